@@ -0,0 +1,470 @@
+"""
+Bulk geolocation of a directory or zip of images.
+
+Each image flows through a pipeline whose stages overlap across images:
+decode (thread pool), CLIP embedding (shared with other images through the
+micro-batcher), concurrent vector queries and rate-limited concurrent LLM
+calls. Results are appended to a JSONL file as they finish; that file is
+also the checkpoint, so an interrupted run resumes where it stopped.
+
+    python batch.py photos/ --output results.jsonl
+    python batch.py photos.zip --output results.jsonl --llm-concurrency 8 --llm-rpm 600
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Awaitable, Callable, Iterator, Optional, Set, Tuple
+
+from clustering import cluster_matches
+from embedding_cache import content_hash
+from executor import run_cpu, run_io
+from ingest import build_artifacts
+from llm import RateLimiter
+from pineconedb import aembed_preprocessed, aquery_namespaces
+from reasoning import GEOLOCATION_MODE, CoordinatesStreamParser, aestimate_coordinates, athink, athink_structured
+from scheduler import QueueFull, Scheduler
+
+logger = logging.getLogger(__name__)
+
+BATCH_DECODE_WORKERS = int(os.getenv("BATCH_DECODE_WORKERS", str(os.cpu_count() or 4)))
+# Images between decode and write at any time (bounds memory)
+BATCH_INFLIGHT = int(os.getenv("BATCH_INFLIGHT", "64"))
+BATCH_QUERY_CONCURRENCY = int(os.getenv("BATCH_QUERY_CONCURRENCY", "16"))
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "4"))
+# LLM requests per minute across the whole batch (0 = unlimited)
+BATCH_LLM_RPM = float(os.getenv("BATCH_LLM_RPM", "60"))
+BATCH_REPORT_SECONDS = float(os.getenv("BATCH_REPORT_SECONDS", "10"))
+# Where HTTP batch jobs keep their input archive, status and results
+BATCH_DIR = os.getenv("BATCH_DIR", "batches")
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+# Scheduler slots one HTTP batch job may hold (its images in flight)
+BATCH_JOB_CONCURRENCY = int(os.getenv("BATCH_JOB_CONCURRENCY", "2"))
+# Pause before asking again when the scheduler queue is full
+BATCH_QUEUE_RETRY_SECONDS = 1.0
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+
+QUERY_SPECS = [
+    {"namespace": "images", "top_k": 25, "threshold": 0.7},
+    {"namespace": "features", "top_k": 25, "threshold": 0.7},
+]
+
+STAGES = ("decode", "embed", "query", "llm")
+
+
+def iter_sources(path: str) -> Iterator[Tuple[str, Callable[[], bytes]]]:
+    """
+    (name, read) for every image in a directory (recursively) or zip file.
+    read() returns the raw bytes and is safe to call from worker threads
+    """
+    source = Path(path)
+    if source.is_dir():
+        for file in sorted(p for p in source.rglob("*") if p.suffix.lower() in IMAGE_SUFFIXES):
+            yield str(file.relative_to(source)), file.read_bytes
+        return
+
+    def reader(name):
+        # Each read gets its own handle: the listing below is closed long
+        # before the images are read, and threads never share a file position
+        def read():
+            with zipfile.ZipFile(source) as archive:
+                return archive.read(name)
+        return read
+
+    with zipfile.ZipFile(source) as archive:
+        names = sorted(archive.namelist())
+    for name in names:
+        if Path(name).suffix.lower() in IMAGE_SUFFIXES and not name.startswith("__MACOSX/"):
+            yield name, reader(name)
+
+
+def completed(output: Path) -> Set[str]:
+    """
+    Names already written to a results file, not counting failures so they
+    are retried (the last record for a name wins). A torn last line (the
+    previous run was killed mid-write) is cut off so the file stays valid JSONL
+    """
+    if not output.exists():
+        return set()
+    done = set()
+    valid_bytes = 0
+    with open(output, "rb") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                name = record["name"]
+            except (ValueError, KeyError, TypeError):
+                break
+            if "error" in record:
+                done.discard(name)
+            else:
+                done.add(name)
+            valid_bytes += len(line)
+    if valid_bytes < output.stat().st_size:
+        with open(output, "r+b") as f:
+            f.truncate(valid_bytes)
+    return done
+
+
+class BatchStats:
+    """Counts and per-stage busy time, for progress reports and the final summary"""
+
+    def __init__(self, total: int, skipped: int):
+        self.total = total
+        self.skipped = skipped
+        self.done = 0
+        self.failed = 0
+        self.stage_seconds = {stage: 0.0 for stage in STAGES}
+        self.started = time.perf_counter()
+
+    def snapshot(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        processed = self.done + self.failed
+        return {
+            "total": self.total,
+            "skipped": self.skipped,
+            "done": self.done,
+            "failed": self.failed,
+            "remaining": self.total - self.skipped - processed,
+            "elapsed_seconds": round(elapsed, 1),
+            "images_per_sec": round(processed / elapsed, 3) if elapsed else 0.0,
+            "mean_stage_seconds": {stage: round(seconds / processed, 3) if processed else 0.0 for stage, seconds in self.stage_seconds.items()},
+        }
+
+
+class BatchRunner:
+    def __init__(self, source: str, output: str, decode_workers: int = BATCH_DECODE_WORKERS, inflight: int = BATCH_INFLIGHT,
+                 query_concurrency: int = BATCH_QUERY_CONCURRENCY, llm_concurrency: int = BATCH_LLM_CONCURRENCY,
+                 llm_rpm: float = BATCH_LLM_RPM, limit: Optional[int] = None, report_seconds: float = BATCH_REPORT_SECONDS,
+                 on_progress: Optional[Callable[[dict], None]] = None,
+                 admit: Optional[Callable[[Callable[[], Awaitable[dict]]], Awaitable[dict]]] = None):
+        self.source = source
+        self.output = Path(output)
+        self.decode_pool = ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="batch-decode")
+        self.inflight = asyncio.Semaphore(inflight)
+        self.query_slots = asyncio.Semaphore(query_concurrency)
+        self.llm_slots = asyncio.Semaphore(llm_concurrency)
+        self.llm_rate = RateLimiter(llm_rpm, burst=llm_concurrency)
+        self.limit = limit
+        self.report_seconds = report_seconds
+        # Called on the I/O pool, so it may block (e.g. write a status file)
+        self.on_progress = on_progress or (lambda stats: logger.info(f"batch progress: {stats}"))
+        # Wraps the processing of each image, e.g. to take a scheduler slot
+        self.admit = admit
+        self.stats: Optional[BatchStats] = None
+        self._write_lock = asyncio.Lock()
+
+    async def _llm(self, call):
+        async with self.llm_slots:
+            await self.llm_rate.acquire()
+            return await call()
+
+    async def _geolocate(self, artifacts, image_matches, feature_matches, clusters) -> Tuple[str, list]:
+        """Reasoning text and parsed candidate locations for one image"""
+        if GEOLOCATION_MODE == "single_pass":
+            async def structured():
+                parser = CoordinatesStreamParser()
+                text, locations = "", []
+                async for chunk in athink_structured(image_matches, feature_matches, artifacts.data_url, clusters):
+                    visible, found = parser.feed(chunk.content)
+                    text += visible
+                    locations.extend(found)
+                return text + parser.flush(), locations
+
+            reasoning, locations = await self._llm(structured)
+            if locations:
+                return reasoning, locations
+        else:
+            async def reason():
+                return "".join([chunk.content async for chunk in athink(image_matches, feature_matches, artifacts.data_url, clusters)])
+
+            reasoning = await self._llm(reason)
+
+        coordinates = await self._llm(lambda: aestimate_coordinates(reasoning, clusters))
+        try:
+            return reasoning, json.loads(coordinates)
+        except ValueError:
+            return reasoning, []
+
+    async def _process(self, name: str, read: Callable[[], bytes]) -> dict:
+        timings = {}
+        loop = asyncio.get_running_loop()
+
+        def decode():
+            data = read()
+            return content_hash(data), build_artifacts(data)
+
+        start = time.perf_counter()
+        digest, artifacts = await loop.run_in_executor(self.decode_pool, decode)
+        timings["decode"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        vector = await aembed_preprocessed(artifacts.clip_input)
+        timings["embed"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        async with self.query_slots:
+            results = await aquery_namespaces(QUERY_SPECS, vector=vector)
+        image_matches, feature_matches = results["images"], results["features"]
+        clusters = await run_cpu(cluster_matches, image_matches)
+        timings["query"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        reasoning, locations = await self._geolocate(artifacts, image_matches, feature_matches, clusters)
+        timings["llm"] = time.perf_counter() - start
+
+        return {
+            "name": name,
+            "sha256": digest,
+            "locations": locations,
+            "reasoning": reasoning,
+            "image_matches": len(image_matches),
+            "clusters": clusters,
+            "timings": {stage: round(seconds, 3) for stage, seconds in timings.items()},
+        }
+
+    async def _write(self, record: dict):
+        line = json.dumps(record) + "\n"
+
+        def append():
+            with open(self.output, "a") as f:
+                f.write(line)
+
+        async with self._write_lock:
+            await run_io(append)
+
+    async def _run_one(self, name: str, read: Callable[[], bytes]):
+        try:
+            if self.admit is None:
+                record = await self._process(name, read)
+            else:
+                record = await self.admit(lambda: self._process(name, read))
+            for stage, seconds in record["timings"].items():
+                self.stats.stage_seconds[stage] += seconds
+            self.stats.done += 1
+        except Exception as e:
+            logger.error(f"batch: {name} failed: {e}")
+            record = {"name": name, "error": str(e)}
+            self.stats.failed += 1
+        finally:
+            self.inflight.release()
+        await self._write(record)
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.report_seconds)
+            await run_io(self.on_progress, self.stats.snapshot())
+
+    async def run(self) -> dict:
+        """Process every image not already in the output file; returns the final stats"""
+        self.output.parent.mkdir(parents=True, exist_ok=True)
+        done = await run_io(completed, self.output)
+        sources = await run_io(lambda: list(iter_sources(self.source)))
+        if self.limit is not None:
+            sources = sources[:self.limit]
+        pending = [(name, read) for name, read in sources if name not in done]
+        self.stats = BatchStats(total=len(sources), skipped=len(sources) - len(pending))
+
+        reporter = asyncio.create_task(self._report())
+        tasks = []
+        try:
+            for name, read in pending:
+                # Backpressure: never more than BATCH_INFLIGHT decoded images in memory
+                await self.inflight.acquire()
+                tasks.append(asyncio.create_task(self._run_one(name, read)))
+            await asyncio.gather(*tasks)
+        finally:
+            reporter.cancel()
+            for task in tasks:
+                task.cancel()
+            self.decode_pool.shutdown(wait=False, cancel_futures=True)
+
+        summary = self.stats.snapshot()
+        await run_io(self.on_progress, summary)
+        return summary
+
+
+class BatchJobs:
+    """
+    Batch jobs submitted over HTTP. Each job gets a directory under BATCH_DIR
+    with the uploaded zip, results.jsonl and status.json, so status and
+    results can be read back after a restart. resume() (called at startup)
+    restarts jobs left running, which skip the images already in their
+    results file
+    """
+
+    def __init__(self, root: str = BATCH_DIR, scheduler: Optional[Scheduler] = None, concurrency: int = BATCH_JOB_CONCURRENCY):
+        self.root = Path(root)
+        # Images are admitted through the scheduler next to websocket jobs
+        self.scheduler = scheduler
+        self.concurrency = concurrency
+        self._tasks = {}
+        self._stopping = False
+        self._status_lock = threading.Lock()
+
+    def _dir(self, job_id: str) -> Path:
+        return self.root / job_id
+
+    def _write_status(self, job_id: str, status: dict):
+        path = self._dir(job_id) / "status.json"
+        tmp = path.with_suffix(".tmp")
+        with self._status_lock:
+            tmp.write_text(json.dumps(status))
+            os.replace(tmp, path)
+
+    async def create(self, upload, chunk_bytes: int = 1024 * 1024) -> dict:
+        """Store an uploaded zip (streamed in chunks) and start processing it"""
+        job_id = uuid.uuid4().hex
+        job_dir = self._dir(job_id)
+        await run_io(job_dir.mkdir, parents=True)
+        archive = job_dir / "input.zip"
+
+        try:
+            size = 0
+            f = await run_io(open, archive, "wb")
+            try:
+                while chunk := await upload.read(chunk_bytes):
+                    size += len(chunk)
+                    if size > BATCH_MAX_BYTES:
+                        raise ValueError("Batch archive too large")
+                    await run_io(f.write, chunk)
+            finally:
+                await run_io(f.close)
+            if not await run_io(zipfile.is_zipfile, archive):
+                raise ValueError("Batch input must be a zip file")
+        except BaseException:
+            # Rejected or interrupted upload: do not keep the partial archive
+            await asyncio.shield(run_io(shutil.rmtree, job_dir, ignore_errors=True))
+            raise
+
+        status = {"job_id": job_id, "state": "running", "progress": None, "error": None}
+        await run_io(self._write_status, job_id, status)
+        self._start(job_id, status)
+        return status
+
+    async def resume(self):
+        """Restart the jobs that were still running when the server stopped"""
+
+        def interrupted():
+            jobs = []
+            for path in self.root.glob("*/status.json"):
+                try:
+                    status = json.loads(path.read_text())
+                except ValueError:
+                    continue
+                if status.get("state") == "running" and status.get("job_id") == path.parent.name:
+                    jobs.append(status)
+            return jobs
+
+        for status in await run_io(interrupted):
+            if status["job_id"] not in self._tasks:
+                logger.info(f"Resuming batch job {status['job_id']}")
+                self._start(status["job_id"], status)
+
+    def _start(self, job_id: str, status: dict):
+        job_dir = self._dir(job_id)
+
+        def progress(stats: dict):
+            status["progress"] = stats
+            self._write_status(job_id, status)
+
+        session_id = f"batch:{job_id}"
+
+        async def _admit(job):
+            while True:
+                try:
+                    return await self.scheduler.run(session_id, job)
+                except QueueFull:
+                    # Interactive sessions keep their place; try again shortly
+                    await asyncio.sleep(BATCH_QUEUE_RETRY_SECONDS)
+
+        if self.scheduler is not None:
+            self.scheduler.set_session_limit(session_id, self.concurrency)
+        admit = _admit if self.scheduler is not None else None
+
+        # With admission, images past the job's slots would only wait in the scheduler queue
+        inflight = self.concurrency if self.scheduler is not None else BATCH_INFLIGHT
+        runner = BatchRunner(str(job_dir / "input.zip"), str(job_dir / "results.jsonl"), inflight=inflight,
+                             on_progress=progress, admit=admit)
+        self._tasks[job_id] = asyncio.create_task(self._run(job_id, runner, status))
+
+    async def _run(self, job_id: str, runner: BatchRunner, status: dict):
+        try:
+            await runner.run()
+            status["state"] = "done"
+        except asyncio.CancelledError:
+            if self._stopping:
+                # Server shutdown: the job stays "running" so the next start resumes it
+                self._tasks.pop(job_id, None)
+                return
+            status["state"] = "cancelled"
+        except Exception as e:
+            logger.exception(f"Batch job {job_id} failed: {e}")
+            status.update(state="failed", error=str(e))
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.set_session_limit(f"batch:{job_id}", None)
+        self._tasks.pop(job_id, None)
+        await run_io(self._write_status, job_id, status)
+
+    def status(self, job_id: str) -> Optional[dict]:
+        path = self._dir(job_id) / "status.json"
+        if not path.exists():
+            return None
+        return json.loads(path.read_text())
+
+    def results_path(self, job_id: str) -> Optional[Path]:
+        path = self._dir(job_id) / "results.jsonl"
+        return path if path.exists() else None
+
+    def cancel(self, job_id: str) -> bool:
+        task = self._tasks.get(job_id)
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+    async def stop(self):
+        """Stop running jobs at shutdown, leaving them to be resumed"""
+        self._stopping = True
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Geolocate every image in a directory or zip file")
+    parser.add_argument("source", help="directory or .zip of images")
+    parser.add_argument("--output", required=True, help="JSONL results file (re-run to resume)")
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--decode-workers", type=int, default=BATCH_DECODE_WORKERS)
+    parser.add_argument("--inflight", type=int, default=BATCH_INFLIGHT)
+    parser.add_argument("--query-concurrency", type=int, default=BATCH_QUERY_CONCURRENCY)
+    parser.add_argument("--llm-concurrency", type=int, default=BATCH_LLM_CONCURRENCY)
+    parser.add_argument("--llm-rpm", type=float, default=BATCH_LLM_RPM, help="LLM requests per minute, 0 for no limit")
+    parser.add_argument("--report-seconds", type=float, default=BATCH_REPORT_SECONDS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    runner = BatchRunner(
+        args.source, args.output,
+        decode_workers=args.decode_workers, inflight=args.inflight,
+        query_concurrency=args.query_concurrency, llm_concurrency=args.llm_concurrency,
+        llm_rpm=args.llm_rpm, limit=args.limit, report_seconds=args.report_seconds,
+        on_progress=lambda stats: print(json.dumps(stats)),
+    )
+    asyncio.run(runner.run())
+
+
+if __name__ == "__main__":
+    main()
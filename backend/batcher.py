@@ -0,0 +1,102 @@
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import Callable, List, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    Dynamic micro-batching in front of a batched model call.
+
+    Callers submit single inputs from any thread and get a Future back. A
+    worker thread waits up to max_latency_ms after the first queued input
+    (or until max_batch_size inputs are queued), runs encode_fn once on the
+    whole batch and resolves each Future with its own row of the output.
+    """
+
+    def __init__(self, encode_fn: Callable[[List], Sequence], max_batch_size: int = 16, max_latency_ms: float = 5.0, name: str = "batcher"):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_latency = max(0.0, max_latency_ms) / 1000
+        self.name = name
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._requests = 0
+        self._batches = 0
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def submit(self, item) -> Future:
+        """Queue one input for the next batch"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def encode(self, item):
+        """Blocking helper: submit one input and wait for its output"""
+        return self.submit(item).result()
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                outputs = self.encode_fn([item for item, _ in batch])
+            except Exception as e:
+                logger.error(f"{self.name}: batch of {len(batch)} failed: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), output in zip(batch, outputs):
+                future.set_result(output)
+
+            with self._stats_lock:
+                self._batch_sizes[len(batch)] += 1
+                self._requests += len(batch)
+                self._batches += 1
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "requests": self._requests,
+                "batches": self._batches,
+                "mean_batch_size": self._requests / self._batches if self._batches else 0.0,
+                "max_batch_size_seen": max(self._batch_sizes) if self._batch_sizes else 0,
+                "batch_size_histogram": dict(sorted(self._batch_sizes.items())),
+                "queued": self._queue.qsize(),
+                "max_batch_size": self.max_batch_size,
+                "max_latency_ms": self.max_latency * 1000,
+            }
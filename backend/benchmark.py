@@ -0,0 +1,215 @@
+"""
+Offline end-to-end benchmark of the backend.
+
+Pinecone, Gemini and Mapillary are replaced by the stand-ins in fakes.py
+(CLIP too with --fake-clip). The app runs in-process under uvicorn; each
+simulated session uploads an image to /upload-image, runs process_image
+(and optionally chat turns) over /ws/chat and records client-side timings.
+
+    python benchmark.py --sessions 32 --concurrency 16 --output bench.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import httpx
+import numpy as np
+import uvicorn
+import websockets
+from PIL import Image
+
+BACKEND_DIR = Path(__file__).resolve().parent
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _test_image(seed: int) -> bytes:
+    """Distinct random image per session so the result cache never hits"""
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, size=(480, 640, 3), dtype=np.uint8)
+    buffered = io.BytesIO()
+    Image.fromarray(pixels).save(buffered, format="JPEG", quality=85)
+    return buffered.getvalue()
+
+
+def _summarize(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0}
+    array = np.array(values) * 1000
+    return {
+        "count": len(values),
+        "mean_ms": round(float(array.mean()), 2),
+        "p50_ms": round(float(np.percentile(array, 50)), 2),
+        "p90_ms": round(float(np.percentile(array, 90)), 2),
+        "p99_ms": round(float(np.percentile(array, 99)), 2),
+        "max_ms": round(float(array.max()), 2),
+    }
+
+
+async def _receive_until_complete(ws, start: float, timings: Dict[str, float], prefix: str, frames: List[int]):
+    """Record the first occurrence of each message type until 'complete' or 'error'"""
+    while True:
+        message = json.loads(await ws.recv())
+        frames[0] += 1
+        kind = message.get("type")
+        key = f"{prefix}{kind}"
+        if key not in timings:
+            timings[key] = time.perf_counter() - start
+        if kind in ("complete", "error"):
+            return kind
+
+
+async def _run_session(client: httpx.AsyncClient, base_url: str, ws_url: str, index: int, chat_turns: int, stages: Dict[str, List[float]], errors: List[str], frames: List[int]):
+    session_id = f"bench-{index}-{random.getrandbits(32):08x}"
+    session_start = time.perf_counter()
+
+    start = time.perf_counter()
+    response = await client.post(f"{base_url}/upload-image/{session_id}", files={"file": ("bench.jpg", _test_image(index), "image/jpeg")})
+    if response.status_code != 200:
+        errors.append(f"upload {response.status_code}: {response.text}")
+        return
+    stages["upload"].append(time.perf_counter() - start)
+
+    async with websockets.connect(f"{ws_url}/ws/chat/{session_id}", max_size=None) as ws:
+        timings: Dict[str, float] = {}
+        start = time.perf_counter()
+        await ws.send(json.dumps({"type": "process_image", "session_id": session_id}))
+        if await _receive_until_complete(ws, start, timings, "", frames) == "error":
+            errors.append(f"process_image failed for {session_id}")
+            return
+        for kind, stage in (("status", "first_status"), ("reasoning_chunk", "time_to_first_chunk"), ("coordinates", "coordinates"), ("complete", "analysis_total")):
+            if kind in timings:
+                stages[stage].append(timings[kind])
+
+        history = []
+        for turn in range(chat_turns):
+            timings = {}
+            start = time.perf_counter()
+            await ws.send(json.dumps({"type": "chat_message", "text": f"Are you sure? ({turn})", "history": history, "session_id": session_id}))
+            if await _receive_until_complete(ws, start, timings, "chat_", frames) == "error":
+                errors.append(f"chat_message failed for {session_id}")
+                return
+            if "chat_chat_response_chunk" in timings:
+                stages["chat_time_to_first_chunk"].append(timings["chat_chat_response_chunk"])
+            stages["chat_total"].append(timings["chat_complete"])
+            history.append({"role": "user", "text": f"Are you sure? ({turn})"})
+
+    stages["session_total"].append(time.perf_counter() - session_start)
+
+
+async def _drive(base_url: str, ws_url: str, sessions: int, concurrency: int, chat_turns: int):
+    stages: Dict[str, List[float]] = {name: [] for name in (
+        "upload", "first_status", "time_to_first_chunk", "coordinates", "analysis_total",
+        "chat_time_to_first_chunk", "chat_total", "session_total",
+    )}
+    errors: List[str] = []
+    # Websocket frames received across all sessions
+    frames = [0]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(i):
+        async with semaphore:
+            try:
+                await _run_session(client, base_url, ws_url, i, chat_turns, stages, errors, frames)
+            except Exception as e:
+                errors.append(f"session {i}: {e!r}")
+
+    async with httpx.AsyncClient(timeout=120) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(limited(i) for i in range(sessions)))
+        wall = time.perf_counter() - start
+
+    return stages, errors, wall, frames[0]
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark with fake Pinecone, Gemini and Mapillary")
+    parser.add_argument("--sessions", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--chat-turns", type=int, default=1)
+    parser.add_argument("--index-latency-ms", type=float, default=40)
+    parser.add_argument("--first-token-ms", type=float, default=400)
+    parser.add_argument("--tokens-per-sec", type=float, default=80)
+    parser.add_argument("--output-tokens", type=int, default=250)
+    parser.add_argument("--invoke-ms", type=float, default=900)
+    parser.add_argument("--llm-stall-rate", type=float, default=0.0, help="fraction of LLM calls that stall (exercises hedging)")
+    parser.add_argument("--llm-stall-ms", type=float, default=5000)
+    parser.add_argument("--mapillary-latency-ms", type=float, default=150)
+    parser.add_argument("--fake-clip", action="store_true", help="replace CLIP with a fixed-latency stand-in")
+    parser.add_argument("--clip-latency-ms", type=float, default=30)
+    parser.add_argument("--output", help="write the JSON report here")
+    args = parser.parse_args()
+
+    output = Path(args.output).resolve() if args.output else None
+
+    # Uploads and caches go to a scratch directory, nothing persists
+    os.environ["RESULT_CACHE_PATH"] = ""
+    workdir = tempfile.mkdtemp(prefix="rainbolt-bench-")
+    os.chdir(workdir)
+    sys.path.insert(0, str(BACKEND_DIR))
+
+    import fakes
+    fakes.install(
+        index=fakes.FakeIndex(latency_ms=args.index_latency_ms),
+        chat_model=fakes.FakeChatModel(first_token_ms=args.first_token_ms, tokens_per_sec=args.tokens_per_sec, output_tokens=args.output_tokens, invoke_ms=args.invoke_ms, stall_rate=args.llm_stall_rate, stall_ms=args.llm_stall_ms),
+        mapillary_latency_ms=args.mapillary_latency_ms,
+        clip_model=fakes.FakeClip(latency_ms=args.clip_latency_ms) if args.fake_clip else None,
+    )
+    import main as backend
+    import warmup
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(backend.app, host="127.0.0.1", port=port, log_level="warning", ws_per_message_deflate=True))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    # Measure steady state, not model loading
+    while not warmup.readiness.ready:
+        time.sleep(0.1)
+
+    stages, errors, wall, frames = asyncio.run(_drive(f"http://127.0.0.1:{port}", f"ws://127.0.0.1:{port}", args.sessions, args.concurrency, args.chat_turns))
+    server.should_exit = True
+    thread.join(timeout=10)
+
+    completed = len(stages["session_total"])
+    report = {
+        "revision": _git_revision(),
+        "config": vars(args),
+        "sessions_completed": completed,
+        "errors": errors,
+        "wall_seconds": round(wall, 3),
+        "sessions_per_sec": round(completed / wall, 3) if wall else 0.0,
+        "frames_per_session": round(frames / completed, 1) if completed else 0.0,
+        "stages": {name: _summarize(values) for name, values in stages.items()},
+        "llm": backend.llm_client.snapshot(),
+    }
+    print(json.dumps(report, indent=2))
+    if output:
+        output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Where uploaded images and their derived artifacts live.
+
+BLOB_STORE=file keeps them under BLOB_DIR (the local uploads/ directory by
+default, or a directory shared between nodes such as an NFS mount);
+BLOB_STORE=s3 uses an S3-compatible bucket so any worker can serve any session.
+"""
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+BLOB_STORE = os.getenv("BLOB_STORE", "file")
+BLOB_DIR = os.getenv("BLOB_DIR", "uploads")
+S3_BUCKET = os.getenv("S3_BUCKET", "")
+S3_PREFIX = os.getenv("S3_PREFIX", "uploads/")
+# Set for MinIO / R2 / other S3-compatible endpoints
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+
+
+class BlobStore:
+    """Key -> bytes storage, keys may contain "/". Methods block; call them via run_io"""
+
+    def put(self, key: str, data: bytes):
+        raise NotImplementedError
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Stored bytes, or None if the key does not exist"""
+        raise NotImplementedError
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def location(self, key: str) -> str:
+        """Human-readable location of a key, for responses and logs"""
+        raise NotImplementedError
+
+
+class FileBlobStore(BlobStore):
+    """
+    Blobs as files in one directory. Writes go to a temp file and are renamed
+    into place, so readers on other workers never see a partial file
+    """
+
+    def __init__(self, root: str = BLOB_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.root / key
+
+    def put(self, key: str, data: bytes):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.chmod(tmp, 0o666)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self._path(key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def delete(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+
+    def location(self, key: str) -> str:
+        return str(self._path(key))
+
+
+class S3BlobStore(BlobStore):
+    """Blobs as objects under a prefix of an S3-compatible bucket (needs boto3)"""
+
+    def __init__(self, bucket: str = S3_BUCKET, prefix: str = S3_PREFIX, endpoint_url: Optional[str] = S3_ENDPOINT_URL):
+        if not bucket:
+            raise ValueError("S3_BUCKET environment variable not set")
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError as e:
+            raise ImportError("BLOB_STORE=s3 requires boto3 (pip install boto3)") from e
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client = boto3.client("s3", endpoint_url=endpoint_url)
+        self._client_error = ClientError
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    def _missing(self, error) -> bool:
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def put(self, key: str, data: bytes):
+        self._client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data)
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            response = self._client.get_object(Bucket=self.bucket, Key=self._key(key))
+        except self._client_error as e:
+            if self._missing(e):
+                return None
+            raise
+        return response["Body"].read()
+
+    def exists(self, key: str) -> bool:
+        try:
+            self._client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except self._client_error as e:
+            if self._missing(e):
+                return False
+            raise
+        return True
+
+    def delete(self, key: str):
+        self._client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def location(self, key: str) -> str:
+        return f"s3://{self.bucket}/{self._key(key)}"
+
+
+def create_blob_store() -> BlobStore:
+    """The blob store selected by BLOB_STORE"""
+    if BLOB_STORE == "file":
+        return FileBlobStore(BLOB_DIR)
+    if BLOB_STORE == "s3":
+        return S3BlobStore()
+    raise ValueError(f"Unknown BLOB_STORE: {BLOB_STORE}")
@@ -0,0 +1,359 @@
+"""
+Build or refresh the images and features namespaces from source data.
+
+    python build_index.py images manifest.csv
+    python build_index.py features features.jsonl
+    python build_index.py images manifest.jsonl --target local --root index
+
+Image manifests are CSV or JSONL rows with path (relative to the manifest),
+latitude and longitude; feature files need a text column. Other columns are
+kept as metadata. Vector ids are content hashes, so an image or text that
+appears twice is indexed once and reruns overwrite rather than duplicate.
+
+Loader threads read, hash, decode and CLIP-preprocess rows ahead of the
+encoder, which runs the server's CLIP model over large batches while
+upsert workers send the previous batches concurrently. Ids are appended to
+a per-namespace checkpoint file once stored, so an interrupted run resumes
+by skipping them.
+"""
+import argparse
+import csv
+import hashlib
+import io
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Set, Tuple
+
+import torch
+from PIL import Image, ImageOps
+
+from embedding_cache import content_hash
+from pineconedb import encode_texts, get_clip, index_name
+from vectorstore import LocalStore, PineconeStore
+
+logger = logging.getLogger(__name__)
+
+# CLIP looks at 224px crops: JPEGs are decoded straight at (at least) this size
+DECODE_SIZE = 448
+
+Upsert = Callable[[List[str], List[List[float]], List[dict]], None]
+
+
+def read_manifest(path: Path) -> Iterator[dict]:
+    """Rows of a CSV (by extension) or JSONL file"""
+    with open(path, newline="") as f:
+        if path.suffix.lower() == ".csv":
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _metadata(row: dict, exclude=()) -> dict:
+    """Manifest columns as index metadata (empty values dropped, Pinecone rejects nulls)"""
+    return {key: value for key, value in row.items() if key not in exclude and value not in (None, "")}
+
+
+def prefetch(pool: Executor, func: Callable, items: Iterable, depth: int) -> Iterator:
+    """func(item) for every item, in order, keeping up to depth calls running ahead"""
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class ImageSource:
+    """Geotagged images listed in a manifest, encoded with the CLIP image tower"""
+
+    namespace = "images"
+
+    def __init__(self, manifest: Path, root: Optional[Path] = None):
+        self.manifest = manifest
+        self.root = root or manifest.parent
+
+    def rows(self) -> Iterator[dict]:
+        return read_manifest(self.manifest)
+
+    def load(self, row: dict, skip: Set[str]) -> Tuple[str, Optional[torch.Tensor], Optional[dict]]:
+        """(id, preprocessed tensor, metadata); the tensor is None for ids in skip"""
+        data = (self.root / row["path"]).read_bytes()
+        vector_id = content_hash(data)
+        if vector_id in skip:
+            return vector_id, None, None
+        metadata = _metadata(row, exclude=("path", "latitude", "longitude"))
+        metadata.update(latitude=float(row["latitude"]), longitude=float(row["longitude"]), source=row["path"])
+
+        image = Image.open(io.BytesIO(data))
+        image.draft("RGB", (DECODE_SIZE, DECODE_SIZE))
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        return vector_id, get_clip().preprocess(image), metadata
+
+    def encode(self, inputs: List[torch.Tensor]) -> List[List[float]]:
+        return get_clip().encode_image(torch.stack(inputs)).tolist()
+
+
+class FeatureSource:
+    """Feature descriptions, encoded with the CLIP text tower"""
+
+    namespace = "features"
+
+    def __init__(self, manifest: Path):
+        self.manifest = manifest
+
+    def rows(self) -> Iterator[dict]:
+        return read_manifest(self.manifest)
+
+    def load(self, row: dict, skip: Set[str]) -> Tuple[str, Optional[str], Optional[dict]]:
+        text = row["text"].strip()
+        vector_id = hashlib.sha256(text.encode()).hexdigest()
+        if vector_id in skip:
+            return vector_id, None, None
+        return vector_id, text, {**_metadata(row), "text": text}
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        return encode_texts(texts)
+
+
+class Checkpoint:
+    """Ids already stored in a namespace, appended one per line as upserts finish"""
+
+    def __init__(self, path: Optional[Path] = None):
+        self.ids: Set[str] = set()
+        self._file = None
+        self._lock = threading.Lock()
+        if path is None:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.exists():
+            text = path.read_text()
+            # A torn last id never matches; keep the next append on its own line
+            self.ids = set(text.split())
+            self._file = open(path, "a")
+            if text and not text.endswith("\n"):
+                self._file.write("\n")
+        else:
+            self._file = open(path, "a")
+
+    def add(self, ids: List[str]):
+        with self._lock:
+            self.ids.update(ids)
+            if self._file is not None:
+                self._file.write("".join(f"{vector_id}\n" for vector_id in ids))
+                self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class Uploader:
+    """
+    Upserts in batches of batch_size from concurrency worker threads, with at
+    most 2 * concurrency batches waiting. A batch is retried with backoff and
+    its ids are checkpointed once stored; a batch that keeps failing is
+    counted and left for the next run
+    """
+
+    def __init__(self, upsert: Upsert, checkpoint: Checkpoint, batch_size: int = 100, concurrency: int = 8, retries: int = 3):
+        self.upsert = upsert
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.retries = retries
+        self.pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="upsert")
+        self._slots = threading.Semaphore(2 * concurrency)
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.failed = 0
+
+    def submit(self, ids: List[str], vectors: List[List[float]], metadata: List[dict]):
+        for start in range(0, len(ids), self.batch_size):
+            end = start + self.batch_size
+            self._slots.acquire()
+            self.pool.submit(self._send, ids[start:end], vectors[start:end], metadata[start:end])
+
+    def _send(self, ids, vectors, metadata):
+        try:
+            for attempt in range(self.retries):
+                try:
+                    self.upsert(ids, vectors, metadata)
+                    break
+                except Exception as e:
+                    if attempt == self.retries - 1:
+                        logger.error(f"Upsert of {len(ids)} vectors failed, leaving them for the next run: {e}")
+                        with self._lock:
+                            self.failed += len(ids)
+                        return
+                    time.sleep(2 ** attempt)
+            self.checkpoint.add(ids)
+            with self._lock:
+                self.stored += len(ids)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+class IndexBuilder:
+    def __init__(self, source, uploader: Uploader, batch_size: int = 256, decode_workers: int = os.cpu_count() or 4,
+                 prefetch_depth: int = 1024, report_seconds: float = 10):
+        self.source = source
+        self.uploader = uploader
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers
+        self.prefetch_depth = prefetch_depth
+        self.report_seconds = report_seconds
+        self.rows = 0
+        self.skipped = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.encoded = 0
+        self.encode_seconds = 0.0
+        self.loader_wait_seconds = 0.0
+        self.started = time.perf_counter()
+
+    def _load(self, row: dict):
+        try:
+            return self.source.load(row, self.uploader.checkpoint.ids)
+        except Exception as e:
+            logger.warning(f"Skipping {row.get('path') or row.get('text', '')[:40]!r}: {e}")
+            return None
+
+    def _flush(self, ids: List[str], inputs: list, metadata: List[dict]):
+        start = time.perf_counter()
+        vectors = self.source.encode(inputs)
+        self.encode_seconds += time.perf_counter() - start
+        self.encoded += len(ids)
+        self.uploader.submit(ids, vectors, metadata)
+
+    def stats(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        return {
+            "namespace": self.source.namespace,
+            "rows": self.rows,
+            "skipped": self.skipped,
+            "duplicates": self.duplicates,
+            "failed": self.failed + self.uploader.failed,
+            "encoded": self.encoded,
+            "stored": self.uploader.stored,
+            "elapsed_seconds": round(elapsed, 1),
+            "encoded_per_sec": round(self.encoded / elapsed, 1) if elapsed else 0.0,
+            "stored_per_sec": round(self.uploader.stored / elapsed, 1) if elapsed else 0.0,
+            # Where the time goes: a busy encoder is the goal, loader waits mean more decode workers
+            "encoder_busy": round(self.encode_seconds / elapsed, 2) if elapsed else 0.0,
+            "loader_wait": round(self.loader_wait_seconds / elapsed, 2) if elapsed else 0.0,
+        }
+
+    def run(self, limit: Optional[int] = None) -> dict:
+        rows = itertools.islice(self.source.rows(), limit)
+        seen: Set[str] = set()
+        ids, inputs, metadata = [], [], []
+        last_report = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.decode_workers, thread_name_prefix="index-load") as pool:
+            results = prefetch(pool, self._load, rows, self.prefetch_depth)
+            while True:
+                start = time.perf_counter()
+                result = next(results, StopIteration)
+                self.loader_wait_seconds += time.perf_counter() - start
+                if result is StopIteration:
+                    break
+
+                self.rows += 1
+                if result is None:
+                    self.failed += 1
+                    continue
+                vector_id, value, meta = result
+                if value is None:
+                    self.skipped += 1
+                    continue
+                if vector_id in seen:
+                    self.duplicates += 1
+                    continue
+                seen.add(vector_id)
+                ids.append(vector_id)
+                inputs.append(value)
+                metadata.append(meta)
+
+                if len(ids) >= self.batch_size:
+                    self._flush(ids, inputs, metadata)
+                    ids, inputs, metadata = [], [], []
+                if time.perf_counter() - last_report >= self.report_seconds:
+                    logger.info(f"index progress: {self.stats()}")
+                    last_report = time.perf_counter()
+
+            if ids:
+                self._flush(ids, inputs, metadata)
+        self.uploader.close()
+        return self.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed geotagged images or feature texts into the vector index")
+    parser.add_argument("namespace", choices=["images", "features"])
+    parser.add_argument("manifest", type=Path, help="CSV or JSONL manifest")
+    parser.add_argument("--images-root", type=Path, default=None, help="Base directory of image paths (default: the manifest's directory)")
+    parser.add_argument("--target", choices=["pinecone", "local"], default="pinecone")
+    parser.add_argument("--index-name", default=index_name)
+    parser.add_argument("--root", default=os.getenv("LOCAL_INDEX_DIR", "index"), help="Local index directory (--target local)")
+    parser.add_argument("--checkpoint-dir", type=Path, default=Path("index_checkpoints"))
+    parser.add_argument("--batch-size", type=int, default=256, help="Rows per CLIP forward pass")
+    parser.add_argument("--decode-workers", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--prefetch", type=int, default=1024, help="Rows loaded ahead of the encoder")
+    parser.add_argument("--upsert-batch", type=int, default=100)
+    parser.add_argument("--upsert-concurrency", type=int, default=8)
+    parser.add_argument("--report-seconds", type=float, default=10)
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    source = ImageSource(args.manifest, args.images_root) if args.namespace == "images" else FeatureSource(args.manifest)
+
+    writer = None
+    if args.target == "local":
+        # A local snapshot is rewritten as a whole (staged, then swapped in
+        # by close()), so there is nothing to resume
+        writer = LocalStore(args.root).writer(args.namespace)
+        checkpoint = Checkpoint()
+        uploader = Uploader(writer.append, checkpoint, batch_size=args.upsert_batch, concurrency=1)
+    else:
+        from dotenv import load_dotenv
+        from pinecone import Pinecone
+        load_dotenv()
+        store = PineconeStore(Pinecone(api_key=os.getenv("PINECONE_API_KEY")).Index(args.index_name))
+        checkpoint = Checkpoint(args.checkpoint_dir / f"{args.index_name}-{args.namespace}.ids")
+
+        def upsert(ids, vectors, metadata):
+            store.upsert(ids, vectors, metadata, namespace=args.namespace)
+
+        uploader = Uploader(upsert, checkpoint, batch_size=args.upsert_batch, concurrency=args.upsert_concurrency)
+
+    builder = IndexBuilder(source, uploader, batch_size=args.batch_size, decode_workers=args.decode_workers,
+                           prefetch_depth=args.prefetch, report_seconds=args.report_seconds)
+    committed = False
+    try:
+        summary = builder.run(limit=args.limit)
+        if writer is not None:
+            # Swaps the staged snapshot in; a served namespace is never half-written
+            writer.close()
+        committed = True
+    finally:
+        checkpoint.close()
+        if writer is not None and not committed:
+            writer.abort()
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
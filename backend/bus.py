@@ -0,0 +1,182 @@
+"""
+Message bus between workers. Each worker subscribes to the channels of the
+sessions whose websocket it holds, so a message for a session can be
+published from any worker and reaches the one with the socket.
+
+SESSION_BUS=local keeps everything in-process (single worker, or several
+LocalBus instances sharing a LocalHub as a stand-in in tests);
+SESSION_BUS=redis uses Redis pub/sub at REDIS_URL.
+"""
+import asyncio
+import json
+import logging
+import os
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+SESSION_BUS = os.getenv("SESSION_BUS", "local")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+BUS_CHANNEL_PREFIX = os.getenv("BUS_CHANNEL_PREFIX", "rainbolt:")
+# After a lost Redis connection, retry after this long, doubling up to the max
+BUS_RECONNECT_SECONDS = float(os.getenv("BUS_RECONNECT_SECONDS", "0.5"))
+BUS_RECONNECT_MAX_SECONDS = float(os.getenv("BUS_RECONNECT_MAX_SECONDS", "30"))
+
+# Worker-wide events (e.g. a session's upload was replaced)
+BROADCAST_CHANNEL = "broadcast"
+
+Deliver = Callable[[str, dict], Awaitable[None]]
+
+
+def session_channel(session_id: str) -> str:
+    return f"session:{session_id}"
+
+
+class SessionBus:
+    """
+    Publish/subscribe of JSON messages by channel name. Messages for the
+    channels this worker subscribed to are passed to deliver(channel, message),
+    which must not block on a slow client: it runs for every session in turn
+    """
+
+    async def start(self, deliver: Deliver):
+        raise NotImplementedError
+
+    async def publish(self, channel: str, message: dict):
+        raise NotImplementedError
+
+    async def subscribe(self, channel: str):
+        raise NotImplementedError
+
+    async def unsubscribe(self, channel: str):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class LocalHub:
+    """Shared routing table for LocalBus instances in one process"""
+
+    def __init__(self):
+        self.subscribers: Dict[str, Set["LocalBus"]] = {}
+
+
+class LocalBus(SessionBus):
+    def __init__(self, hub: Optional[LocalHub] = None):
+        self.hub = hub or LocalHub()
+        self._deliver: Optional[Deliver] = None
+        self._channels: Set[str] = set()
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+        await self.subscribe(BROADCAST_CHANNEL)
+
+    async def publish(self, channel: str, message: dict):
+        for bus in list(self.hub.subscribers.get(channel, ())):
+            if bus._deliver is not None:
+                await bus._deliver(channel, message)
+
+    async def subscribe(self, channel: str):
+        self._channels.add(channel)
+        self.hub.subscribers.setdefault(channel, set()).add(self)
+
+    async def unsubscribe(self, channel: str):
+        self._channels.discard(channel)
+        subscribers = self.hub.subscribers.get(channel)
+        if subscribers is not None:
+            subscribers.discard(self)
+            if not subscribers:
+                del self.hub.subscribers[channel]
+
+    async def close(self):
+        for channel in list(self._channels):
+            await self.unsubscribe(channel)
+
+
+class RedisBus(SessionBus):
+    """
+    Redis pub/sub (needs the redis package); one listener task per worker.
+    If the connection drops, the listener logs it, resubscribes to every
+    channel on a new connection and retries with backoff
+    """
+
+    def __init__(self, url: str = REDIS_URL, prefix: str = BUS_CHANNEL_PREFIX):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise ImportError("SESSION_BUS=redis requires the redis package (pip install redis)") from e
+        self.prefix = prefix
+        self._redis = redis.from_url(url)
+        self._pubsub = self._redis.pubsub()
+        self._channels: Set[str] = set()
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: Deliver):
+        # Subscribe before listening: the pub/sub connection needs a channel
+        await self.subscribe(BROADCAST_CHANNEL)
+        self._listener = asyncio.create_task(self._listen(deliver))
+
+    async def _listen(self, deliver: Deliver):
+        delay = BUS_RECONNECT_SECONDS
+        while True:
+            try:
+                async for item in self._pubsub.listen():
+                    delay = BUS_RECONNECT_SECONDS
+                    if item.get("type") != "message":
+                        continue
+                    channel = item["channel"]
+                    if isinstance(channel, bytes):
+                        channel = channel.decode()
+                    try:
+                        await deliver(channel[len(self.prefix):], json.loads(item["data"]))
+                    except Exception as e:
+                        logger.error(f"Failed to deliver bus message on {channel}: {e}")
+                # listen() only returns once nothing is subscribed, e.g. a failed resubscribe
+                raise ConnectionError("pub/sub connection has no subscriptions")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Session bus connection lost, reconnecting in {delay:g}s: {e!r}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, BUS_RECONNECT_MAX_SECONDS)
+                await self._reconnect()
+
+    async def _reconnect(self):
+        """Resubscribe every channel on a fresh pub/sub connection"""
+        old, self._pubsub = self._pubsub, self._redis.pubsub()
+        try:
+            await old.aclose()
+        except Exception:
+            pass
+        try:
+            await self._pubsub.subscribe(*[self.prefix + channel for channel in self._channels])
+        except Exception as e:
+            logger.error(f"Session bus resubscribe failed: {e!r}")
+
+    async def publish(self, channel: str, message: dict):
+        await self._redis.publish(self.prefix + channel, json.dumps(message))
+
+    async def subscribe(self, channel: str):
+        # Recorded first so a reconnect restores it even if this call fails
+        self._channels.add(channel)
+        await self._pubsub.subscribe(self.prefix + channel)
+
+    async def unsubscribe(self, channel: str):
+        self._channels.discard(channel)
+        await self._pubsub.unsubscribe(self.prefix + channel)
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+        await self._pubsub.aclose()
+        await self._redis.aclose()
+
+
+def create_bus() -> SessionBus:
+    """The bus selected by SESSION_BUS"""
+    if SESSION_BUS == "local":
+        return LocalBus()
+    if SESSION_BUS == "redis":
+        return RedisBus()
+    raise ValueError(f"Unknown SESSION_BUS: {SESSION_BUS}")
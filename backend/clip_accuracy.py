@@ -0,0 +1,105 @@
+"""
+Compare reduced-precision CLIP inference modes against the fp32 encoder.
+
+For every sample image the fp32 and candidate embeddings are queried against
+the configured vector store; the report gives mean top-k overlap, embedding
+cosine similarity and encode throughput per mode, so the fastest mode that
+keeps retrieval quality can be picked for CLIP_INFERENCE_MODE.
+
+    python clip_accuracy.py --images samples/ --modes int8 channels_last int8,channels_last
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import List
+
+import clip
+import numpy as np
+import torch
+from PIL import Image
+from dotenv import load_dotenv
+
+from clip_runtime import ClipRuntime
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+
+
+def _load_images(directory: str, limit: int) -> List[Image.Image]:
+    paths = sorted(p for p in Path(directory).rglob("*") if p.suffix.lower() in IMAGE_SUFFIXES)[:limit]
+    return [Image.open(p).convert("RGB") for p in paths]
+
+
+def _encode(runtime: ClipRuntime, images: List[Image.Image], batch_size: int):
+    """Embeddings (N, D) and images/sec for one runtime"""
+    inputs = [runtime.preprocess(image) for image in images]
+    runtime.encode_image(torch.stack(inputs[:1]))  # first-inference overhead
+    start = time.perf_counter()
+    vectors = [runtime.encode_image(torch.stack(inputs[i:i + batch_size])) for i in range(0, len(inputs), batch_size)]
+    elapsed = time.perf_counter() - start
+    return torch.cat(vectors).numpy(), len(images) / elapsed
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def _top_ids(store, vectors: np.ndarray, top_k: int, namespace: str) -> List[List[str]]:
+    return [[m['id'] for m in store.query(vector.tolist(), top_k=top_k, namespace=namespace)] for vector in vectors]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Top-k retrieval overlap of CLIP inference modes vs fp32")
+    parser.add_argument("--images", required=True, help="directory of sample images")
+    parser.add_argument("--modes", nargs="+", default=["int8", "channels_last", "int8,channels_last"])
+    parser.add_argument("--texts", help="optional file of feature descriptions, one per line")
+    parser.add_argument("--namespace", default="images")
+    parser.add_argument("--top-k", type=int, default=25)
+    parser.add_argument("--limit", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--output", help="write the report as JSON")
+    args = parser.parse_args()
+
+    load_dotenv()
+    from pineconedb import get_vector_store
+    store = get_vector_store()
+
+    images = _load_images(args.images, args.limit)
+    if not images:
+        raise SystemExit(f"No images found in {args.images}")
+    texts = Path(args.texts).read_text().splitlines() if args.texts else []
+
+    reference = ClipRuntime("fp32")
+    ref_vectors, ref_rate = _encode(reference, images, args.batch_size)
+    ref_ids = _top_ids(store, ref_vectors, args.top_k, args.namespace)
+    ref_text = reference.encode_text(clip.tokenize(texts)).numpy() if texts else None
+    del reference
+
+    report = {"samples": len(images), "top_k": args.top_k, "modes": {"fp32": {"images_per_sec": round(ref_rate, 2)}}}
+    for mode in args.modes:
+        runtime = ClipRuntime(mode)
+        vectors, rate = _encode(runtime, images, args.batch_size)
+        ids = _top_ids(store, vectors, args.top_k, args.namespace)
+
+        overlaps = [len(set(a) & set(b)) / max(len(a), 1) for a, b in zip(ref_ids, ids)]
+        cosines = (_normalize(ref_vectors) * _normalize(vectors)).sum(axis=1)
+        result = {
+            "images_per_sec": round(rate, 2),
+            "speedup": round(rate / ref_rate, 2),
+            "mean_topk_overlap": round(float(np.mean(overlaps)), 4),
+            "min_topk_overlap": round(float(np.min(overlaps)), 4),
+            "mean_cosine_to_fp32": round(float(cosines.mean()), 5),
+        }
+        if ref_text is not None:
+            text_vectors = runtime.encode_text(clip.tokenize(texts)).numpy()
+            result["mean_text_cosine_to_fp32"] = round(float((_normalize(ref_text) * _normalize(text_vectors)).sum(axis=1).mean()), 5)
+        report["modes"][mode] = result
+        print(f"{mode:>20}: {result}")
+        del runtime
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import logging
+import os
+
+import clip
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated flags: "fp32" (baseline), "int8" (dynamic quantization of
+# the Linear layers) and "channels_last" (channels-last conv input)
+CLIP_INFERENCE_MODE = os.getenv("CLIP_INFERENCE_MODE", "fp32")
+# 0 leaves torch's defaults alone
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", "0"))
+TORCH_INTEROP_THREADS = int(os.getenv("TORCH_INTEROP_THREADS", "0"))
+
+MODES = {"fp32", "int8", "channels_last"}
+
+_threads_configured = False
+
+
+def parse_mode(mode: str) -> set:
+    flags = {flag.strip() for flag in mode.split(",") if flag.strip()} or {"fp32"}
+    unknown = flags - MODES
+    if unknown:
+        raise ValueError(f"Unknown CLIP_INFERENCE_MODE flag(s): {', '.join(sorted(unknown))}")
+    return flags
+
+
+def configure_threads():
+    """Apply TORCH_NUM_THREADS / TORCH_INTEROP_THREADS once, before any inference"""
+    global _threads_configured
+    if _threads_configured:
+        return
+    _threads_configured = True
+    if TORCH_NUM_THREADS > 0:
+        torch.set_num_threads(TORCH_NUM_THREADS)
+    if TORCH_INTEROP_THREADS > 0:
+        try:
+            torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
+        except RuntimeError as e:
+            # Only allowed before the first parallel op in the process
+            logger.warning(f"Could not set inter-op threads: {e}")
+
+
+class ClipRuntime:
+    """
+    CLIP model prepared for a given inference mode. encode_image/encode_text
+    run under torch.inference_mode and handle the input memory format.
+    """
+
+    def __init__(self, mode: str = CLIP_INFERENCE_MODE, device: str = "cpu"):
+        configure_threads()
+        self.flags = parse_mode(mode)
+        self.device = device
+        model, self.preprocess = clip.load("ViT-B/32", device=device)
+        model.eval()
+
+        if "int8" in self.flags:
+            if device != "cpu":
+                logger.warning("int8 dynamic quantization is CPU-only, keeping full precision")
+                self.flags.discard("int8")
+            else:
+                model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        self.channels_last = "channels_last" in self.flags
+        if self.channels_last:
+            model.visual.conv1.to(memory_format=torch.channels_last)
+
+        self.model = model
+        logger.info(f"CLIP loaded on {device} with mode {','.join(sorted(self.flags))}")
+
+    def encode_image(self, batch: torch.Tensor) -> torch.Tensor:
+        batch = batch.to(self.device)
+        if self.channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        with torch.inference_mode():
+            return self.model.encode_image(batch).float()
+
+    def encode_text(self, tokens: torch.Tensor) -> torch.Tensor:
+        with torch.inference_mode():
+            return self.model.encode_text(tokens.to(self.device)).float()
@@ -0,0 +1,88 @@
+import os
+from typing import List
+
+import numpy as np
+
+# Matches closer than this to a cluster's leading match join that cluster
+CLUSTER_RADIUS_KM = float(os.getenv("CLUSTER_RADIUS_KM", "25"))
+# Rough prompt budget for the cluster summary lines (~4 characters per token)
+CLUSTER_TOKEN_BUDGET = int(os.getenv("CLUSTER_TOKEN_BUDGET", "150"))
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def _unit_vectors(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    phi, lam = np.radians(lats), np.radians(lons)
+    return np.stack([np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)], axis=-1)
+
+
+def _pairwise_km(points: np.ndarray) -> np.ndarray:
+    """Great-circle distances between unit vectors, (N, N) in km"""
+    cosines = np.clip(points @ points.T, -1.0, 1.0)
+    return EARTH_RADIUS_KM * np.arccos(cosines)
+
+
+def cluster_matches(matches: List[dict], radius_km: float = CLUSTER_RADIUS_KM) -> List[dict]:
+    """
+    Group visual matches that lie within radius_km of each other. Clusters
+    are seeded greedily from the best remaining score and ranked by their
+    summed score, so many consistent hits outrank a single strong outlier.
+    """
+    if not matches:
+        return []
+
+    lats = np.array([float(m['metadata']['latitude']) for m in matches])
+    lons = np.array([float(m['metadata']['longitude']) for m in matches])
+    scores = np.array([float(m['score']) for m in matches])
+    points = _unit_vectors(lats, lons)
+    distances = _pairwise_km(points)
+
+    unassigned = np.ones(len(matches), dtype=bool)
+    clusters = []
+    for leader in np.argsort(-scores):
+        if not unassigned[leader]:
+            continue
+        members = unassigned & (distances[leader] <= radius_km)
+        unassigned &= ~members
+
+        # Score-weighted centroid on the sphere (safe across the antimeridian)
+        member_scores = scores[members]
+        mean_point = (points[members] * member_scores[:, None]).sum(axis=0)
+        mean_point /= np.linalg.norm(mean_point) or 1
+        centroid_lat = float(np.degrees(np.arcsin(mean_point[2])))
+        centroid_lon = float(np.degrees(np.arctan2(mean_point[1], mean_point[0])))
+        spread = EARTH_RADIUS_KM * np.arccos(np.clip(points[members] @ mean_point, -1.0, 1.0))
+
+        clusters.append({
+            "latitude": round(centroid_lat, 5),
+            "longitude": round(centroid_lon, 5),
+            "count": int(members.sum()),
+            "spread_km": round(float(spread.max()), 2),
+            "max_score": round(float(member_scores.max()), 4),
+            "mean_score": round(float(member_scores.mean()), 4),
+            "total_score": float(member_scores.sum()),
+        })
+
+    clusters.sort(key=lambda c: c["total_score"], reverse=True)
+    return clusters
+
+
+def format_clusters(clusters: List[dict], token_budget: int = CLUSTER_TOKEN_BUDGET) -> str:
+    """
+    Prompt lines for the best clusters, stopping before the token budget is
+    exceeded (the top cluster is always included)
+    """
+    lines = []
+    used = 0
+    for cluster in clusters:
+        line = (
+            f"(Latitude: {cluster['latitude']}, Longitude: {cluster['longitude']}) - "
+            f"{cluster['count']} match(es) within {cluster['spread_km']} km, "
+            f"best score {cluster['max_score']}, mean score {cluster['mean_score']}\n"
+        )
+        cost = len(line) // 4 + 1
+        if lines and used + cost > token_budget:
+            break
+        lines.append(line)
+        used += cost
+    return "".join(lines)
@@ -0,0 +1,155 @@
+"""
+Server-side conversation state per session, and the token-budgeted history
+that goes into each chat prompt.
+
+The last CONTEXT_RECENT_TURNS turns are kept verbatim (each capped at
+CONTEXT_TURN_TOKENS). Older turns are condensed into a rolling summary
+capped at CONTEXT_SUMMARY_TOKENS, and the latest coordinate guesses are kept
+as one line each, so the history sent with a turn stays the same size
+however long the chat runs. The retrieval results for the session image are
+kept here as well, so follow-up turns skip the vector queries.
+"""
+import json
+import os
+import re
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+CONTEXT_RECENT_TURNS = int(os.getenv("CONTEXT_RECENT_TURNS", "4"))
+CONTEXT_TURN_TOKENS = int(os.getenv("CONTEXT_TURN_TOKENS", "300"))
+CONTEXT_SUMMARY_TOKENS = int(os.getenv("CONTEXT_SUMMARY_TOKENS", "400"))
+CONTEXT_MAX_GUESSES = int(os.getenv("CONTEXT_MAX_GUESSES", "10"))
+# Conversations kept in memory, least recently used evicted first
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "1024"))
+
+# Budgeting only needs an estimate: ~4 characters per token for English text
+CHARS_PER_TOKEN = 4
+# Length of one condensed turn in the summary
+SUMMARY_LINE_TOKENS = 60
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def truncate_tokens(text: str, tokens: int) -> str:
+    """text cut at a word boundary to about tokens tokens"""
+    limit = tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + " ..."
+
+
+def condense(role: str, text: str, tokens: int = SUMMARY_LINE_TOKENS) -> str:
+    """One summary line for a turn: as many leading sentences as fit in tokens"""
+    sentences = _SENTENCE_END.split(" ".join(text.split()))
+    line = sentences[0]
+    for sentence in sentences[1:]:
+        if estimate_tokens(f"{line} {sentence}") > tokens:
+            break
+        line = f"{line} {sentence}"
+    return f"{role.upper()}: {truncate_tokens(line, tokens)}"
+
+
+class Conversation:
+    def __init__(self):
+        self.turns: Deque[Tuple[str, str]] = deque()
+        # Condensed older turns, oldest first
+        self.summary: List[str] = []
+        self.guesses: List[dict] = []
+        self._retrieval: Optional[Tuple[str, Dict[str, List[dict]]]] = None
+
+    @property
+    def empty(self) -> bool:
+        return not self.turns and not self.summary and not self.guesses
+
+    def add_turn(self, role: str, text: str):
+        text = text.strip()
+        if not text:
+            return
+        self.turns.append((role, text))
+        while len(self.turns) > CONTEXT_RECENT_TURNS:
+            self.summary.append(condense(*self.turns.popleft()))
+        # Rolling: the oldest summary lines go once over budget
+        while len(self.summary) > 1 and estimate_tokens("\n".join(self.summary)) > CONTEXT_SUMMARY_TOKENS:
+            self.summary.pop(0)
+
+    def add_guesses(self, coordinates: str):
+        """Record the locations of a coordinates JSON response (ignored if it does not parse)"""
+        try:
+            locations = json.loads(coordinates)
+        except (TypeError, ValueError):
+            return
+        for location in locations if isinstance(locations, list) else []:
+            try:
+                self.guesses.append({
+                    "name": str(location.get("name") or "Unnamed"),
+                    "latitude": round(float(location["latitude"]), 4),
+                    "longitude": round(float(location["longitude"]), 4),
+                })
+            except (AttributeError, KeyError, TypeError, ValueError):
+                continue
+        del self.guesses[:-CONTEXT_MAX_GUESSES]
+
+    def seed(self, history: List[dict]):
+        """Start from client-sent history (server restarted or the session moved workers)"""
+        for message in history:
+            self.add_turn(message.get("role", "user"), message.get("text", ""))
+
+    def context(self) -> str:
+        """The conversation history section of the chat prompt"""
+        sections = []
+        if self.summary:
+            sections.append("Summary of earlier conversation:\n" + "\n".join(self.summary))
+        if self.guesses:
+            sections.append("Coordinate guesses so far (oldest first):\n" + "\n".join(
+                f"- {guess['name']} ({guess['latitude']}, {guess['longitude']})" for guess in self.guesses
+            ))
+        if self.turns:
+            sections.append("Recent turns:\n" + "\n".join(
+                f"{role.upper()}: {truncate_tokens(text, CONTEXT_TURN_TOKENS)}" for role, text in self.turns
+            ))
+        return "\n\nPrevious Conversation:\n" + "\n\n".join(sections) + "\n"
+
+    def retrieval(self, digest: str) -> Optional[Dict[str, List[dict]]]:
+        """Cached query results for the image with this content hash"""
+        if self._retrieval is not None and self._retrieval[0] == digest:
+            return self._retrieval[1]
+        return None
+
+    def set_retrieval(self, digest: str, results: Dict[str, List[dict]]):
+        self._retrieval = (digest, results)
+
+
+class ConversationStore:
+    def __init__(self, max_sessions: int = CONVERSATION_CACHE_SIZE):
+        self.max_sessions = max_sessions
+        self._conversations: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Conversation:
+        """The session's conversation, started empty if there is none"""
+        with self._lock:
+            conversation = self._conversations.get(session_id)
+            if conversation is None:
+                conversation = self._conversations[session_id] = Conversation()
+                while len(self._conversations) > self.max_sessions:
+                    self._conversations.popitem(last=False)
+            else:
+                self._conversations.move_to_end(session_id)
+            return conversation
+
+    def forget(self, session_id: str):
+        """Drop a session's conversation (e.g. a new image was uploaded)"""
+        with self._lock:
+            self._conversations.pop(session_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"sessions": len(self._conversations)}
+
+
+conversations = ConversationStore()
@@ -0,0 +1,151 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import numpy as np
+
+from executor import run_cpu, run_io
+
+logger = logging.getLogger(__name__)
+
+# Max number of embeddings kept in memory (each ViT-B/32 vector is 512 floats)
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "256"))
+# Optional directory where evicted embeddings are spilled and reloaded from
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR")
+# Spilled embeddings kept on disk, least recently used deleted first
+EMBEDDING_CACHE_DIR_MAX_FILES = int(os.getenv("EMBEDDING_CACHE_DIR_MAX_FILES", "10000"))
+
+
+def content_hash(data: bytes) -> str:
+    """SHA-256 hex digest of raw image bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    LRU cache of CLIP image embeddings keyed by (session_id, content hash).
+    Entries evicted from memory are written to spill_dir (if set) so a later
+    turn can reload them without running the model again. The spill
+    directory is an LRU as well, capped at max_spilled files. Spill reads
+    and writes run on the I/O pool.
+    """
+
+    def __init__(self, max_entries: int = EMBEDDING_CACHE_SIZE, spill_dir: Optional[str] = EMBEDDING_CACHE_DIR,
+                 max_spilled: int = EMBEDDING_CACHE_DIR_MAX_FILES):
+        self.max_entries = max_entries
+        self.max_spilled = max_spilled
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        self._entries: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
+        # Digests with a spill file, least recently used first
+        self._spilled: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.spill_dir:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            for path in sorted(self.spill_dir.glob("*.npy"), key=lambda p: p.stat().st_mtime):
+                self._spilled[path.stem] = None
+            self._prune()
+
+    def _spill_path(self, digest: str) -> Path:
+        # Keyed on the content hash only: the same image shared by two
+        # sessions is spilled once
+        return self.spill_dir / f"{digest}.npy"
+
+    def _get(self, key: Tuple[str, str]) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return vector
+
+    def _put(self, key: Tuple[str, str], vector: np.ndarray) -> List[Tuple[Tuple[str, str], np.ndarray]]:
+        """Insert into memory, returning the evicted entries"""
+        evicted = []
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False))
+        return evicted
+
+    def _load(self, digest: str) -> Optional[np.ndarray]:
+        """A spilled embedding (blocking: run on the I/O pool)"""
+        with self._lock:
+            if digest not in self._spilled:
+                return None
+            self._spilled.move_to_end(digest)
+        path = self._spill_path(digest)
+        try:
+            return np.load(path)
+        except Exception as e:
+            logger.warning(f"Could not load spilled embedding {path}: {e}")
+            return None
+
+    def _spill(self, evicted: List[Tuple[Tuple[str, str], np.ndarray]]):
+        """Write evicted embeddings and prune the oldest files (blocking: run on the I/O pool)"""
+        for (_, digest), vector in evicted:
+            with self._lock:
+                if digest in self._spilled:
+                    self._spilled.move_to_end(digest)
+                    continue
+            np.save(self._spill_path(digest), vector)
+            with self._lock:
+                self._spilled[digest] = None
+        self._prune()
+
+    def _prune(self):
+        while True:
+            with self._lock:
+                if len(self._spilled) <= self.max_spilled:
+                    return
+                digest, _ = self._spilled.popitem(last=False)
+            try:
+                self._spill_path(digest).unlink()
+            except FileNotFoundError:
+                pass
+
+    async def aget_or_compute(self, session_id: str, data: Optional[bytes], compute: Callable[[], Awaitable[List[float]]], digest: Optional[str] = None) -> List[float]:
+        """
+        Return the cached embedding for these image bytes, awaiting compute()
+        only on a miss. Hashing runs on the CPU pool (unless the digest is
+        already known)
+        """
+        if digest is None:
+            digest = await run_cpu(content_hash, data)
+        key = (session_id, digest)
+        vector = self._get(key)
+        if vector is not None:
+            return vector.tolist()
+
+        vector = await run_io(self._load, digest) if self.spill_dir else None
+        if vector is not None:
+            with self._lock:
+                self.hits += 1
+        else:
+            with self._lock:
+                self.misses += 1
+            vector = await compute()
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        evicted = self._put(key, vector)
+        if self.spill_dir and evicted:
+            await run_io(self._spill, evicted)
+        return vector.tolist()
+
+    def invalidate(self, session_id: str) -> None:
+        """Drop every in-memory entry for a session (e.g. after a new upload)"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == session_id]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,31 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# CPU-bound stages (CLIP preprocessing/encoding, image decode/encode). Torch
+# releases the GIL inside its kernels and already fans out over intra-op
+# threads, so a small pool of threads sharing the one loaded model is enough.
+CPU_WORKERS = int(os.getenv("EXECUTOR_CPU_WORKERS", "2"))
+# Blocking network/disk I/O (Pinecone queries, file reads, Mapillary)
+IO_WORKERS = int(os.getenv("EXECUTOR_IO_WORKERS", "32"))
+
+cpu_pool = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+
+async def run_cpu(func, *args, **kwargs):
+    """Run a CPU-bound callable on the bounded CPU pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(cpu_pool, functools.partial(func, *args, **kwargs))
+
+
+async def run_io(func, *args, **kwargs):
+    """Run a blocking I/O callable on the bounded I/O pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_pool, functools.partial(func, *args, **kwargs))
+
+
+def shutdown():
+    cpu_pool.shutdown(wait=False, cancel_futures=True)
+    io_pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,188 @@
+"""
+Local stand-ins for the external services, with configurable latency and
+token rates. install() swaps them into pineconedb, reasoning and mapillary
+so the whole backend runs offline (benchmarks, local development).
+"""
+import asyncio
+import json
+import os
+import random
+import time
+from typing import List
+
+import httpx
+
+WORDS = (
+    "the architecture signage vegetation road markings suggest a temperate european city "
+    "with narrow streets stone facades and tram lines near the river district"
+).split()
+
+
+class FakeChunk:
+    def __init__(self, content: str):
+        self.content = content
+
+
+class FakeIndex:
+    """Stand-in for pinecone.Index: random geotagged matches after a fixed delay"""
+
+    def __init__(self, latency_ms: float = 40, seed: int = 0):
+        self.latency = latency_ms / 1000
+        self.random = random.Random(seed)
+
+    def query(self, vector=None, top_k=5, include_metadata=True, namespace=None, **kwargs):
+        time.sleep(self.latency)
+        matches = []
+        center_lat, center_lon = 48.8566, 2.3522
+        for i in range(top_k):
+            if namespace == "features":
+                metadata = {"text": f"feature description {i}"}
+            else:
+                metadata = {
+                    "latitude": center_lat + self.random.uniform(-0.5, 0.5),
+                    "longitude": center_lon + self.random.uniform(-0.5, 0.5),
+                }
+            matches.append({"id": f"{namespace}-{i}", "score": 0.95 - i * 0.01, "metadata": metadata})
+        return {"matches": matches}
+
+    def describe_index_stats(self):
+        return {}
+
+
+class FakeChatModel:
+    """
+    Stand-in for ChatGoogleGenerativeAI. Streams words at tokens_per_sec after
+    first_token_ms; invoke() returns a coordinates JSON array. A stall_rate
+    fraction of calls waits an extra stall_ms before answering, like a
+    provider with a slow tail.
+    """
+
+    def __init__(self, first_token_ms: float = 400, tokens_per_sec: float = 80, output_tokens: int = 250, chunk_tokens: int = 8, invoke_ms: float = 900,
+                 stall_rate: float = 0.0, stall_ms: float = 0):
+        self.stall_rate = stall_rate
+        self.stall = stall_ms / 1000
+        self.first_token = first_token_ms / 1000
+        self.tokens_per_sec = tokens_per_sec
+        self.output_tokens = output_tokens
+        self.chunk_tokens = chunk_tokens
+        self.invoke_latency = invoke_ms / 1000
+
+    @staticmethod
+    def _prompt_text(messages) -> str:
+        if isinstance(messages, str):
+            return messages
+        parts = []
+        for message in messages:
+            content = getattr(message, "content", message)
+            if isinstance(content, list):
+                parts.extend(part.get("text", "") for part in content if isinstance(part, dict))
+            else:
+                parts.append(str(content))
+        return "\n".join(parts)
+
+    @staticmethod
+    def _locations() -> List[dict]:
+        return [
+            {"latitude": 48.8566 + i * 0.1, "longitude": 2.3522 - i * 0.1, "name": f"Candidate {i + 1}", "accuracy": 60 - i * 15, "facts": ["fact one", "fact two", "fact three"]}
+            for i in range(3)
+        ]
+
+    def _chunks(self, prompt: str) -> List[str]:
+        words = [random.choice(WORDS) for _ in range(self.output_tokens)]
+        chunks = [" ".join(words[i:i + self.chunk_tokens]) + " " for i in range(0, len(words), self.chunk_tokens)]
+        if "<<<COORDINATES>>>" in prompt:
+            # Single-pass prompt: end with the coordinates block, one object per chunk
+            objects = [json.dumps(location) for location in self._locations()]
+            chunks.append("\n<<<COORDINATES>>>\n[")
+            chunks.extend(obj + "," for obj in objects[:-1])
+            chunks.append(objects[-1] + "]")
+        return chunks
+
+    def _first_delay(self, base: float) -> float:
+        return base + (self.stall if random.random() < self.stall_rate else 0)
+
+    def _chunk_delay(self) -> float:
+        return self.chunk_tokens / self.tokens_per_sec
+
+    def stream(self, messages, **kwargs):
+        time.sleep(self._first_delay(self.first_token))
+        for i, chunk in enumerate(self._chunks(self._prompt_text(messages))):
+            if i:
+                time.sleep(self._chunk_delay())
+            yield FakeChunk(chunk)
+
+    async def astream(self, messages, **kwargs):
+        await asyncio.sleep(self._first_delay(self.first_token))
+        for i, chunk in enumerate(self._chunks(self._prompt_text(messages))):
+            if i:
+                await asyncio.sleep(self._chunk_delay())
+            yield FakeChunk(chunk)
+
+    def invoke(self, messages, **kwargs):
+        time.sleep(self._first_delay(self.invoke_latency))
+        return FakeChunk(json.dumps(self._locations()))
+
+    async def ainvoke(self, messages, **kwargs):
+        await asyncio.sleep(self._first_delay(self.invoke_latency))
+        return FakeChunk(json.dumps(self._locations()))
+
+
+class FakeClip:
+    """Stand-in for clip_runtime.ClipRuntime: random unit vectors after a per-batch delay"""
+
+    def __init__(self, latency_ms: float = 30, dim: int = 512):
+        self.latency = latency_ms / 1000
+        self.dim = dim
+
+    def preprocess(self, image):
+        import torch
+        return torch.zeros(3, 224, 224)
+
+    def _vectors(self, n: int):
+        import torch
+        time.sleep(self.latency)
+        vectors = torch.randn(n, self.dim)
+        return vectors / vectors.norm(dim=-1, keepdim=True)
+
+    def encode_image(self, batch):
+        return self._vectors(len(batch))
+
+    def encode_text(self, tokens):
+        return self._vectors(len(tokens))
+
+
+def fake_mapillary_transport(latency_ms: float = 150) -> httpx.MockTransport:
+    """Mock transport answering Mapillary image searches with nearby thumbnails"""
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency_ms / 1000)
+        min_lon, min_lat, max_lon, max_lat = map(float, request.url.params["bbox"].split(","))
+        data = [
+            {
+                "id": str(i),
+                "thumb_1024_url": f"https://example.invalid/thumb/{i}.jpg",
+                "geometry": {"coordinates": [random.uniform(min_lon, max_lon), random.uniform(min_lat, max_lat)]},
+            }
+            for i in range(int(request.url.params.get("limit", 50)))
+        ]
+        return httpx.Response(200, json={"data": data})
+
+    return httpx.MockTransport(handler)
+
+
+def install(index: FakeIndex = None, chat_model: FakeChatModel = None, mapillary_latency_ms: float = 150, clip_model: FakeClip = None):
+    """
+    Swap the fakes into the backend modules (call before the app starts).
+    CLIP stays real unless clip_model is given
+    """
+    import mapillary
+    import pineconedb
+    import reasoning
+    from vectorstore import PineconeStore
+
+    pineconedb._vector_store = PineconeStore(index or FakeIndex())
+    if clip_model is not None:
+        pineconedb._clip = clip_model
+    reasoning._model = chat_model or FakeChatModel()
+    os.environ.setdefault("MAPILLARY_API_KEY", "fake")
+    mapillary._client = httpx.AsyncClient(transport=fake_mapillary_transport(mapillary_latency_ms))
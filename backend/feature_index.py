@@ -0,0 +1,169 @@
+"""
+The features namespace held in memory. Every feature description is
+embedded once with CLIP's text tower into a normalized matrix, so matching
+an image against all of them is one matrix-vector product instead of a
+remote query.
+
+The matrix lives in FEATURE_INDEX_DIR in the local index layout
+(vectors.npy, ids.json, metadata.jsonl) and is reloaded when a rebuild
+replaces it on disk.
+
+    python feature_index.py --from-pinecone
+    python feature_index.py --from-file features.jsonl
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from vectorstore import NamespaceWriter, _normalize, _top_k
+
+logger = logging.getLogger(__name__)
+
+FEATURE_INDEX_DIR = os.getenv("FEATURE_INDEX_DIR", "index/features_text")
+# How often the files are checked for a rebuild
+FEATURE_INDEX_RELOAD_SECONDS = float(os.getenv("FEATURE_INDEX_RELOAD_SECONDS", "5"))
+
+
+class _Matrix:
+    def __init__(self, vectors: np.ndarray, ids: List[str], metadata: List[dict], stamp: int):
+        self.vectors = vectors
+        self.ids = ids
+        self.metadata = metadata
+        self.stamp = stamp
+
+
+class FeatureIndex:
+    """
+    Normalized feature-text embeddings loaded fully into memory. query() has
+    the same top_k / threshold semantics as VectorStore.query
+    """
+
+    def __init__(self, path: str = FEATURE_INDEX_DIR, reload_seconds: float = FEATURE_INDEX_RELOAD_SECONDS):
+        self.path = Path(path)
+        self.reload_seconds = reload_seconds
+        self._matrix: Optional[_Matrix] = None
+        self._checked: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _stamp(self) -> Optional[int]:
+        # ids.json is the last file a rebuild writes
+        try:
+            return (self.path / "ids.json").stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load(self, stamp: int) -> _Matrix:
+        vectors = _normalize(np.load(self.path / "vectors.npy").astype(np.float32))
+        ids = json.loads((self.path / "ids.json").read_text())
+        with open(self.path / "metadata.jsonl") as f:
+            metadata = [json.loads(line) for line in f]
+        if not len(vectors) == len(ids) == len(metadata):
+            raise ValueError(f"{self.path} is inconsistent ({len(vectors)} vectors, {len(ids)} ids, {len(metadata)} metadata rows)")
+        return _Matrix(vectors, ids, metadata, stamp)
+
+    def maybe_reload(self):
+        """Pick up a rebuilt matrix, checking the files at most every reload_seconds"""
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < self.reload_seconds:
+            return
+        with self._lock:
+            if self._checked is not None and now - self._checked < self.reload_seconds:
+                return
+            self._checked = now
+            stamp = self._stamp()
+            if stamp is None or (self._matrix is not None and self._matrix.stamp == stamp):
+                return
+            try:
+                self._matrix = self._load(stamp)
+            except Exception as e:
+                # Mid-rebuild or corrupt: keep serving the previous matrix
+                logger.warning(f"Could not load feature index from {self.path}: {e}")
+                return
+            logger.info(f"Loaded {len(self._matrix.ids)} feature embeddings from {self.path}")
+
+    @property
+    def available(self) -> bool:
+        self.maybe_reload()
+        return self._matrix is not None
+
+    def query(self, vector, top_k=5, threshold=0) -> List[dict]:
+        matrix = self._matrix
+        if matrix is None or len(matrix.ids) == 0:
+            return []
+        query = _normalize(np.asarray(vector, dtype=np.float32).reshape(-1))
+        scores = matrix.vectors @ query
+        matches = []
+        for row in _top_k(scores, top_k).tolist():
+            score = float(scores[row])
+            if threshold > 0 and score < threshold:
+                continue
+            matches.append({"id": matrix.ids[row], "score": score, "metadata": matrix.metadata[row]})
+        return matches
+
+
+def build_feature_index(records: Iterable[dict], encode: Callable[[List[str]], List[List[float]]], path: str = FEATURE_INDEX_DIR, batch_size: int = 256) -> int:
+    """
+    Embed the text of every record (metadata dicts with a "text" key, each
+    distinct text once) and write the matrix to path
+    """
+    with NamespaceWriter(Path(path)) as writer:
+        seen = set()
+        batch: List[dict] = []
+
+        def flush():
+            texts = [record["text"] for record in batch]
+            writer.append([record.get("id") or f"feature-{len(writer.ids) + i}" for i, record in enumerate(batch)], encode(texts), batch)
+            batch.clear()
+
+        for record in records:
+            text = (record.get("text") or "").strip()
+            if not text or text in seen:
+                continue
+            seen.add(text)
+            batch.append({**record, "text": text})
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+    return len(writer.ids)
+
+
+def pinecone_features(index, namespace: str = "features", batch_size: int = 200) -> Iterator[dict]:
+    """Metadata of every vector in a Pinecone namespace, with its id"""
+    for page in index.list(namespace=namespace):
+        for start in range(0, len(page), batch_size):
+            fetched = index.fetch(ids=page[start:start + batch_size], namespace=namespace).vectors
+            for vector_id, record in fetched.items():
+                yield {**dict(record.metadata or {}), "id": vector_id}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the in-memory feature matching matrix")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--from-pinecone", action="store_true", help="Texts from the features namespace of the hosted index")
+    source.add_argument("--from-file", type=Path, help="CSV or JSONL file with a text column")
+    parser.add_argument("--index-name", default="htv2025")
+    parser.add_argument("--output", default=FEATURE_INDEX_DIR)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from pineconedb import encode_texts
+
+    if args.from_file:
+        from build_index import read_manifest
+        records = read_manifest(args.from_file)
+    else:
+        from dotenv import load_dotenv
+        from pinecone import Pinecone
+        load_dotenv()
+        records = pinecone_features(Pinecone(api_key=os.getenv("PINECONE_API_KEY")).Index(args.index_name))
+
+    count = build_feature_index(records, encode_texts, args.output)
+    print(f"Wrote {count} feature embeddings to {args.output}")
@@ -0,0 +1,244 @@
+import base64
+import io
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+import torch
+from PIL import Image, ImageOps
+
+from blobstore import BlobStore
+from embedding_cache import content_hash
+from pineconedb import preprocess
+from result_cache import dhash
+
+logger = logging.getLogger(__name__)
+
+# Longest side of the derivative sent to Gemini and stored on disk
+LLM_IMAGE_MAX_SIDE = int(os.getenv("LLM_IMAGE_MAX_SIDE", "1024"))
+# "JPEG" or "WEBP"
+LLM_IMAGE_FORMAT = os.getenv("LLM_IMAGE_FORMAT", "JPEG").upper()
+LLM_IMAGE_QUALITY = int(os.getenv("LLM_IMAGE_QUALITY", "85"))
+# Sessions whose artifacts are kept decoded in memory
+ARTIFACT_CACHE_SIZE = int(os.getenv("ARTIFACT_CACHE_SIZE", "64"))
+
+_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp"}
+
+
+class ImageArtifacts:
+    """
+    Everything the pipeline needs from an uploaded image, computed once at
+    upload time: the normalized derivative, its base64 data URL for the LLM
+    and the CLIP-preprocessed tensor.
+    """
+
+    def __init__(self, image: Image.Image, data: bytes, data_url: str, clip_input: torch.Tensor, original_size=None, original_format=None):
+        self.image = image
+        self.data = data
+        self.data_url = data_url
+        self.clip_input = clip_input
+        self.digest = content_hash(data)
+        self.phash = dhash(image)
+        self.original_size = original_size or image.size
+        self.original_format = original_format
+
+
+def build_artifacts(source) -> ImageArtifacts:
+    """
+    Decode an upload once (bytes or a file object), apply EXIF orientation,
+    downsample and encode the compact derivative
+    """
+    original = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    original_format = original.format
+    original_size = original.size
+    # JPEGs can be decoded straight at a reduced scale, far cheaper than
+    # decoding every pixel of a large photo only to shrink it
+    original.draft("RGB", (LLM_IMAGE_MAX_SIDE, LLM_IMAGE_MAX_SIDE))
+
+    image = ImageOps.exif_transpose(original).convert("RGB")
+    image.thumbnail((LLM_IMAGE_MAX_SIDE, LLM_IMAGE_MAX_SIDE), Image.LANCZOS)
+
+    buffered = io.BytesIO()
+    image.save(buffered, format=LLM_IMAGE_FORMAT, quality=LLM_IMAGE_QUALITY)
+    data = buffered.getvalue()
+    data_url = f"data:image/{LLM_IMAGE_FORMAT.lower()};base64,{base64.b64encode(data).decode()}"
+
+    return ImageArtifacts(image, data, data_url, preprocess(image), original_size, original_format)
+
+
+def _keys(name: str):
+    return {
+        "image": f"{name}{_EXTENSIONS.get(LLM_IMAGE_FORMAT, '.jpg')}",
+        "data_url": f"{name}.b64",
+        "clip_input": f"{name}.clip.npy",
+        "metadata": f"{name}.json",
+    }
+
+
+def _legacy_image_key(session_id: str) -> str:
+    """Where uploads were stored before content addressing"""
+    return f"{session_id}.jpg"
+
+
+def _content_keys(key: str):
+    return _keys(f"content/{key}")
+
+
+def _session_ref(session_id: str) -> str:
+    return f"sessions/{session_id}.ref"
+
+
+def _tensor_bytes(tensor: torch.Tensor) -> bytes:
+    # Raw .npy rather than torch.save: blobs may come from a shared bucket,
+    # and loading must never unpickle
+    buffered = io.BytesIO()
+    np.save(buffered, tensor.numpy(), allow_pickle=False)
+    return buffered.getvalue()
+
+
+def _tensor_from_bytes(data: bytes) -> torch.Tensor:
+    return torch.from_numpy(np.load(io.BytesIO(data), allow_pickle=False))
+
+
+def _metadata(artifacts: ImageArtifacts) -> dict:
+    width, height = artifacts.original_size
+    return {"width": width, "height": height, "format": artifacts.original_format}
+
+
+class ArtifactStore:
+    """
+    Content-addressed artifact storage. Artifacts are stored once per upload
+    hash under content/, and each session holds a small reference to the
+    content it uploaded. The most recently used artifacts and session
+    references are kept in memory so chat turns skip decoding entirely.
+
+    Sessions uploaded before content addressing (a plain {session_id}.jpg)
+    are migrated the first time they are loaded.
+    """
+
+    def __init__(self, blobs: BlobStore, max_entries: int = ARTIFACT_CACHE_SIZE):
+        self.blobs = blobs
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, ImageArtifacts]" = OrderedDict()
+        # References are tiny, keep many more of them than decoded images
+        self._sessions: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key: str, artifacts: ImageArtifacts):
+        with self._lock:
+            self._entries[key] = artifacts
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _remember_session(self, session_id: str, key: str):
+        with self._lock:
+            self._sessions[session_id] = key
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_entries * 16:
+                self._sessions.popitem(last=False)
+
+    def forget(self, session_id: str):
+        """Drop the cached reference, e.g. after another worker replaced the upload"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def save(self, key: str, artifacts: ImageArtifacts) -> str:
+        """Store artifacts under a content key (the upload's hash)"""
+        keys = _content_keys(key)
+        # The image goes last: once it exists the content is complete
+        self.blobs.put(keys["data_url"], artifacts.data_url.encode())
+        self.blobs.put(keys["clip_input"], _tensor_bytes(artifacts.clip_input))
+        self.blobs.put(keys["metadata"], json.dumps(_metadata(artifacts)).encode())
+        self.blobs.put(keys["image"], artifacts.data)
+        self._remember(key, artifacts)
+        return self.location(key)
+
+    def describe(self, key: str) -> Optional[dict]:
+        """Original size and format of stored content, None if not stored yet"""
+        with self._lock:
+            artifacts = self._entries.get(key)
+        if artifacts is not None:
+            return _metadata(artifacts)
+        keys = _content_keys(key)
+        if not self.blobs.exists(keys["image"]):
+            return None
+        metadata = self.blobs.get(keys["metadata"])
+        return json.loads(metadata) if metadata is not None else {}
+
+    def link(self, session_id: str, key: str):
+        """Point a session at stored content"""
+        self.blobs.put(_session_ref(session_id), key.encode())
+        self._remember_session(session_id, key)
+
+    def resolve(self, session_id: str) -> Optional[str]:
+        """Content key of a session's upload, None if it has none"""
+        with self._lock:
+            key = self._sessions.get(session_id)
+            if key is not None:
+                self._sessions.move_to_end(session_id)
+                return key
+        ref = self.blobs.get(_session_ref(session_id))
+        if ref is None:
+            return None
+        key = ref.decode()
+        self._remember_session(session_id, key)
+        return key
+
+    def exists(self, session_id: str) -> bool:
+        if self.resolve(session_id) is not None:
+            return True
+        return self.blobs.exists(_legacy_image_key(session_id))
+
+    def image_key(self, key: str) -> str:
+        return _content_keys(key)["image"]
+
+    def location(self, key: str) -> str:
+        return self.blobs.location(self.image_key(key))
+
+    def session_location(self, session_id: str) -> str:
+        key = self.resolve(session_id)
+        return self.location(key) if key is not None else self.blobs.location(_legacy_image_key(session_id))
+
+    def _load_content(self, key: str) -> Optional[ImageArtifacts]:
+        with self._lock:
+            artifacts = self._entries.get(key)
+            if artifacts is not None:
+                self._entries.move_to_end(key)
+                return artifacts
+
+        keys = _content_keys(key)
+        data = self.blobs.get(keys["image"])
+        if data is None:
+            return None
+        data_url = self.blobs.get(keys["data_url"])
+        clip_input = self.blobs.get(keys["clip_input"])
+        if data_url is not None and clip_input is not None:
+            image = Image.open(io.BytesIO(data))
+            artifacts = ImageArtifacts(image, data, data_url.decode(), _tensor_from_bytes(clip_input))
+            self._remember(key, artifacts)
+        else:
+            artifacts = build_artifacts(data)
+            self.save(key, artifacts)
+        return artifacts
+
+    def load(self, session_id: str) -> Optional[ImageArtifacts]:
+        """Artifacts for a session, from memory or the blob store. None if never uploaded"""
+        key = self.resolve(session_id)
+        if key is not None:
+            return self._load_content(key)
+
+        # Uploaded before content addressing: migrate the original upload once
+        data = self.blobs.get(_legacy_image_key(session_id))
+        if data is None:
+            return None
+        logger.info(f"Migrating image artifacts for session {session_id}")
+        key = content_hash(data)
+        artifacts = build_artifacts(data)
+        self.save(key, artifacts)
+        self.link(session_id, key)
+        return artifacts
@@ -0,0 +1,341 @@
+"""
+Client layer between the prompts in reasoning.py and the chat model.
+
+Every call is admitted through a token bucket (LLM_RPM) and a concurrency
+cap (LLM_MAX_CONCURRENT), and runs under a deadline: streams must produce
+their first chunk within LLM_FIRST_CHUNK_SECONDS and finish within
+LLM_STREAM_DEADLINE_SECONDS, invokes within LLM_INVOKE_DEADLINE_SECONDS.
+
+Slow calls are hedged: once a call kind has LLM_HEDGE_MIN_SAMPLES latencies
+(time to first chunk for streams, total time for invokes), a call still
+waiting after that kind's LLM_HEDGE_PERCENTILE latency sends a second
+identical request, and whichever answers first is used. Hedges are skipped
+rather than queued when the rate limit or concurrency cap has no room.
+A failed attempt is retried LLM_RETRIES times within the deadline.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+import numpy as np
+
+from metrics import LLM_DEADLINES_EXCEEDED, LLM_HEDGES, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Requests per minute to the provider from this worker (0 = unlimited)
+LLM_RPM = float(os.getenv("LLM_RPM", "0"))
+LLM_BURST = int(os.getenv("LLM_BURST", "10"))
+LLM_MAX_CONCURRENT = int(os.getenv("LLM_MAX_CONCURRENT", "32"))
+LLM_FIRST_CHUNK_SECONDS = float(os.getenv("LLM_FIRST_CHUNK_SECONDS", "20"))
+LLM_STREAM_DEADLINE_SECONDS = float(os.getenv("LLM_STREAM_DEADLINE_SECONDS", "120"))
+LLM_INVOKE_DEADLINE_SECONDS = float(os.getenv("LLM_INVOKE_DEADLINE_SECONDS", "30"))
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "1"))
+LLM_RETRY_BACKOFF_SECONDS = 0.5
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") == "1"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+# Never hedge sooner than this, however fast the call usually is
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", "0.5"))
+# Latencies kept per call kind for the percentiles
+LLM_STATS_WINDOW = int(os.getenv("LLM_STATS_WINDOW", "200"))
+
+T = TypeVar("T")
+
+
+class LLMTimeout(Exception):
+    pass
+
+
+class LLMOverloaded(Exception):
+    """Every attempt was turned away for lack of a slot or rate-limit token"""
+
+
+class _NoCapacity(Exception):
+    """A hedge found no free slot or rate-limit token"""
+
+
+class RateLimiter:
+    """Token bucket: at most rate_per_minute acquisitions per minute, bursting up to burst"""
+
+    def __init__(self, rate_per_minute: float, burst: int = 1):
+        self.rate = rate_per_minute / 60
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def try_acquire(self) -> bool:
+        """Take a token only if one is available right now"""
+        if self.rate <= 0:
+            return True
+        if self._lock.locked():
+            return False
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+
+class LatencyStats:
+    """Recent latencies and hedging counts for one call kind"""
+
+    def __init__(self, window: int = LLM_STATS_WINDOW):
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedges_skipped = 0
+
+    def observe(self, seconds: float):
+        self.latencies.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        return float(np.percentile(self.latencies, q))
+
+    def hedge_delay(self) -> Optional[float]:
+        """How long to wait before hedging, or None while there are too few samples"""
+        if not LLM_HEDGE or len(self.latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return max(LLM_HEDGE_MIN_DELAY_SECONDS, self.percentile(LLM_HEDGE_PERCENTILE))
+
+    def snapshot(self) -> dict:
+        def ms(q):
+            value = self.percentile(q)
+            return round(value * 1000, 1) if value is not None else None
+
+        return {
+            "calls": self.calls,
+            "p50_ms": ms(50),
+            "p95_ms": ms(95),
+            "p99_ms": ms(99),
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedges_skipped": self.hedges_skipped,
+        }
+
+
+class _Opened:
+    """A provider stream that has produced its first chunk"""
+
+    def __init__(self, stream, iterator, first):
+        self.stream = stream
+        self.iterator = iterator
+        self.first = first
+
+
+_EMPTY = object()
+
+
+class LLMClient:
+    def __init__(self, get_model: Callable, rpm: float = LLM_RPM, burst: int = LLM_BURST, max_concurrent: int = LLM_MAX_CONCURRENT):
+        self.get_model = get_model
+        self.rpm = rpm
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.stats: Dict[str, LatencyStats] = {}
+        self._loop = None
+
+    def _bind(self):
+        # asyncio primitives belong to one loop; tests and CLIs may run several
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.max_concurrent)
+            self._limiter = RateLimiter(self.rpm, self.burst)
+
+    def _stats(self, call: str) -> LatencyStats:
+        if call not in self.stats:
+            self.stats[call] = LatencyStats()
+        return self.stats[call]
+
+    async def _admit(self, call: str, hedge: bool):
+        """Take a concurrency slot and a rate-limit token; hedges never wait for them"""
+        if hedge:
+            if self._slots.locked() or not self._limiter.try_acquire():
+                raise _NoCapacity()
+            await self._slots.acquire()
+            return
+        start = time.perf_counter()
+        await self._slots.acquire()
+        try:
+            await self._limiter.acquire()
+        except BaseException:
+            self._slots.release()
+            raise
+        STAGE_SECONDS.labels(f"llm_{call}_admission").observe(time.perf_counter() - start)
+
+    @staticmethod
+    async def _after(delay: float, attempt: Callable[[bool], Awaitable[T]]) -> T:
+        await asyncio.sleep(delay)
+        return await attempt(False)
+
+    async def _race(self, call: str, attempt: Callable[[bool], Awaitable[T]], deadline: float,
+                    discard: Optional[Callable[[T], Awaitable[None]]] = None) -> T:
+        """
+        Run attempt(False) and, if it is slow, a hedged attempt(True); retry
+        failures while time remains. Returns the first successful result,
+        cancelling (or discarding) the rest
+        """
+        stats = self._stats(call)
+        stats.calls += 1
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        hedge_at = stats.hedge_delay()
+        retries = LLM_RETRIES
+        tasks = {asyncio.ensure_future(attempt(False)): False}
+        error: Optional[BaseException] = None
+        try:
+            while True:
+                now = loop.time()
+                remaining = start + deadline - now
+                if remaining <= 0:
+                    stats.timeouts += 1
+                    LLM_DEADLINES_EXCEEDED.labels(call).inc()
+                    raise LLMTimeout(f"{call} did not answer within {deadline:g}s")
+                timeout = remaining
+                if hedge_at is not None:
+                    timeout = min(timeout, max(0.0, start + hedge_at - now))
+
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    hedged = tasks.pop(task)
+                    if task.exception() is None:
+                        if hedged:
+                            stats.hedge_wins += 1
+                            LLM_HEDGES.labels(call, "won").inc()
+                        stats.observe(loop.time() - start)
+                        return task.result()
+                    if isinstance(task.exception(), _NoCapacity):
+                        stats.hedges_skipped += 1
+                        LLM_HEDGES.labels(call, "skipped").inc()
+                        continue
+                    error = task.exception()
+                    logger.warning(f"LLM {call} attempt failed: {error!r}")
+
+                if not tasks:
+                    if error is None:
+                        stats.errors += 1
+                        raise LLMOverloaded(f"{call} found no free capacity")
+                    if retries <= 0:
+                        stats.errors += 1
+                        raise error
+                    retries -= 1
+                    stats.retries += 1
+                    tasks[asyncio.ensure_future(self._after(LLM_RETRY_BACKOFF_SECONDS, attempt))] = False
+                elif hedge_at is not None and loop.time() >= start + hedge_at:
+                    # One hedge per call
+                    hedge_at = None
+                    stats.hedges += 1
+                    LLM_HEDGES.labels(call, "sent").inc()
+                    tasks[asyncio.ensure_future(attempt(True))] = True
+        finally:
+            for task in tasks:
+                task.cancel()
+            for task in tasks:
+                try:
+                    result = await task
+                except BaseException:
+                    continue
+                # Finished in the same instant as the winner: still holds resources
+                if discard is not None:
+                    await discard(result)
+
+    async def invoke(self, call: str, prompt, deadline: float = LLM_INVOKE_DEADLINE_SECONDS):
+        """model.ainvoke(prompt) with admission, deadline, retries and hedging"""
+        self._bind()
+
+        async def attempt(hedge: bool):
+            await self._admit(call, hedge)
+            try:
+                return await self.get_model().ainvoke(prompt)
+            finally:
+                self._slots.release()
+
+        return await self._race(call, attempt, deadline)
+
+    async def _close(self, opened: _Opened):
+        try:
+            aclose = getattr(opened.stream, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        finally:
+            self._slots.release()
+
+    async def stream(self, call: str, messages, first_chunk_deadline: float = LLM_FIRST_CHUNK_SECONDS,
+                     deadline: float = LLM_STREAM_DEADLINE_SECONDS) -> AsyncIterator:
+        """
+        model.astream(messages) with admission and deadlines; the hedge races
+        on the first chunk and the losing stream is closed
+        """
+        self._bind()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+
+        async def attempt(hedge: bool) -> _Opened:
+            await self._admit(call, hedge)
+            stream = None
+            try:
+                stream = self.get_model().astream(messages)
+                iterator = stream.__aiter__()
+                try:
+                    first = await iterator.__anext__()
+                except StopAsyncIteration:
+                    first = _EMPTY
+                return _Opened(stream, iterator, first)
+            except BaseException:
+                aclose = getattr(stream, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+                self._slots.release()
+                raise
+
+        opened = await self._race(call, attempt, first_chunk_deadline, discard=self._close)
+        try:
+            if opened.first is _EMPTY:
+                return
+            yield opened.first
+            while True:
+                remaining = start + deadline - loop.time()
+                try:
+                    chunk = await asyncio.wait_for(opened.iterator.__anext__(), max(0.0, remaining))
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    self._stats(call).timeouts += 1
+                    LLM_DEADLINES_EXCEEDED.labels(call).inc()
+                    raise LLMTimeout(f"{call} stream did not finish within {deadline:g}s")
+                yield chunk
+        finally:
+            await self._close(opened)
+
+    def snapshot(self) -> Dict[str, dict]:
+        return {call: stats.snapshot() for call, stats in self.stats.items()}
@@ -1,21 +1,38 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, Response
 from pydantic import BaseModel
 import os
-from pathlib import Path
-from PIL import Image
-import io
-from typing import List, Dict, Optional
+from typing import Awaitable, Callable, List, Dict, Optional
 import json
 import asyncio
 import logging
+import uuid
 from urllib.parse import unquote
-from pineconedb import query_pinecone_with_image
-from reasoning import think, estimate_coordinates
-from mapillary import get_mapillary_images
-
-# Set up logging
-logging.basicConfig(level=logging.INFO)
+from pineconedb import aquery_namespaces, aembed_preprocessed, image_batcher
+from ingest import ArtifactStore, build_artifacts
+from blobstore import FileBlobStore, create_blob_store
+from bus import BROADCAST_CHANNEL, SessionBus, create_bus, session_channel
+from embedding_cache import embedding_cache
+from clustering import cluster_matches
+from result_cache import result_cache, replay
+from reasoning import athink, athink_structured, achat_with_context, aestimate_coordinates, llm_client, SentinelScanner, CoordinatesStreamParser, COORDINATES_SENTINEL, GEOLOCATION_MODE
+from mapillary import aget_mapillary_images
+import mapillary
+from executor import run_cpu, run_io
+import executor
+from warmup import readiness, start_warm_up
+import metrics
+from metrics import ACTIVE_CONNECTIONS, CANCELLATIONS, CHAT_CONTEXT_TOKENS, JOBS, UPLOADS, span, track_job
+from scheduler import QueueFull, Scheduler
+from batch import BATCH_MAX_BYTES, BatchJobs
+from conversation import Conversation, conversations, estimate_tokens
+from uploads import MULTIPART_OVERHEAD_BYTES, UploadLimitMiddleware, UploadTooLarge, hash_upload
+from output import OutputChannel
+
+# Set up logging; LOG_LEVEL=DEBUG turns on the per-request diagnostics
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
@@ -28,94 +45,256 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+# Refuse oversized upload bodies while they stream in, not after buffering
+app.add_middleware(UploadLimitMiddleware)
+app.add_middleware(UploadLimitMiddleware, path_prefix="/batch", max_bytes=BATCH_MAX_BYTES + MULTIPART_OVERHEAD_BYTES)
+
 #websocket tracking 
 
 class Manager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
+    """
+    Websockets held by this worker, each written through its own output
+    channel. Messages for sessions connected to another worker are published
+    on the session bus and delivered by that worker
+    """
 
-    def disconnect(self, session_id: str):
-        if session_id in self.active_connections:
-            del self.active_connections[session_id]
+    def __init__(self, bus: SessionBus):
+        self.active_connections: Dict[str, OutputChannel] = {}
+        self.bus = bus
+        self.worker_id = uuid.uuid4().hex
+        self._event_handlers: List[Callable[[dict], Awaitable[None]]] = []
+
+    async def start(self):
+        await self.bus.start(self._deliver)
+
+    async def disconnect(self, session_id: str):
+        channel = self.active_connections.pop(session_id, None)
+        if channel is not None:
+            ACTIVE_CONNECTIONS.set(len(self.active_connections))
+            await channel.close()
+            await self.bus.unsubscribe(session_channel(session_id))
 
     async def connect(self, session_id: str, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections[session_id] = websocket
+        self.active_connections[session_id] = OutputChannel(websocket)
+        ACTIVE_CONNECTIONS.set(len(self.active_connections))
+        await self.bus.subscribe(session_channel(session_id))
     
     async def send_message(self, session_id: str, message: dict):
-        if session_id in self.active_connections:
-            await self.active_connections[session_id].send_json(message)
-
-manager = Manager()
-
-UPLOAD_DIR = Path("uploads")
-UPLOAD_DIR.mkdir(exist_ok=True)
+        channel = self.active_connections.get(session_id)
+        if channel is not None:
+            await channel.send(message)
+        else:
+            # The socket may be held by another worker
+            await self.bus.publish(session_channel(session_id), message)
+
+    def on_event(self, handler: Callable[[dict], Awaitable[None]]):
+        """Register a handler for events broadcast by other workers"""
+        self._event_handlers.append(handler)
+
+    async def broadcast(self, event: dict):
+        await self.bus.publish(BROADCAST_CHANNEL, {**event, "origin": self.worker_id})
+
+    async def _deliver(self, channel: str, message: dict):
+        if channel == BROADCAST_CHANNEL:
+            if message.get("origin") != self.worker_id:
+                for handler in self._event_handlers:
+                    await handler(message)
+            return
+        output = self.active_connections.get(channel[len(session_channel("")):])
+        if output is not None:
+            # Never wait on one slow client: the bus delivers for every session
+            output.send_nowait(message)
+
+manager = Manager(create_bus())
+
+# Global and per-session limits on concurrently running analysis jobs
+scheduler = Scheduler()
+
+# Why a running job was cancelled (label of rainbolt_cancellations_total)
+CANCEL_SUPERSEDED = "superseded"
+CANCEL_DISCONNECTED = "disconnected"
+
+# Load CLIP, connect the vector store and build the Gemini client in the
+# background so the server binds immediately; /ready reports progress
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "1") == "1"
+
+@app.on_event("startup")
+def warm_up():
+    if WARMUP_ON_STARTUP:
+        start_warm_up()
+    else:
+        readiness.skip()
+
+@app.on_event("startup")
+async def start_bus():
+    await manager.start()
+
+@app.on_event("shutdown")
+async def shutdown_clients():
+    await manager.bus.close()
+    await mapillary.aclose()
+    await batch_jobs.stop()
+    executor.shutdown()
+
+# Uploads live in BLOB_STORE (local or shared directory, or S3) so any worker
+# can serve any session
+blob_store = create_blob_store()
+
+# Normalized derivatives, LLM data URLs and CLIP tensors for each session
+artifact_store = ArtifactStore(blob_store)
+
+logger.info(f"Blob store: {blob_store.location('')}")
+logger.info(f"Current working directory: {os.getcwd()}")
 
-# Set directory permissions to be readable/writable by all (755)
-os.chmod(UPLOAD_DIR, 0o755)
+async def _on_worker_event(event: dict):
+    # Another worker stored a new upload for this session: cached copies are stale
+    if event.get("event") == "session_updated":
+        artifact_store.forget(event["session_id"])
+        embedding_cache.invalidate(event["session_id"])
+        # The conversation was about the previous image
+        conversations.forget(event["session_id"])
 
-logger.info(f"UPLOAD_DIR set to: {UPLOAD_DIR}")
-logger.info(f"Current working directory: {os.getcwd()}")
-logger.info(f"UPLOAD_DIR permissions: {oct(os.stat(UPLOAD_DIR).st_mode)[-3:]}")
+manager.on_event(_on_worker_event)
 
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
 
+@app.get("/ready")
+def read_ready():
+    """
+    Readiness probe: 200 once every component is warm, 503 before that
+    (always 200 with WARMUP_ON_STARTUP=0, components then load on first use)
+    """
+    return JSONResponse(
+        status_code=200 if readiness.ready else 503,
+        content={"ready": readiness.ready, "components": readiness.snapshot()},
+    )
+
+@app.get("/stats")
+def read_stats():
+    return {
+        "embedding_cache": embedding_cache.stats(),
+        "conversations": conversations.stats(),
+        "clip_batcher": image_batcher.stats(),
+        "mapillary_cache": mapillary.cache_stats(),
+        "result_cache": result_cache.stats(),
+        "scheduler": scheduler.stats(),
+        "llm": llm_client.snapshot(),
+    }
+
+@app.get("/metrics")
+def read_metrics():
+    """
+    Prometheus scrape endpoint: stage latencies, LLM timings, jobs and connections
+    """
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
 @app.post("/upload-image/{session_id}")
 async def upload_image(session_id: str, file: UploadFile = File(...)):
     """
     Upload and process an image file - returns session ID for WebSocket connection
     Session ID is passed as a path parameter
     """
-    logger.info(f"=== UPLOAD IMAGE REQUEST ===")
-    logger.info(f"Received session_id from path: {session_id}")
+    logger.debug("Upload for session %s", session_id)
     
     # Check if file is an image
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
     
-    # Check file size (limit to 10MB)
-    contents = await file.read()
-    if len(contents) > 10 * 1024 * 1024:  # 10MB
-        raise HTTPException(status_code=400, detail="File too large")
-    
+    # Hash in chunks while enforcing the size limit (UPLOAD_MAX_BYTES)
     try:
-        image = Image.open(io.BytesIO(contents))
-        width, height = image.size
+        upload_digest, size = await hash_upload(file)
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail="File too large")
     
-        # Save the file with session ID as name
-        new_filename = f"{session_id}.jpg"
-        file_path = UPLOAD_DIR / new_filename
-        
-        logger.info(f"Saving file to: {file_path}")
-        
-        # Create file with open permissions from the start
-        # Use os.open with explicit permissions to avoid umask issues
-        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
-        try:
-            os.write(fd, contents)
-        finally:
-            os.close(fd)
-        
-        # Ensure permissions are set correctly
-        os.chmod(file_path, 0o666)
-        
-        logger.info(f"File saved successfully. Exists: {file_path.exists()}")
+    try:
+        # Identical bytes were uploaded before (by any session): reuse their artifacts
+        metadata = await run_io(artifact_store.describe, upload_digest)
+        if metadata is None:
+            UPLOADS.labels("new").inc()
+            # Decode once straight from the spooled upload: normalized
+            # derivative, LLM data URL and CLIP tensor
+            with span("image_decode"):
+                artifacts = await run_cpu(build_artifacts, file.file)
+            with span("image_save"):
+                await run_io(artifact_store.save, upload_digest, artifacts)
+            metadata = {"width": artifacts.original_size[0], "height": artifacts.original_size[1], "format": artifacts.original_format}
+        else:
+            UPLOADS.labels("duplicate").inc()
+
+        await run_io(artifact_store.link, session_id, upload_digest)
+
+        # A new upload replaces the session image, drop its old embeddings and
+        # conversation here and any cached copies on other workers
+        embedding_cache.invalidate(session_id)
+        conversations.forget(session_id)
+        await manager.broadcast({"event": "session_updated", "session_id": session_id})
         
+        logger.debug("Session %s now points at content %s", session_id, upload_digest)
+
         return {
             "message": "Image uploaded successfully",
             "session_id": session_id,
-            "filename": new_filename,
+            "filename": artifact_store.image_key(upload_digest),
             "original_filename": file.filename,
-            "size": len(contents),
-            "dimensions": {"width": width, "height": height},
-            "format": image.format,
-            "file_path": str(file_path)
+            "size": size,
+            "content_hash": upload_digest,
+            "dimensions": {"width": metadata.get("width"), "height": metadata.get("height")},
+            "format": metadata.get("format"),
+            "file_path": artifact_store.location(upload_digest)
         }
     
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Invalid image file: {str(e)}")
+        # The error text can include internal object reprs: log it, answer generically
+        logger.warning(f"Rejected upload for session {session_id}: {e}")
+        raise HTTPException(status_code=400, detail="Invalid image file")
+
+
+# Bulk geolocation of a zip of images; progress and results are polled.
+# Each image takes a scheduler slot like a websocket job
+batch_jobs = BatchJobs(scheduler=scheduler)
+
+@app.on_event("startup")
+async def resume_batches():
+    # Jobs left running by a previous process continue from their results file
+    await batch_jobs.resume()
+
+@app.post("/batch")
+async def create_batch(file: UploadFile = File(...)):
+    """
+    Start geolocating every image in an uploaded zip. Poll /batch/{job_id}
+    for progress, download /batch/{job_id}/results as JSONL
+    """
+    try:
+        status = await batch_jobs.create(file)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    job_id = status["job_id"]
+    return {**status, "status_url": f"/batch/{job_id}", "results_url": f"/batch/{job_id}/results"}
+
+@app.get("/batch/{job_id}")
+async def read_batch(job_id: str):
+    status = await run_io(batch_jobs.status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown batch job")
+    return status
+
+@app.get("/batch/{job_id}/results")
+async def read_batch_results(job_id: str):
+    """Results so far, one JSON object per line (complete once state is done)"""
+    path = await run_io(batch_jobs.results_path, job_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="No results yet")
+    return FileResponse(path, media_type="application/x-ndjson", filename=f"{job_id}.jsonl")
+
+@app.delete("/batch/{job_id}")
+def cancel_batch(job_id: str):
+    if not batch_jobs.cancel(job_id):
+        raise HTTPException(status_code=404, detail="No running batch job with this id")
+    return {"job_id": job_id, "state": "cancelling"}
 
 
 class MapillaryRequest(BaseModel):
@@ -131,7 +310,7 @@ async def get_mapillary_images_endpoint(request: MapillaryRequest):
     Fetch Mapillary street view images for given coordinates
     """
     try:
-        images = get_mapillary_images(
+        images = await aget_mapillary_images(
             lat=request.latitude,
             lon=request.longitude,
             radius=request.radius,
@@ -143,227 +322,397 @@ async def get_mapillary_images_endpoint(request: MapillaryRequest):
             "count": len(images)
         }
     except Exception as e:
-        print(f"Error fetching Mapillary images: {e}")
+        logger.error(f"Error fetching Mapillary images: {e}")
         raise HTTPException(status_code=500, detail=f"Error fetching Mapillary images: {str(e)}")
 
 
+def _log_upload_dir():
+    """Directory diagnostics for a missing upload, only built at DEBUG level"""
+    if logger.isEnabledFor(logging.DEBUG) and isinstance(blob_store, FileBlobStore):
+        try:
+            logger.debug(f"Available files in {blob_store.root}: {list(blob_store.root.iterdir())}")
+        except Exception as e:
+            logger.debug(f"Cannot list directory contents: {e}")
+
+
+# One query serves the analysis and every chat turn: features are fetched at
+# the looser chat threshold and narrowed for the analysis
+RETRIEVAL_QUERIES = [
+    {"namespace": "images", "top_k": 25, "threshold": 0.7},
+    {"namespace": "features", "top_k": 25, "threshold": 0.6},
+]
+ANALYSIS_FEATURE_THRESHOLD = 0.7
+CHAT_FEATURE_TOP_K = 10
+
+async def retrieve(session_id: str, conversation: Conversation, artifacts) -> Dict[str, List[dict]]:
+    """
+    Vector matches and clusters for the session image, queried once per
+    image and kept with the conversation
+    """
+    results = conversation.retrieval(artifacts.digest)
+    if results is None:
+        vector = await embedding_cache.aget_or_compute(session_id, artifacts.data, lambda: aembed_preprocessed(artifacts.clip_input), digest=artifacts.digest)
+        results = await aquery_namespaces(RETRIEVAL_QUERIES, vector=vector)
+        results["clusters"] = cluster_matches(results["images"])
+        conversation.set_retrieval(artifacts.digest, results)
+    return results
+
+async def handle_chat_message(session_id: str, message_data: dict) -> str:
+    """
+    Answer a follow-up question about the session image. Returns the job
+    outcome for metrics
+    """
+    user_message = message_data.get("text", "")
+    chat_history = message_data.get("history", [])
+    chat_session_id = message_data.get("session_id", session_id)
+    
+    # URL-decode the session ID to handle special characters
+    decoded_session_id = unquote(chat_session_id)
+    logger.debug("Chat message for session %s: %s", decoded_session_id, user_message)
+    
+    if not await run_io(artifact_store.exists, decoded_session_id):
+        logger.error(f"Image file not found for session: {chat_session_id} (expected {artifact_store.session_location(decoded_session_id)})")
+        _log_upload_dir()
+        await manager.send_message(session_id, {
+            "type": "error",
+            "message": "Image file not found"
+        })
+        return "not_found"
+    
+    coords_task = None
+    try:
+        # Load the artifacts prepared at upload time
+        with span("image_load"):
+            artifacts = await run_io(artifact_store.load, decoded_session_id)
+        
+        # Query Pinecone for context
+        await manager.send_message(session_id, {
+            "type": "status",
+            "message": "Analyzing your question..."
+        })
+
+        # The server keeps the conversation; client history only fills in
+        # what this worker has not seen (restart, or the session moved)
+        conversation = conversations.get(decoded_session_id)
+        if conversation.empty and chat_history:
+            if chat_history[-1].get("role") == "user" and chat_history[-1].get("text", "").strip() == user_message.strip():
+                chat_history = chat_history[:-1]
+            conversation.seed(chat_history)
+
+        # Matches found for this image on earlier turns are reused
+        results = await retrieve(decoded_session_id, conversation, artifacts)
+        image_matches = results["images"]
+        feature_matches = results["features"][:CHAT_FEATURE_TOP_K]
+        clusters = results["clusters"]
+
+        conversation_context = conversation.context()
+        CHAT_CONTEXT_TOKENS.observe(estimate_tokens(conversation_context))
+        
+        # Stream response
+        response_stream = achat_with_context(
+            user_message, 
+            conversation_context,
+            image_matches, 
+            feature_matches, 
+            artifacts.data_url,
+            clusters=clusters
+        )
+        
+        # Forward chunks as they arrive, stripping the recalculation sentinel
+        scanner = SentinelScanner(COORDINATES_SENTINEL)
+        response = ""
+        async for chunk in response_stream:
+            chunk_text = scanner.feed(chunk.content)
+            response += chunk_text
+            if chunk_text:
+                await manager.send_message(session_id, {
+                    "type": "chat_response_chunk",
+                    "text": chunk_text
+                })
+
+            # The sentinel ends the revised reasoning, start re-estimating right away
+            if scanner.found and coords_task is None:
+                coords_task = asyncio.create_task(aestimate_coordinates(response, clusters))
+
+        tail = scanner.flush()
+        if tail:
+            response += tail
+            await manager.send_message(session_id, {
+                "type": "chat_response_chunk",
+                "text": tail
+            })
+
+        # Handle recalculation trigger
+        if coords_task is not None:
+            await manager.send_message(session_id, {
+                "type": "chat_response_coordinates", 
+                "text": "Rex`   calculating coordinates..."
+            })
+            
+            new_coords = await coords_task
+            await manager.send_message(session_id, {
+                "type": "coordinates",
+                "text": new_coords
+            })
+            conversation.add_guesses(new_coords)
+
+        conversation.add_turn("user", user_message)
+        conversation.add_turn("assistant", response)
+
+        await manager.send_message(session_id, {
+            "type": "complete",
+            "message": "Response complete"
+        })
+        
+    except Exception as e:
+        logger.exception(f"Error processing chat: {e}")
+        await manager.send_message(session_id, {
+            "type": "error",
+            "message": f"Error processing message: {str(e)}"
+        })
+        return "error"
+    finally:
+        # An abandoned reply (cancelled or failed) must not leave the estimate running
+        if coords_task is not None and not coords_task.done():
+            coords_task.cancel()
+    return "ok"
+
+
+async def handle_process_image(session_id: str, message_data: dict) -> str:
+    """
+    Run the full geolocation analysis for the session image. Returns the job
+    outcome for metrics
+    """
+    # URL-decode the session ID to handle special characters
+    process_session_id = unquote(message_data.get('session_id'))
+    
+    logger.debug("Processing image request for: %s", process_session_id)
+    
+    if not await run_io(artifact_store.exists, process_session_id):
+        error_msg = f"Image file not found: {artifact_store.session_location(process_session_id)}"
+        logger.error(error_msg)
+        _log_upload_dir()
+        await manager.send_message(session_id, {
+            "type": "error",
+            "message": error_msg
+        })
+        return "not_found"
+    
+    # Send thinking status
+    await manager.send_message(session_id, {
+        "type": "status",
+        "message": "Analyzing image..."
+    })
+    
+    try:
+        # Load the artifacts prepared at upload time
+        with span("image_load"):
+            artifacts = await run_io(artifact_store.load, process_session_id)
+        vector = await embedding_cache.aget_or_compute(process_session_id, artifacts.data, lambda: aembed_preprocessed(artifacts.clip_input), digest=artifacts.digest)
+
+        # Same or near-identical image analyzed before: replay that result
+        cached = result_cache.lookup(artifacts.phash, vector)
+        if cached is not None:
+            logger.debug("Replaying cached analysis for session %s", process_session_id)
+            await replay(cached, lambda message: manager.send_message(session_id, message))
+            conversation = conversations.get(process_session_id)
+            conversation.add_turn("assistant", cached["reasoning"])
+            conversation.add_guesses(cached["coordinates"])
+            await manager.send_message(session_id, {
+                "type": "complete",
+                "message": "Analysis complete"
+            })
+            return "cached"
+
+        conversation = conversations.get(process_session_id)
+        results = await retrieve(process_session_id, conversation, artifacts)
+        image_matches = results["images"]
+        feature_matches = [m for m in results["features"] if m["score"] >= ANALYSIS_FEATURE_THRESHOLD]
+        # Nearby hits merged once, shared by the reasoning and coordinate prompts
+        clusters = results["clusters"]
+        
+        await manager.send_message(session_id, {
+            "type": "status",
+            "message": f"Found {len(image_matches)} similar images in the database."
+        })
+
+        await manager.send_message(session_id, {
+            "type": "status",
+            "message": "Detecting features..."
+        })
+
+        # Start reasoning process
+        await manager.send_message(session_id, {
+            "type": "status",
+            "message": "Analyzing location details..."
+        })
+        
+        # Stream thinking process
+        reasoning_text = ""
+        locations = []
+
+        if GEOLOCATION_MODE == "single_pass":
+            # One call: reasoning is streamed, each candidate location is
+            # sent as a "location" frame as soon as its JSON object
+            # completes, and all of them in one coordinates frame at the end
+            parser = CoordinatesStreamParser()
+            async for chunk in athink_structured(image_matches, feature_matches, artifacts.data_url, clusters):
+                chunk_text, found = parser.feed(chunk.content)
+                reasoning_text += chunk_text
+                if chunk_text:
+                    await manager.send_message(session_id, {
+                        "type": "reasoning_chunk",
+                        "text": chunk_text
+                    })
+                for location in found:
+                    locations.append(location)
+                    await manager.send_message(session_id, {
+                        "type": "location",
+                        "text": json.dumps(location)
+                    })
+            coordinates = json.dumps(locations)
+
+            tail = parser.flush()
+            if tail:
+                reasoning_text += tail
+                await manager.send_message(session_id, {
+                    "type": "reasoning_chunk",
+                    "text": tail
+                })
+            if locations:
+                # Clients treat each coordinates frame as the complete answer
+                await manager.send_message(session_id, {
+                    "type": "coordinates",
+                    "text": coordinates
+                })
+        else:
+            thinking_stream = athink(image_matches, feature_matches, artifacts.data_url, clusters)
+            
+            async for chunk in thinking_stream:
+                chunk_text = chunk.content
+                reasoning_text += chunk_text
+                await manager.send_message(session_id, {
+                    "type": "reasoning_chunk",
+                    "text": chunk_text
+                })
+        
+        # Two-pass mode, or the single-pass block was missing: estimate coordinates
+        if not locations:
+            await manager.send_message(session_id, {
+                "type": "status",
+                "message": "Calculating final coordinates..."
+            })
+            
+            coordinates = await aestimate_coordinates(reasoning_text, clusters)
+            
+            await manager.send_message(session_id, {
+                "type": "coordinates",
+                "text": coordinates
+            })
+
+        await result_cache.store(artifacts.phash, vector, reasoning_text, coordinates)
+        conversation.add_turn("assistant", reasoning_text)
+        conversation.add_guesses(coordinates)
+        
+        # Send completion message
+        await manager.send_message(session_id, {
+            "type": "complete",
+            "message": "Analysis complete"
+        })
+        
+    except Exception as e:
+        logger.exception(f"Error processing image: {e}")
+        await manager.send_message(session_id, {
+            "type": "error",
+            "message": f"Error processing image: {str(e)}"
+        })
+        return "error"
+    return "ok"
+
+
+async def run_job(session_id: str, kind: str, handler: Callable[[str, dict], Awaitable[str]], message_data: dict, previous: Optional[asyncio.Task] = None):
+    """
+    Run a websocket job through the scheduler, reporting the queue position
+    while it waits and refusing it cleanly when the queue is full. A
+    superseded previous job is allowed to unwind first so its last messages
+    never interleave with this one's, then the client is told it was cancelled
+    """
+    if previous is not None:
+        await asyncio.wait([previous])
+        if previous.cancelled():
+            await manager.send_message(session_id, {"type": "cancelled", "reason": CANCEL_SUPERSEDED})
+
+    started = False
+
+    async def job():
+        nonlocal started
+        started = True
+        with track_job(kind) as tracked:
+            tracked["outcome"] = await handler(session_id, message_data)
+
+    async def report_position(position: int):
+        await manager.send_message(session_id, {
+            "type": "status",
+            "message": f"Waiting for a free slot, position {position} in queue..."
+        })
+
+    try:
+        await scheduler.run(session_id, job, on_position=report_position)
+    except QueueFull:
+        JOBS.labels(kind, "rejected").inc()
+        await manager.send_message(session_id, {
+            "type": "error",
+            "message": "The server is busy right now, please try again in a moment"
+        })
+    except asyncio.CancelledError as e:
+        reason = e.args[0] if e.args else "cancelled"
+        CANCELLATIONS.labels(kind, reason, "running" if started else "queued").inc()
+        logger.debug("Cancelled %s for session %s (%s)", kind, session_id, reason)
+        raise
+    except Exception as e:
+        logger.exception(f"{kind} failed for session {session_id}: {e}")
+
+
+def start_job(current: Optional[asyncio.Task], session_id: str, kind: str, handler: Callable[[str, dict], Awaitable[str]], message_data: dict) -> asyncio.Task:
+    """Cancel the job still running for this socket, if any, and start the new one"""
+    if current is not None and not current.done():
+        current.cancel(CANCEL_SUPERSEDED)
+    return asyncio.create_task(run_job(session_id, kind, handler, message_data, previous=current))
+
+
 @app.websocket("/ws/chat/{session_id}")
 async def websocket_chat(websocket: WebSocket, session_id: str):
     await manager.connect(session_id, websocket)
-    print(f"WebSocket connected: {session_id}")
+    logger.info(f"WebSocket connected: {session_id}")
+    # Jobs run as tasks so this loop keeps reading: a new message supersedes
+    # the job in flight and a disconnect cancels it
+    current: Optional[asyncio.Task] = None
     try:
         while True:
             data = await websocket.receive_text()
-            print(f"Received data: {data}")
+            logger.debug("Received data: %s", data)
             message_data = json.loads(data)
             
             message_type = message_data.get("type")
             
             # Handle user chat messages
             if message_type == "chat_message":
-                user_message = message_data.get("text", "")
-                chat_history = message_data.get("history", [])
-                chat_session_id = message_data.get("session_id", session_id)
-                
-                print(f"Received chat message: {user_message}")
-                
-                # URL-decode the session ID to handle special characters
-                decoded_session_id = unquote(chat_session_id)
-                logger.info(f"Original session_id: {chat_session_id}")
-                logger.info(f"Decoded session_id: {decoded_session_id}")
-                
-                # Construct the expected file path directly
-                expected_file_path = UPLOAD_DIR / f"{decoded_session_id}.jpg"
-                logger.info(f"Looking for image file: {expected_file_path}")
-                logger.info(f"File exists check: {expected_file_path.exists()}")
-                
-                if not expected_file_path.exists():
-                    logger.error(f"Image file not found for session: {chat_session_id}")
-                    logger.error(f"Expected path: {expected_file_path}")
-                    logger.error(f"UPLOAD_DIR: {UPLOAD_DIR}")
-                    logger.error(f"UPLOAD_DIR exists: {UPLOAD_DIR.exists()}")
-                    logger.error(f"UPLOAD_DIR is readable: {os.access(UPLOAD_DIR, os.R_OK)}")
-                    try:
-                        logger.error(f"Available files in {UPLOAD_DIR}: {list(UPLOAD_DIR.iterdir())}")
-                    except Exception as e:
-                        logger.error(f"Cannot list directory contents: {e}")
-                    await manager.send_message(session_id, {
-                        "type": "error",
-                        "message": "Image file not found"
-                    })
-                    continue
-                
-                file_path = expected_file_path
-                
-                try:
-                    # Load the image
-                    image = Image.open(file_path)
-                    
-                    # Query Pinecone for context
-                    await manager.send_message(session_id, {
-                        "type": "status",
-                        "message": "Analyzing your question..."
-                    })
-
-                    image_matches = query_pinecone_with_image(image, top_k=25, namespace="images", threshold=0.7)
-                    feature_matches = query_pinecone_with_image(image, top_k=10, namespace="features", threshold=0.6)
-
-                    # Build conversation context
-                    conversation_context = "\n\nPrevious Conversation:\n"
-                    for msg in chat_history:
-                        role = msg.get("role", "user")
-                        text = msg.get("text", "")
-                        conversation_context += f"{role.upper()}: {text}\n"
-                    
-                    # Stream response
-                    from reasoning import chat_with_context
-                    response_stream = chat_with_context(
-                        user_message, 
-                        conversation_context,
-                        image_matches, 
-                        feature_matches, 
-                        image
-                    )
-                    
-                    # Append chunks to full response
-                    response = ""
-                    for chunk in response_stream:
-                        chunk_text = chunk.content
-                        response += chunk_text
-
-                    # Handle recalculation trigger
-                    if "__output__coordinates__" in response:
-                        response = response.replace("__output__coordinates__", "")
-                        await manager.send_message(session_id, {
-                            "type": "chat_response_coordinates", 
-                            "text": "Rex`   calculating coordinates..."
-                        })
-                        
-                        # Recalculate coordinates
-                        new_coords = estimate_coordinates(response)
-                        await manager.send_message(session_id, {
-                            "type": "coordinates",
-                            "text": new_coords
-                        })
-
-                    await manager.send_message(session_id, {
-                        "type": "chat_response_chunk",
-                        "text": response
-                    })
-
-                    await manager.send_message(session_id, {
-                        "type": "complete",
-                        "message": "Response complete"
-                    })
-                    
-                except Exception as e:
-                    print(f"Error processing chat: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    await manager.send_message(session_id, {
-                        "type": "error",
-                        "message": f"Error processing message: {str(e)}"
-                    })
+                current = start_job(current, session_id, "chat_message", handle_chat_message, message_data)
                 continue
             
             # Check if this is an image processing request
             if message_type == "process_image":
-                # URL-decode the session ID to handle special characters
-                process_session_id = unquote(message_data.get('session_id'))
-                logger.info(f"Original session_id: {message_data.get('session_id')}")
-                logger.info(f"Decoded session_id: {process_session_id}")
-                
-                file_path = UPLOAD_DIR / f"{process_session_id}.jpg"
-                logger.info(f"Processing image request for: {file_path}")
-                logger.info(f"File exists: {file_path.exists()}")
-                logger.info(f"UPLOAD_DIR contents: {list(UPLOAD_DIR.iterdir())}")
-                
-                if not file_path.exists():
-                    error_msg = f"Image file not found: {file_path}"
-                    logger.error(error_msg)
-                    logger.error(f"Available files in {UPLOAD_DIR}: {list(UPLOAD_DIR.iterdir())}")
-                    await manager.send_message(session_id, {
-                        "type": "error",
-                        "message": error_msg
-                    })
-                    continue
-                
-                # Send thinking status
-                await manager.send_message(session_id, {
-                    "type": "status",
-                    "message": "Analyzing image..."
-                })
-                
-                try:
-                    # Load the image
-                    image = Image.open(file_path)
-                    image_matches = query_pinecone_with_image(image, top_k=25, namespace="images", threshold=0.7)
-                    
-                    await manager.send_message(session_id, {
-                        "type": "status",
-                        "message": f"Found {len(image_matches)} similar images in the database."
-                    })
-
-                    # Query Pinecone for features
-                    await manager.send_message(session_id, {
-                        "type": "status",
-                        "message": "Detecting features..."
-                    })
-                    feature_matches = query_pinecone_with_image(image, top_k=25, namespace="features", threshold=0.7)
-
-                    # Start reasoning process
-                    await manager.send_message(session_id, {
-                        "type": "status",
-                        "message": "Analyzing location details..."
-                    })
-                    
-                    # Stream thinking process
-                    reasoning_text = ""
-                    thinking_stream = think(image_matches, feature_matches, image)
-                    
-                    for chunk in thinking_stream:
-                        chunk_text = chunk.content
-                        reasoning_text += chunk_text
-                        await manager.send_message(session_id, {
-                            "type": "reasoning_chunk",
-                            "text": chunk_text
-                        })
-                    
-                    # Estimate coordinates
-                    await manager.send_message(session_id, {
-                        "type": "status",
-                        "message": "Calculating final coordinates..."
-                    })
-                    
-                    coordinates = estimate_coordinates(reasoning_text)
-                    
-                    await manager.send_message(session_id, {
-                        "type": "coordinates",
-                        "text": coordinates
-                    })
-                    
-                    # Send completion message
-                    await manager.send_message(session_id, {
-                        "type": "complete",
-                        "message": "Analysis complete"
-                    })
-                    
-                except Exception as e:
-                    await manager.send_message(session_id, {
-                        "type": "error",
-                        "message": f"Error processing image: {str(e)}"
-                    })
-
-
+                current = start_job(current, session_id, "process_image", handle_process_image, message_data)
 
     except WebSocketDisconnect:
-        print(f"WebSocket disconnected: {session_id}")
-        manager.disconnect(session_id)
+        logger.info(f"WebSocket disconnected: {session_id}")
     except Exception as e:
-        print(f"WebSocket error for {session_id}: {e}")
-        import traceback
-        traceback.print_exc()
-        manager.disconnect(session_id)
+        logger.exception(f"WebSocket error for {session_id}: {e}")
+    finally:
+        # Nobody is listening any more: stop the LLM stream and pending stages
+        if current is not None and not current.done():
+            current.cancel(CANCEL_DISCONNECTED)
+        await manager.disconnect(session_id)
 
 
 
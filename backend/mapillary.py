@@ -1,72 +1,206 @@
-import requests
-import os
+import asyncio
+import logging
 import math
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import httpx
+import numpy as np
+
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+MAPILLARY_URL = "https://graph.mapillary.com/images"
+# How long a tile's candidates stay valid, and how many tiles are kept
+MAPILLARY_CACHE_TTL = float(os.getenv("MAPILLARY_CACHE_TTL", "3600"))
+MAPILLARY_CACHE_SIZE = int(os.getenv("MAPILLARY_CACHE_SIZE", "1024"))
+# Candidates fetched per requested image, to rank by distance
+MAPILLARY_OVERFETCH = int(os.getenv("MAPILLARY_OVERFETCH", "10"))
+MAPILLARY_TIMEOUT = float(os.getenv("MAPILLARY_TIMEOUT", "10"))
 
 
 def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     """Calculate distance between two points in meters using Haversine formula"""
     R = 6371000  # Earth's radius in meters
-    
+
     phi1 = math.radians(lat1)
     phi2 = math.radians(lat2)
     delta_phi = math.radians(lat2 - lat1)
     delta_lambda = math.radians(lon2 - lon1)
-    
+
     a = math.sin(delta_phi/2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda/2)**2
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    
+
     return R * c
 
-def get_mapillary_images(lat: float, lon: float, radius: float = 0.003, limit: int = 5) -> list:
+def haversine_distances(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Vectorized haversine: meters from (lat, lon) to every (lats[i], lons[i])"""
+    R = 6371000  # Earth's radius in meters
+
+    phi1 = np.radians(lat)
+    phi2 = np.radians(lats)
+    delta_phi = phi2 - phi1
+    delta_lambda = np.radians(lons - lon)
 
-    if not os.getenv("MAPILLARY_API_KEY"):
-        raise ValueError("MAPILLARY_API_KEY environment variable not set")
-    
-    api_key = os.getenv("MAPILLARY_API_KEY")
-    url = "https://graph.mapillary.com/images"
+    a = np.sin(delta_phi/2)**2 + np.cos(phi1) * np.cos(phi2) * np.sin(delta_lambda/2)**2
+    return 2 * R * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+
+def quadkey(lat: float, lon: float, zoom: int) -> str:
+    """Web-mercator quadkey of the tile containing (lat, lon)"""
+    lat = max(min(lat, 85.05112878), -85.05112878)
+    n = 1 << zoom
+    x = int((lon + 180) / 360 * n)
+    sin_lat = math.sin(math.radians(lat))
+    y = int((0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * n)
+    x, y = min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+    digits = []
+    for i in range(zoom, 0, -1):
+        mask = 1 << (i - 1)
+        digits.append(str((1 if x & mask else 0) + (2 if y & mask else 0)))
+    return "".join(digits)
+
+def _tile_bounds(key: str) -> Tuple[float, float, float, float]:
+    """(min_lon, min_lat, max_lon, max_lat) of a quadkey tile"""
+    x = y = 0
+    for digit in key:
+        x, y = x << 1, y << 1
+        d = int(digit)
+        x |= d & 1
+        y |= (d >> 1) & 1
+    n = 1 << len(key)
+
+    def lat_of(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return x / n * 360 - 180, lat_of(y + 1), (x + 1) / n * 360 - 180, lat_of(y)
+
+def _zoom_for_radius(radius: float) -> int:
+    """Smallest zoom whose tiles are no wider than the search radius (degrees)"""
+    return max(0, min(22, math.ceil(math.log2(360 / max(radius, 1e-6)))))
 
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire after ttl seconds"""
+
+    def __init__(self, max_entries: int = MAPILLARY_CACHE_SIZE, ttl: float = MAPILLARY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[tuple, Tuple[float, object]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+_client: Optional[httpx.AsyncClient] = None
+_cache = TTLCache()
+_inflight: Dict[tuple, asyncio.Future] = {}
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=MAPILLARY_TIMEOUT,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+        )
+    return _client
+
+async def aclose():
+    """Close the pooled HTTP session (call on shutdown)"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def _fetch_tile(key: str, radius: float, fetch_limit: int) -> Optional[np.ndarray]:
+    """
+    Fetch every candidate within radius of any point of the tile. Returns a
+    structured array of (lat, lon, url) rows
+    """
+    api_key = os.getenv("MAPILLARY_API_KEY")
+    min_lon, min_lat, max_lon, max_lat = _tile_bounds(key)
     params = {
         "access_token": api_key,
         "fields": "id,thumb_1024_url,geometry",
-        "bbox": f"{lon-radius},{lat-radius},{lon+radius},{lat+radius}",
-        "limit": 50  # Fetch more images to filter from
+        "bbox": f"{min_lon-radius},{min_lat-radius},{max_lon+radius},{max_lat+radius}",
+        "limit": fetch_limit
     }
 
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-        all_data = response.json()
-        data = all_data.get('data', [])
-        
-        # Calculate distance for each image and sort by proximity
-        images_with_distance = []
-        for img in data:
-            if img.get('thumb_1024_url') and img.get('geometry'):
-                coords = img['geometry']['coordinates']
-                img_lon, img_lat = coords[0], coords[1]
-                distance = haversine_distance(lat, lon, img_lat, img_lon)
-                images_with_distance.append({
-                    'url': img['thumb_1024_url'],
-                    'distance': distance,
-                    'lat': img_lat,
-                    'lon': img_lon
-                })
-        
-        # Sort by distance and return the closest ones
-        images_with_distance.sort(key=lambda x: x['distance'])
-
-        print(f"closest image at {images_with_distance[0]['distance']:.2f} meters, coordinates: ({images_with_distance[0]['lat']}, {images_with_distance[0]['lon']})")
-        
-        return [img['url'] for img in images_with_distance[:limit]]
-    
-    else:
-        print(f"Error fetching Mapillary images: {response.status_code}")
+    with span("mapillary_fetch"):
+        response = await _get_client().get(MAPILLARY_URL, params=params)
+    if response.status_code != 200:
+        logger.warning(f"Error fetching Mapillary images: {response.status_code}")
+        return None
+
+    rows = [
+        (img['geometry']['coordinates'][1], img['geometry']['coordinates'][0], img['thumb_1024_url'])
+        for img in response.json().get('data', [])
+        if img.get('thumb_1024_url') and img.get('geometry')
+    ]
+    return np.array(rows, dtype=[("lat", "f8"), ("lon", "f8"), ("url", "O")])
+
+async def aget_mapillary_images(lat: float, lon: float, radius: float = 0.003, limit: int = 5) -> list:
+    """
+    Closest Mapillary thumbnails to (lat, lon). Candidates are cached per
+    quadkey tile, so nearby requests for the same place skip the network
+    """
+    if not os.getenv("MAPILLARY_API_KEY"):
+        raise ValueError("MAPILLARY_API_KEY environment variable not set")
+
+    fetch_limit = min(2000, max(limit * MAPILLARY_OVERFETCH, limit))
+    cache_key = (quadkey(lat, lon, _zoom_for_radius(radius)), radius, fetch_limit)
+
+    candidates = _cache.get(cache_key)
+    if candidates is None:
+        # Share one request between concurrent callers for the same tile
+        pending = _inflight.get(cache_key)
+        if pending is None:
+            pending = asyncio.ensure_future(_fetch_tile(cache_key[0], radius, fetch_limit))
+            _inflight[cache_key] = pending
+            pending.add_done_callback(lambda _: _inflight.pop(cache_key, None))
+        candidates = await asyncio.shield(pending)
+        if candidates is None:
+            return []
+        _cache.put(cache_key, candidates)
+
+    # The tile fetch covers a larger area: keep what lies inside this request's box
+    in_box = (np.abs(candidates["lat"] - lat) <= radius) & (np.abs(candidates["lon"] - lon) <= radius)
+    candidates = candidates[in_box]
+    if len(candidates) == 0:
         return []
 
+    distances = haversine_distances(lat, lon, candidates["lat"], candidates["lon"])
+    closest = np.argsort(distances)[:limit]
+    logger.debug("closest image at %.2f meters, coordinates: (%s, %s)", distances[closest[0]], candidates['lat'][closest[0]], candidates['lon'][closest[0]])
+
+    return [candidates["url"][i] for i in closest]
+
+def cache_stats() -> dict:
+    return {"tiles": len(_cache._entries), "hits": _cache.hits, "misses": _cache.misses}
+
 if __name__ == "__main__":
     from dotenv import load_dotenv
-    load_dotenv()  
+    load_dotenv()
     # Eiffel Tower coordinates: 48.8584° N, 2.2945° E
-    images = get_mapillary_images(48.858093, 2.294694, radius=0.001, limit=5)
+    images = asyncio.run(aget_mapillary_images(48.858093, 2.294694, radius=0.001, limit=5))
     print(f"Found {len(images)} images")
     for i, url in enumerate(images, 1):
-        print(f"{i}. {url}")
\ No newline at end of file
+        print(f"{i}. {url}")
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from typing import AsyncIterator, Iterator
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+logger = logging.getLogger(__name__)
+
+# Covers cache hits (sub-ms) up to slow LLM streams (tens of seconds)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+STAGE_SECONDS = Histogram(
+    "rainbolt_stage_seconds",
+    "Duration of each pipeline stage",
+    ["stage"],
+    buckets=BUCKETS,
+)
+STAGE_ERRORS = Counter(
+    "rainbolt_stage_errors_total",
+    "Pipeline stages that raised",
+    ["stage"],
+)
+QUERY_SECONDS = Histogram(
+    "rainbolt_vector_query_seconds",
+    "Vector store query duration per namespace",
+    ["namespace"],
+    buckets=BUCKETS,
+)
+LLM_FIRST_TOKEN_SECONDS = Histogram(
+    "rainbolt_llm_first_token_seconds",
+    "Time from request to the first streamed LLM chunk",
+    ["call"],
+    buckets=BUCKETS,
+)
+LLM_TOTAL_SECONDS = Histogram(
+    "rainbolt_llm_total_seconds",
+    "Time from request to the end of the LLM response",
+    ["call"],
+    buckets=BUCKETS,
+)
+LLM_CHUNKS = Counter(
+    "rainbolt_llm_chunks_total",
+    "Streamed LLM chunks received",
+    ["call"],
+)
+LLM_HEDGES = Counter(
+    "rainbolt_llm_hedges_total",
+    "Hedged LLM requests: sent, won (answered first) or skipped (no capacity)",
+    ["call", "result"],
+)
+LLM_DEADLINES_EXCEEDED = Counter(
+    "rainbolt_llm_deadlines_exceeded_total",
+    "LLM calls abandoned at their deadline",
+    ["call"],
+)
+JOBS = Counter(
+    "rainbolt_jobs_total",
+    "Websocket jobs by type and outcome",
+    ["type", "outcome"],
+)
+CANCELLATIONS = Counter(
+    "rainbolt_cancellations_total",
+    "Websocket jobs cancelled before finishing, by reason and whether they had started",
+    ["type", "reason", "state"],
+)
+CANCELLED_STAGES = Counter(
+    "rainbolt_cancelled_stages_total",
+    "Pipeline stages interrupted by a cancellation (work not paid for)",
+    ["stage"],
+)
+UPLOADS = Counter(
+    "rainbolt_uploads_total",
+    "Image uploads, by whether the content was already stored",
+    ["result"],
+)
+CHAT_CONTEXT_TOKENS = Histogram(
+    "rainbolt_chat_context_tokens",
+    "Estimated tokens of conversation history sent with each chat turn",
+    buckets=(100, 250, 500, 1000, 1500, 2000, 3000, 5000, 10000, 20000),
+)
+WS_MESSAGES = Counter(
+    "rainbolt_ws_messages_total",
+    "Websocket messages written as their own frame (sent) or merged into a pending chunk (coalesced)",
+    ["result"],
+)
+SLOW_CLIENT_DISCONNECTS = Counter(
+    "rainbolt_slow_client_disconnects_total",
+    "Websockets closed because the client stopped reading",
+)
+ACTIVE_CONNECTIONS = Gauge(
+    "rainbolt_active_connections",
+    "Open websocket connections",
+)
+QUEUE_DEPTH = Gauge(
+    "rainbolt_queued_jobs",
+    "Websocket jobs waiting for a scheduler slot",
+)
+INFLIGHT_JOBS = Gauge(
+    "rainbolt_inflight_jobs",
+    "Websocket jobs currently running",
+    ["type"],
+)
+
+
+@contextmanager
+def span(stage: str, histogram: Histogram = STAGE_SECONDS, **labels) -> Iterator[None]:
+    """
+    Time the enclosed block into histogram (labelled stage by default) and
+    count it as an error if it raises. Usable around awaits too.
+    """
+    labels = labels or {"stage": stage}
+    start = time.perf_counter()
+    try:
+        yield
+    except asyncio.CancelledError:
+        CANCELLED_STAGES.labels(stage).inc()
+        raise
+    except BaseException:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        histogram.labels(**labels).observe(elapsed)
+        logger.debug("span %s %.1fms %s", stage, elapsed * 1000, labels)
+
+
+async def timed_stream(call: str, stream: AsyncIterator) -> AsyncIterator:
+    """
+    Pass an LLM chunk stream through, recording time to first chunk and the
+    total stream duration under the given call name. If the consumer is
+    cancelled or stops early the provider stream is closed right away
+    """
+    start = time.perf_counter()
+    first = True
+    try:
+        async for chunk in stream:
+            if first:
+                LLM_FIRST_TOKEN_SECONDS.labels(call).observe(time.perf_counter() - start)
+                first = False
+            LLM_CHUNKS.labels(call).inc()
+            yield chunk
+    except (asyncio.CancelledError, GeneratorExit):
+        CANCELLED_STAGES.labels(f"llm_{call}").inc()
+        raise
+    except BaseException:
+        STAGE_ERRORS.labels(f"llm_{call}").inc()
+        raise
+    finally:
+        LLM_TOTAL_SECONDS.labels(call).observe(time.perf_counter() - start)
+        aclose = getattr(stream, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+def timed_sync_stream(call: str, stream: Iterator) -> Iterator:
+    """Synchronous counterpart of timed_stream for model.stream()"""
+    start = time.perf_counter()
+    first = True
+    try:
+        for chunk in stream:
+            if first:
+                LLM_FIRST_TOKEN_SECONDS.labels(call).observe(time.perf_counter() - start)
+                first = False
+            LLM_CHUNKS.labels(call).inc()
+            yield chunk
+    except BaseException:
+        STAGE_ERRORS.labels(f"llm_{call}").inc()
+        raise
+    finally:
+        LLM_TOTAL_SECONDS.labels(call).observe(time.perf_counter() - start)
+
+
+@contextmanager
+def track_job(kind: str) -> Iterator[dict]:
+    """
+    In-flight gauge plus an outcome counter for one websocket job. The caller
+    may set job["outcome"] (e.g. "cached", "error") before the block exits
+    """
+    INFLIGHT_JOBS.labels(kind).inc()
+    job = {"outcome": "ok"}
+    try:
+        yield job
+    except asyncio.CancelledError:
+        job["outcome"] = "cancelled"
+        raise
+    except BaseException:
+        job["outcome"] = "error"
+        raise
+    finally:
+        INFLIGHT_JOBS.labels(kind).dec()
+        JOBS.labels(kind, job["outcome"]).inc()
+
+
+def render():
+    """Prometheus text exposition of every metric above: (body, content type)"""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,190 @@
+"""
+Per-connection websocket output.
+
+Messages are queued and written by one task per connection. Streamed chunks
+(reasoning_chunk, chat_response_chunk) that arrive within
+OUTPUT_COALESCE_MS of the previous chunk frame are merged into one message, so a
+fast token stream costs a frame every few milliseconds rather than one per
+chunk; the first chunk still goes out immediately. Frames are serialized
+with orjson, and compressed by permessage-deflate when the client offers it
+(negotiated by uvicorn, on unless --ws-per-message-deflate false); larger
+coalesced frames compress far better than single tokens.
+
+The queue is bounded (OUTPUT_QUEUE_MESSAGES / OUTPUT_QUEUE_BYTES): producers
+wait while a client reads slowly, and a client that takes nothing for
+OUTPUT_STALL_SECONDS is disconnected instead of buffering without limit.
+Messages relayed from the session bus are queued without waiting, and a
+client that falls twice the bound behind them is disconnected too.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Deque, Optional
+
+import orjson
+from fastapi import WebSocket
+
+from metrics import SLOW_CLIENT_DISCONNECTS, WS_MESSAGES
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_COALESCE_MS = float(os.getenv("OUTPUT_COALESCE_MS", "20"))
+# A pending chunk this large is sent without waiting out the window
+OUTPUT_COALESCE_BYTES = int(os.getenv("OUTPUT_COALESCE_BYTES", "4096"))
+OUTPUT_QUEUE_MESSAGES = int(os.getenv("OUTPUT_QUEUE_MESSAGES", "256"))
+OUTPUT_QUEUE_BYTES = int(os.getenv("OUTPUT_QUEUE_BYTES", str(256 * 1024)))
+OUTPUT_STALL_SECONDS = float(os.getenv("OUTPUT_STALL_SECONDS", "30"))
+
+COALESCED_TYPES = {"reasoning_chunk", "chat_response_chunk"}
+
+# Policy close code "try again later"
+CLOSE_STALLED = 1013
+
+
+def dumps(message: dict) -> str:
+    return orjson.dumps(message, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+
+def _size(message: dict) -> int:
+    text = message.get("text")
+    return len(text) if isinstance(text, str) else 64
+
+
+def _mergeable(message: dict) -> bool:
+    return message.get("type") in COALESCED_TYPES and message.keys() == {"type", "text"} and isinstance(message["text"], str)
+
+
+class OutputChannel:
+    def __init__(self, websocket: WebSocket, coalesce_ms: float = OUTPUT_COALESCE_MS, coalesce_bytes: int = OUTPUT_COALESCE_BYTES,
+                 max_messages: int = OUTPUT_QUEUE_MESSAGES, max_bytes: int = OUTPUT_QUEUE_BYTES, stall_seconds: float = OUTPUT_STALL_SECONDS):
+        self.websocket = websocket
+        self.coalesce = coalesce_ms / 1000
+        self.coalesce_bytes = coalesce_bytes
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.stall_seconds = stall_seconds
+        self.closed = False
+        self._pending: Deque[dict] = deque()
+        self._pending_bytes = 0
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        # When the last chunk frame went out: the window runs from there
+        self._last_chunk_sent = 0.0
+        self._writer = asyncio.create_task(self._run())
+
+    def _full(self) -> bool:
+        return len(self._pending) >= self.max_messages or self._pending_bytes >= self.max_bytes
+
+    async def send(self, message: dict):
+        """
+        Queue a message, waiting while the queue is full. Messages for a closed
+        channel are dropped: the connection's jobs are cancelled separately
+        """
+        if self.closed:
+            return
+        # The bound applies to merged chunks too, or a fast stream into a
+        # stalled client would grow its pending text without limit
+        while self._full():
+            self._space.clear()
+            try:
+                await asyncio.wait_for(self._space.wait(), self.stall_seconds)
+            except asyncio.TimeoutError:
+                await self._stalled()
+                return
+            if self.closed:
+                return
+
+        self._enqueue(message)
+
+    def send_nowait(self, message: dict):
+        """
+        Queue a message without waiting, for messages relayed from the session
+        bus (its listener serves every session and must not block on one).
+        The queue may pass its bound here; a client that falls behind by twice
+        the bound is disconnected as stalled
+        """
+        if self.closed:
+            return
+        if len(self._pending) >= 2 * self.max_messages or self._pending_bytes >= 2 * self.max_bytes:
+            asyncio.ensure_future(self._stalled("client fell behind relayed messages"))
+            return
+        self._enqueue(message)
+
+    def _enqueue(self, message: dict):
+        last = self._pending[-1] if self._pending else None
+        if last is not None and _mergeable(message) and _mergeable(last) and last["type"] == message["type"]:
+            last["text"] += message["text"]
+            self._pending_bytes += _size(message)
+            WS_MESSAGES.labels("coalesced").inc()
+            self._ready.set()
+            return
+
+        message = dict(message) if _mergeable(message) else message
+        self._pending.append(message)
+        self._pending_bytes += _size(message)
+        self._ready.set()
+
+    async def _next(self) -> dict:
+        """The next frame to write, holding streamed chunks for the coalescing window"""
+        while not self._pending:
+            self._ready.clear()
+            await self._ready.wait()
+        while _mergeable(self._pending[0]) and len(self._pending) == 1 and self._pending_bytes < self.coalesce_bytes:
+            delay = self._last_chunk_sent + self.coalesce - time.monotonic()
+            if delay <= 0:
+                break
+            # More text may be merged in meanwhile; recheck the size when it is
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), delay)
+            except asyncio.TimeoutError:
+                break
+        message = self._pending.popleft()
+        self._pending_bytes -= _size(message)
+        if not self._full():
+            self._space.set()
+        return message
+
+    async def _run(self):
+        try:
+            while True:
+                message = await self._next()
+                try:
+                    await asyncio.wait_for(self.websocket.send_text(dumps(message)), self.stall_seconds)
+                except asyncio.TimeoutError:
+                    await self._stalled()
+                    return
+                if message.get("type") in COALESCED_TYPES:
+                    self._last_chunk_sent = time.monotonic()
+                WS_MESSAGES.labels("sent").inc()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Usually the client went away; the receive loop notices and cleans up
+            logger.debug(f"Websocket output stopped: {e}")
+            self.closed = True
+            self._space.set()
+
+    async def _stalled(self, reason: Optional[str] = None):
+        if self.closed:
+            return
+        self.closed = True
+        self._space.set()
+        SLOW_CLIENT_DISCONNECTS.inc()
+        logger.warning(f"Closing websocket: {reason or f'client read nothing for {self.stall_seconds}s'}")
+        try:
+            await asyncio.wait_for(self.websocket.close(code=CLOSE_STALLED), 5)
+        except Exception:
+            pass
+
+    async def close(self):
+        self.closed = True
+        self._space.set()
+        self._writer.cancel()
+        try:
+            await self._writer
+        except asyncio.CancelledError:
+            pass
@@ -1,52 +1,176 @@
-from typing import List
+from typing import Dict, List
 from pinecone import Pinecone
+import asyncio
 import os
+import threading
 import clip
 import torch
 from PIL import Image
 from dotenv import load_dotenv
+from batcher import MicroBatcher
+from clip_runtime import ClipRuntime
+from executor import io_pool, run_cpu, run_io
+from feature_index import FeatureIndex
+from metrics import QUERY_SECONDS, span
+from vectorstore import LocalStore, PineconeStore, VectorStore
 load_dotenv()  # Load environment variables from .env file
 
+# Micro-batching knobs for concurrent image encodes
+CLIP_BATCH_SIZE = int(os.getenv("CLIP_BATCH_SIZE", "16"))
+CLIP_BATCH_LATENCY_MS = float(os.getenv("CLIP_BATCH_LATENCY_MS", "5"))
+
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("ViT-B/32", device=device)
 
-# env variables should be loaded in upstream code
-if not os.getenv("PINECONE_API_KEY"):
-    raise ValueError("PINECONE_API_KEY environment variable not set")
+# Constructed on first use (or by the startup warm-up), not at import time
+_clip = None
+_vector_store = None
+_clip_lock = threading.Lock()
+_store_lock = threading.Lock()
 
-pinecone = Pinecone(
-    api_key=os.getenv("PINECONE_API_KEY"),
-)
+def get_clip() -> ClipRuntime:
+    """
+    ViT-B/32 prepared for CLIP_INFERENCE_MODE, loaded on first call
+    """
+    global _clip
+    if _clip is None:
+        with _clip_lock:
+            if _clip is None:
+                _clip = ClipRuntime(device=device)
+    return _clip
+
+def preprocess(image: Image.Image) -> torch.Tensor:
+    return get_clip().preprocess(image)
+
+# "pinecone" (hosted index) or "local" (memory-mapped snapshot in LOCAL_INDEX_DIR)
+VECTOR_STORE = os.getenv("VECTOR_STORE", "pinecone")
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "index")
 
 index_name = "htv2025"
-index = pinecone.Index(index_name)
+
+# "memory" answers features-namespace queries from the in-process text
+# embedding matrix (feature_index.py), falling back to the vector store
+# until one has been built; "remote" always queries the vector store
+FEATURE_MATCHING = os.getenv("FEATURE_MATCHING", "memory")
+FEATURES_NAMESPACE = "features"
+
+feature_index = FeatureIndex()
+
+def _create_vector_store() -> VectorStore:
+    if VECTOR_STORE == "local":
+        return LocalStore(LOCAL_INDEX_DIR)
+
+    # env variables should be loaded in upstream code
+    if not os.getenv("PINECONE_API_KEY"):
+        raise ValueError("PINECONE_API_KEY environment variable not set")
+
+    pinecone = Pinecone(
+        api_key=os.getenv("PINECONE_API_KEY"),
+    )
+    return PineconeStore(pinecone.Index(index_name))
+
+def get_vector_store() -> VectorStore:
+    """
+    The configured vector store, connected on first call
+    """
+    global _vector_store
+    if _vector_store is None:
+        with _store_lock:
+            if _vector_store is None:
+                _vector_store = _create_vector_store()
+    return _vector_store
 
 def query_pinecone(vector, top_k=5, namespace=None, threshold=0) -> List[dict]:
     """
-    Query Pinecone index with a vector and return top_k results
+    Query the configured vector store with a vector and return top_k results
     """
-    response = index.query(vector=vector, top_k=top_k, include_metadata=True, namespace=namespace)
-    matches = response['matches']
-    if threshold > 0:
-        matches = [m for m in matches if m['score'] >= threshold]
-    return matches
+    with span(f"query_{namespace}", QUERY_SECONDS, namespace=str(namespace)):
+        if namespace == FEATURES_NAMESPACE and FEATURE_MATCHING == "memory" and feature_index.available:
+            return feature_index.query(vector, top_k=top_k, threshold=threshold)
+        return get_vector_store().query(vector, top_k=top_k, namespace=namespace, threshold=threshold)
+
+def _encode_image_batch(image_inputs: List[torch.Tensor]) -> List[List[float]]:
+    """
+    Run the CLIP image encoder once over a batch of preprocessed images
+    """
+    vectors = get_clip().encode_image(torch.stack(image_inputs))
+    return vectors.tolist()
+
+image_batcher = MicroBatcher(
+    _encode_image_batch,
+    max_batch_size=CLIP_BATCH_SIZE,
+    max_latency_ms=CLIP_BATCH_LATENCY_MS,
+    name="clip-image-batcher",
+)
+
+def embed_image(image: Image.Image) -> List[float]:
+    """
+    Embed a single image. Preprocessing runs in the calling thread, the
+    forward pass is shared with any other images queued at the same time
+    """
+    with span("embed"):
+        image_input = preprocess(image)
+        return image_batcher.encode(image_input)
+
+async def aembed_image(image: Image.Image) -> List[float]:
+    """
+    Async variant of embed_image: preprocess on the CPU pool, then await the
+    batched forward pass without holding a pool thread
+    """
+    image_input = await run_cpu(preprocess, image)
+    return await aembed_preprocessed(image_input)
+
+async def aembed_preprocessed(image_input: torch.Tensor) -> List[float]:
+    """
+    Embed an image tensor that already went through preprocess
+    """
+    with span("embed"):
+        return await asyncio.wrap_future(image_batcher.submit(image_input))
 
 def query_pinecone_with_image(image: Image.Image, top_k=5, namespace=None, threshold=0) -> List[dict]:
     """
     Embed image and query Pinecone index
     """
-    image_input = preprocess(image).unsqueeze(0).to(device)
-    with torch.no_grad():
-        vector = model.encode_image(image_input).tolist()
+    vector = embed_image(image)
     return query_pinecone(vector, top_k=top_k, namespace=namespace, threshold=threshold)
 
+def query_namespaces(specs: List[dict], image: Image.Image = None, vector=None) -> Dict[str, List[dict]]:
+    """
+    Embed the image once (unless a vector is given) and query every namespace
+    spec concurrently. Specs look like {"namespace": "images", "top_k": 25,
+    "threshold": 0.7}; results are keyed by namespace.
+    """
+    if vector is None:
+        vector = embed_image(image)
+    futures = {
+        spec["namespace"]: io_pool.submit(query_pinecone, vector, top_k=spec.get("top_k", 5), namespace=spec["namespace"], threshold=spec.get("threshold", 0))
+        for spec in specs
+    }
+    return {namespace: future.result() for namespace, future in futures.items()}
+
+async def aquery_namespaces(specs: List[dict], image: Image.Image = None, vector=None) -> Dict[str, List[dict]]:
+    """
+    Async variant of query_namespaces
+    """
+    if vector is None:
+        vector = await aembed_image(image)
+    results = await asyncio.gather(*[
+        run_io(query_pinecone, vector, top_k=spec.get("top_k", 5), namespace=spec["namespace"], threshold=spec.get("threshold", 0))
+        for spec in specs
+    ])
+    return {spec["namespace"]: matches for spec, matches in zip(specs, results)}
+
+def encode_texts(texts: List[str]) -> List[List[float]]:
+    """
+    CLIP text embeddings for a batch of texts, cut at the 77-token context
+    """
+    return get_clip().encode_text(clip.tokenize(texts, truncate=True)).tolist()
+
 def query_pinecone_with_text(text: str, top_k=5, namespace=None) -> List[dict]:
     """
     Embed text and query Pinecone index
     """
-    text_input = clip.tokenize([text]).to(device)
-    with torch.no_grad():
-        vector = model.encode_text(text_input).tolist()
+    text_input = clip.tokenize([text])
+    vector = get_clip().encode_text(text_input)[0].tolist()
     return query_pinecone(vector, top_k=top_k, namespace=namespace)
 
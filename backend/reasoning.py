@@ -1,13 +1,20 @@
 import os
 from PIL import Image
 from dotenv import load_dotenv
-from typing import Dict
+from typing import AsyncIterator, Dict, List, Tuple
 from langchain_google_genai import ChatGoogleGenerativeAI
+from executor import run_cpu
+from llm import LLMClient
+from metrics import span, timed_stream, timed_sync_stream
+from clustering import cluster_matches, format_clusters
 import base64
 import io
 import json
+import logging
 import re
 
+logger = logging.getLogger(__name__)
+
 os.environ["GRPC_VERBOSITY"] = "ERROR"
 os.environ["GRPC_TRACE"] = ""
 
@@ -15,18 +22,86 @@ load_dotenv()
 
 FEATURE_THRESHOLD = 0.6
 
-if not os.getenv("GOOGLE_API_KEY"):
-    raise ValueError("GOOGLE_API_KEY environment variable not set")
+# Emitted by chat_with_context when the follow-up should produce new coordinates
+COORDINATES_SENTINEL = "__output__coordinates__"
 
-model = ChatGoogleGenerativeAI(model="gemini-2.5-flash", thinking_budget=0)
+# "two_pass": think streams the reasoning, then estimate_coordinates asks for JSON
+# "single_pass": one streamed call ends with a machine-readable coordinates block
+GEOLOCATION_MODE = os.getenv("GEOLOCATION_MODE", "two_pass")
+COORDINATES_MARKER = "<<<COORDINATES>>>"
 
-def think(image_matches: Dict, features: Dict, image: Image) -> str:
-    visual_match = ""
-    for match in image_matches:
-        latitude = match['metadata']['latitude']
-        longitude = match['metadata']['longitude']
-        score = match['score']
-        visual_match += f"(Latitude: {latitude}, Longitude: {longitude}) - Score: {score}\n"
+STRUCTURED_OUTPUT_INSTRUCTIONS = f"""
+            After your reasoning, output the line {COORDINATES_MARKER} and then a JSON array with your top 3 possible locations, most likely first. Each object has exactly these keys:
+            "latitude" (float), "longitude" (float), "name" (estimated city, landmark, or region), "accuracy" (float between 0 and 100, percentage confidence that the coordinates are correct) and "facts" (a list of 3 concise fun facts about the location).
+            Use double quotes for every key and string. Do not wrap the array in markdown and do not write anything after it.
+"""
+
+# "gemini", or "fake" for the local stand-in in fakes.py (no API key needed)
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "gemini")
+
+_model = None
+
+def get_model() -> ChatGoogleGenerativeAI:
+    """
+    Chat model for LLM_PROVIDER, constructed on first use
+    """
+    global _model
+    if _model is None:
+        if LLM_PROVIDER == "fake":
+            from fakes import FakeChatModel
+            _model = FakeChatModel()
+        else:
+            if not os.getenv("GOOGLE_API_KEY"):
+                raise ValueError("GOOGLE_API_KEY environment variable not set")
+            # Retries, deadlines and hedging are handled by llm_client
+            _model = ChatGoogleGenerativeAI(model="gemini-2.5-flash", thinking_budget=0, max_retries=0)
+    return _model
+
+# Rate limiting, deadlines and hedging for every async call below
+llm_client = LLMClient(get_model)
+
+def image_data_url(image: Image) -> str:
+    """
+    Encode a PIL image as a base64 data URL
+    """
+    buffered = io.BytesIO()
+    image_format = image.format or "JPEG"
+    image.save(buffered, format=image_format)
+    img_base64 = base64.b64encode(buffered.getvalue()).decode()
+    return f"data:image/{image_format.lower()};base64,{img_base64}"
+
+def _image_message(prompt: str, image):
+    """
+    Build the multimodal Gemini message for a prompt and the session image.
+    image is either a PIL image or a precomputed data URL (see ingest.py)
+    """
+    image_url = image if isinstance(image, str) else image_data_url(image)
+    
+    # Create multimodal message
+    from langchain_core.messages import HumanMessage
+    
+    message = HumanMessage(
+        content=[
+            {"type": "text", "text": prompt},
+            {
+                "type": "image_url",
+                "image_url": image_url
+            }
+        ]
+    )
+    return message
+
+def _visual_matches(image_matches: Dict, clusters: List[dict] = None) -> str:
+    """
+    Compact prompt summary of the visual matches: nearby hits are merged into
+    ranked clusters instead of listing every match
+    """
+    if clusters is None:
+        clusters = cluster_matches(image_matches)
+    return format_clusters(clusters)
+
+def _think_message(image_matches: Dict, features: Dict, image: Image, clusters: List[dict] = None):
+    visual_match = _visual_matches(image_matches, clusters)
 
     features_match = ""
     for match in features:
@@ -39,7 +114,7 @@ def think(image_matches: Dict, features: Dict, image: Image) -> str:
     prompt = f"""You are a geography expert analyzing an image to find coordinates based on visual features and similar location matches. 
 
             GIVEN INFORMATION:
-            Closest Visual Matches, images closest to the input image from a database of geotagged images:
+            Closest Visual Matches, images closest to the input image from a database of geotagged images, grouped into clusters of nearby matches:
             {visual_match}
 
             Features Detected in Image:
@@ -55,33 +130,48 @@ def think(image_matches: Dict, features: Dict, image: Image) -> str:
             Write your response in a digestible format, using bullet points or numbered lists where appropriate. Do not use markdown formatting. Be concise as possible while ensuring clarity and completeness in your reasoning.
 """
 
-    
-    # Convert PIL Image to base64
-    buffered = io.BytesIO()
-    image.save(buffered, format=image.format or "JPEG")
-    img_base64 = base64.b64encode(buffered.getvalue()).decode()
-    
-    # Create multimodal message
-    from langchain_core.messages import HumanMessage
-    
-    message = HumanMessage(
-        content=[
-            {"type": "text", "text": prompt},
-            {
-                "type": "image_url",
-                "image_url": f"data:image/jpeg;base64,{img_base64}"
-            }
-        ]
-    )
-    
-    stream = model.stream([message])
-    return stream
+    return _image_message(prompt, image)
+
+def _think_structured_message(image_matches: Dict, features: Dict, image: Image, clusters: List[dict] = None):
+    message = _think_message(image_matches, features, image, clusters)
+    message.content[0]["text"] += STRUCTURED_OUTPUT_INSTRUCTIONS
+    return message
 
-def estimate_coordinates(reasoning) -> Dict:
+def think(image_matches: Dict, features: Dict, image: Image, clusters: List[dict] = None) -> str:
+    message = _think_message(image_matches, features, image, clusters)
+    stream = get_model().stream([message])
+    return timed_sync_stream("think", stream)
+
+async def athink(image_matches: Dict, features: Dict, image: Image, clusters: List[dict] = None) -> AsyncIterator:
+    """
+    Async variant of think: the image is encoded off the event loop and the
+    Gemini chunks are streamed natively with astream
+    """
+    message = await run_cpu(_think_message, image_matches, features, image, clusters)
+    async for chunk in timed_stream("think", llm_client.stream("think", [message])):
+        yield chunk
+
+async def athink_structured(image_matches: Dict, features: Dict, image: Image, clusters: List[dict] = None) -> AsyncIterator:
+    """
+    Single-pass variant of athink: the same stream ends with the coordinates
+    block, to be split off with CoordinatesStreamParser
+    """
+    message = await run_cpu(_think_structured_message, image_matches, features, image, clusters)
+    async for chunk in timed_stream("think_structured", llm_client.stream("think_structured", [message])):
+        yield chunk
+
+def _estimate_prompt(reasoning, clusters: List[dict] = None) -> str:
+    # Let the coordinate step see the same grounded candidates the reasoning used
+    cluster_context = ""
+    if clusters:
+        cluster_context = f"""
+            VISUAL MATCH CLUSTERS (geotagged database images near the candidate locations):
+            {format_clusters(clusters)}"""
 
     prompt = f"""
             You are a geolocation expert tasked with analyzing and determining the exact location of an image based on the following context.
             CONTEXT: {reasoning}
+{cluster_context}
 
             You have 4 deliverables to provide in a JSON array format with 4 fields:
             1. "latitude": the latitude of the approximated location of the image
@@ -96,42 +186,152 @@ def estimate_coordinates(reasoning) -> Dict:
             [{"{"}{"'latitude': float, 'longitude': float, 'name': str, 'accuracy': float, 'facts': str"}{"}"}]
 
             """
+    return prompt
 
-    response = model.invoke(prompt)
-    
-    # Parse the response to extract coordinates
+def estimate_coordinates(reasoning, clusters: List[dict] = None) -> Dict:
+    with span("estimate_coordinates"):
+        response = get_model().invoke(_estimate_prompt(reasoning, clusters))
+    return _parse_coordinates(response.content)
+
+async def aestimate_coordinates(reasoning, clusters: List[dict] = None) -> Dict:
+    with span("estimate_coordinates"):
+        response = await llm_client.invoke("estimate_coordinates", _estimate_prompt(reasoning, clusters))
+    return _parse_coordinates(response.content)
+
+def _loads_lenient(json_str: str):
+    try:
+        return json.loads(json_str)
+    except json.JSONDecodeError:
+        # The prompt shows single-quoted keys, which the model sometimes copies
+        return json.loads(json_str.replace("'", '"'))
+
+def _parse_coordinates(content: str) -> str:
+    """
+    Extract the JSON array of candidate locations from a model response
+    """
     try:
-        # Try to find JSON array in the response
-        content = response.content
-        
         # Extract JSON array from the response (it might be wrapped in markdown code blocks)
         json_match = re.search(r'\[.*\]', content, re.DOTALL)
         if json_match:
-            json_str = json_match.group(0)
-            # Replace single quotes with double quotes for valid JSON
-            json_str = json_str.replace("'", '"')
-            locations = json.loads(json_str)
+            locations = _loads_lenient(json_match.group(0))
             
-            print("extracted locations:", locations)
+            logger.debug("extracted locations: %s", locations)
             return json.dumps(locations)
         else:
-            print("Could not extract JSON from response")
-            return response.content
+            logger.warning("Could not extract JSON from response")
+            return content
             
     except Exception as e:
-        print(f"Error processing coordinates: {e}")
-        return response.content
+        logger.warning(f"Error processing coordinates: {e}")
+        return content
+
+def _partial_suffix(buffer: str, sentinel: str) -> int:
+    """Length of the longest suffix of buffer that is a proper prefix of sentinel"""
+    for n in range(min(len(sentinel) - 1, len(buffer)), 0, -1):
+        if buffer.endswith(sentinel[:n]):
+            return n
+    return 0
 
-def chat_with_context(user_message: str, conversation_history: str, image_matches: Dict, features: Dict, image: Image) -> str:
+class SentinelScanner:
     """
-    Handle follow-up questions with full conversation context
+    Strips a sentinel from a chunked stream. Only a trailing fragment that
+    could be the start of a sentinel split across chunks is held back;
+    everything else is returned from feed() immediately.
+    """
+
+    def __init__(self, sentinel: str = COORDINATES_SENTINEL):
+        self.sentinel = sentinel
+        self.found = False
+        self._pending = ""
+
+    def feed(self, text: str) -> str:
+        buffer = self._pending + text
+        if self.sentinel in buffer:
+            self.found = True
+            buffer = buffer.replace(self.sentinel, "")
+
+        hold = _partial_suffix(buffer, self.sentinel)
+        self._pending = buffer[len(buffer) - hold:] if hold else ""
+        return buffer[:len(buffer) - hold]
+
+    def flush(self) -> str:
+        """Release whatever was held back once the stream has ended"""
+        rest, self._pending = self._pending, ""
+        return rest
+
+class CoordinatesStreamParser:
+    """
+    Splits a single-pass stream into visible reasoning and the coordinates
+    block. feed() returns the visible text of the chunk plus every candidate
+    location whose JSON object completed in it, so each one can be sent as
+    soon as it arrives.
     """
-    visual_match = ""
-    for match in image_matches:
-        latitude = match['metadata']['latitude']
-        longitude = match['metadata']['longitude']
-        score = match['score']
-        visual_match += f"(Latitude: {latitude}, Longitude: {longitude}) - Score: {score}\n"
+
+    def __init__(self, marker: str = COORDINATES_MARKER):
+        self.marker = marker
+        self.in_block = False
+        self._pending = ""
+        self._block = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._start = None
+        self.locations: List[dict] = []
+
+    def feed(self, text: str) -> Tuple[str, List[dict]]:
+        if self.in_block:
+            return "", self._scan(text)
+
+        buffer = self._pending + text
+        index = buffer.find(self.marker)
+        if index >= 0:
+            self.in_block = True
+            self._pending = ""
+            return buffer[:index], self._scan(buffer[index + len(self.marker):])
+
+        hold = _partial_suffix(buffer, self.marker)
+        self._pending = buffer[len(buffer) - hold:] if hold else ""
+        return buffer[:len(buffer) - hold], []
+
+    def _scan(self, text: str) -> List[dict]:
+        self._block += text
+        found = []
+        while self._pos < len(self._block):
+            ch = self._block[self._pos]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                if self._depth == 0:
+                    self._start = self._pos
+                self._depth += 1
+            elif ch == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        location = _loads_lenient(self._block[self._start:self._pos + 1])
+                    except json.JSONDecodeError as e:
+                        logger.debug(f"Skipping malformed location object: {e}")
+                    else:
+                        self.locations.append(location)
+                        found.append(location)
+            self._pos += 1
+        return found
+
+    def flush(self) -> str:
+        """Visible text held back at the end of a stream that never reached the block"""
+        rest, self._pending = self._pending, ""
+        return rest
+
+def _chat_message(user_message: str, conversation_history: str, image_matches: Dict, features: Dict, image: Image, clusters: List[dict] = None):
+    visual_match = _visual_matches(image_matches, clusters)
 
     features_match = ""
     for match in features:
@@ -144,7 +344,7 @@ def chat_with_context(user_message: str, conversation_history: str, image_matche
     prompt = f"""You are a geography expert helping analyze this image to determine its location.
 
 CONTEXT INFORMATION:
-Closest Visual Matches (geotagged images from database):
+Closest Visual Matches (geotagged images from database, grouped into clusters of nearby matches):
 {visual_match}
 
 Features Detected in Image:
@@ -165,24 +365,22 @@ Be VERY concise, explain super simply, your audience is a 14-18 year old. Do not
 
 """
 
-    # Convert PIL Image to base64
-    buffered = io.BytesIO()
-    image.save(buffered, format=image.format or "JPEG")
-    img_base64 = base64.b64encode(buffered.getvalue()).decode()
-    
-    # Create multimodal message
-    from langchain_core.messages import HumanMessage
-    
-    message = HumanMessage(
-        content=[
-            {"type": "text", "text": prompt},
-            {
-                "type": "image_url",
-                "image_url": f"data:image/jpeg;base64,{img_base64}"
-            }
-        ]
-    )
-    
-    stream = model.stream([message])
+    return _image_message(prompt, image)
+
+def chat_with_context(user_message: str, conversation_history: str, image_matches: Dict, features: Dict, image: Image, clusters: List[dict] = None) -> str:
+    """
+    Handle follow-up questions with full conversation context
+    """
+    message = _chat_message(user_message, conversation_history, image_matches, features, image, clusters)
+    stream = get_model().stream([message])
+
+    return timed_sync_stream("chat", stream)
+
+async def achat_with_context(user_message: str, conversation_history: str, image_matches: Dict, features: Dict, image: Image, clusters: List[dict] = None) -> AsyncIterator:
+    """
+    Async variant of chat_with_context streaming chunks with astream
+    """
+    message = await run_cpu(_chat_message, user_message, conversation_history, image_matches, features, image, clusters)
+    async for chunk in timed_stream("chat", llm_client.stream("chat", [message])):
+        yield chunk
 
-    return stream
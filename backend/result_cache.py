@@ -0,0 +1,179 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+from PIL import Image
+
+from executor import run_io
+
+logger = logging.getLogger(__name__)
+
+# A cached analysis is replayed when the new upload is within this many bits
+# of its perceptual hash AND at least this similar in CLIP space. Set
+# RESULT_CACHE_MAX_HAMMING=64 to match on cosine only, or
+# RESULT_CACHE_MIN_COSINE=0 to match on the hash only.
+RESULT_CACHE_MAX_HAMMING = int(os.getenv("RESULT_CACHE_MAX_HAMMING", "6"))
+RESULT_CACHE_MIN_COSINE = float(os.getenv("RESULT_CACHE_MIN_COSINE", "0.95"))
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "5000"))
+# Optional JSONL file the cache is loaded from and appended to
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH")
+# Delay between replayed reasoning chunks; 0 sends the reasoning in one frame
+RESULT_REPLAY_DELAY_MS = float(os.getenv("RESULT_REPLAY_DELAY_MS", "0"))
+RESULT_REPLAY_CHUNK_CHARS = int(os.getenv("RESULT_REPLAY_CHUNK_CHARS", "40"))
+
+
+def dhash(image: Image.Image, size: int = 8) -> int:
+    """64-bit difference hash: brightness gradients of a 9x8 grayscale thumbnail"""
+    pixels = np.asarray(image.convert("L").resize((size + 1, size), Image.LANCZOS), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def _popcount(values: np.ndarray) -> np.ndarray:
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class ResultCache:
+    """
+    Near-duplicate index of finished process_image runs. Each entry keeps
+    the perceptual hash and normalized CLIP embedding of the image along
+    with the reasoning text and coordinates JSON that were sent.
+
+    Entries live in preallocated ring buffers, the newest overwriting the
+    oldest once max_entries is reached. The JSONL file is appended to off
+    the event loop and compacted to the newest max_entries lines whenever
+    it grows to twice that.
+    """
+
+    def __init__(self, max_entries: int = RESULT_CACHE_SIZE, path: Optional[str] = RESULT_CACHE_PATH,
+                 max_hamming: int = RESULT_CACHE_MAX_HAMMING, min_cosine: float = RESULT_CACHE_MIN_COSINE):
+        self.max_entries = max_entries
+        self.max_hamming = max_hamming
+        self.min_cosine = min_cosine
+        self.path = Path(path) if path else None
+        self._hashes = np.zeros(max_entries, dtype=np.uint64)
+        # Allocated on the first entry, once the embedding size is known
+        self._embeddings: Optional[np.ndarray] = None
+        self._results: List[Optional[dict]] = [None] * max_entries
+        self._count = 0
+        self._next = 0
+        self._file_lock = threading.Lock()
+        self._lines_on_disk = 0
+        self.hits = 0
+        self.misses = 0
+
+        if self.path and self.path.exists():
+            # Only the newest entries fit; older lines are skipped, not indexed
+            lines = deque(maxlen=max_entries)
+            with open(self.path) as f:
+                for line in f:
+                    lines.append(line)
+                    self._lines_on_disk += 1
+            for line in lines:
+                entry = json.loads(line)
+                self._add(entry["phash"], entry["embedding"], entry["result"])
+            if self._lines_on_disk > max_entries:
+                self._compact()
+            logger.info(f"Loaded {self._count} cached analyses from {self.path}")
+
+    def _add(self, phash: int, embedding, result: dict):
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if self._embeddings is None:
+            self._embeddings = np.zeros((self.max_entries, embedding.shape[0]), dtype=np.float32)
+        self._hashes[self._next] = np.uint64(phash)
+        self._embeddings[self._next] = embedding / (np.linalg.norm(embedding) or 1)
+        self._results[self._next] = result
+        # Oldest entries are overwritten first
+        self._next = (self._next + 1) % self.max_entries
+        self._count = min(self._count + 1, self.max_entries)
+
+    def lookup(self, phash: int, embedding) -> Optional[dict]:
+        """Closest cached result within both thresholds, if any"""
+        if not self._count:
+            self.misses += 1
+            return None
+
+        query = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        query /= np.linalg.norm(query) or 1
+        distances = _popcount(self._hashes[:self._count] ^ np.uint64(phash))
+        similarities = self._embeddings[:self._count] @ query
+
+        candidates = np.flatnonzero((distances <= self.max_hamming) & (similarities >= self.min_cosine))
+        if len(candidates) == 0:
+            self.misses += 1
+            return None
+
+        best = candidates[np.argmax(similarities[candidates])]
+        self.hits += 1
+        return self._results[best]
+
+    def _append(self, line: str):
+        with self._file_lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+            self._lines_on_disk += 1
+            if self._lines_on_disk >= 2 * self.max_entries:
+                self._compact()
+
+    def _compact(self):
+        """Rewrite the file with only its newest max_entries lines"""
+        with open(self.path) as f:
+            lines = deque(f, maxlen=self.max_entries)
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            f.writelines(lines)
+        os.replace(tmp, self.path)
+        self._lines_on_disk = len(lines)
+
+    async def store(self, phash: int, embedding, reasoning: str, coordinates: str):
+        """Remember a finished analysis (only when the coordinates are valid JSON)"""
+        try:
+            json.loads(coordinates)
+        except (TypeError, json.JSONDecodeError):
+            return
+
+        result = {"reasoning": reasoning, "coordinates": coordinates, "created": time.time()}
+        self._add(phash, embedding, result)
+        if self.path:
+            line = json.dumps({"phash": phash, "embedding": list(map(float, embedding)), "result": result}) + "\n"
+            await run_io(self._append, line)
+
+    def stats(self) -> dict:
+        return {"entries": self._count, "hits": self.hits, "misses": self.misses}
+
+
+async def replay(result: dict, send, delay_ms: float = RESULT_REPLAY_DELAY_MS, chunk_chars: int = RESULT_REPLAY_CHUNK_CHARS):
+    """
+    Send a cached analysis over the socket with the same message types as a
+    live run, optionally paced like a model stream
+    """
+    reasoning = result["reasoning"]
+    if delay_ms <= 0:
+        chunks = [reasoning]
+    else:
+        chunks, current = [], ""
+        for piece in re.findall(r"\S*\s*", reasoning):
+            current += piece
+            if len(current) >= chunk_chars:
+                chunks.append(current)
+                current = ""
+        chunks.append(current)
+
+    for chunk in chunks:
+        if chunk:
+            await send({"type": "reasoning_chunk", "text": chunk})
+            if delay_ms > 0:
+                await asyncio.sleep(delay_ms / 1000)
+
+    await send({"type": "coordinates", "text": result["coordinates"]})
+
+
+result_cache = ResultCache()
@@ -0,0 +1,190 @@
+"""
+Admission control for websocket analysis jobs.
+
+At most SCHEDULER_MAX_CONCURRENT jobs run at once, and at most
+SCHEDULER_PER_SESSION of them for one session. Further jobs wait in a
+bounded queue (SCHEDULER_MAX_QUEUE) that is served round-robin across
+sessions, so one busy session cannot starve the others. When the queue is
+full new jobs are refused with QueueFull.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, TypeVar
+
+from metrics import QUEUE_DEPTH, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_MAX_CONCURRENT = int(os.getenv("SCHEDULER_MAX_CONCURRENT", "8"))
+SCHEDULER_PER_SESSION = int(os.getenv("SCHEDULER_PER_SESSION", "1"))
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "64"))
+
+T = TypeVar("T")
+
+
+class QueueFull(Exception):
+    pass
+
+
+class _Waiter:
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.granted: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.moved = asyncio.Event()
+        self.position: Optional[int] = None
+
+
+class Scheduler:
+    def __init__(self, max_concurrent: int = SCHEDULER_MAX_CONCURRENT, per_session: int = SCHEDULER_PER_SESSION, max_queue: int = SCHEDULER_MAX_QUEUE):
+        self.max_concurrent = max_concurrent
+        self.per_session = per_session
+        self.max_queue = max_queue
+        self._running: Dict[str, int] = {}
+        self._total_running = 0
+        # Waiting jobs per session, in order of arrival
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._queued = 0
+        # When each active session last got a slot: least recently served goes first
+        self._served: Dict[str, int] = {}
+        self._grants = 0
+        self.rejected = 0
+        # Sessions allowed more (or fewer) jobs than per_session
+        self._limits: Dict[str, int] = {}
+
+    def set_session_limit(self, session_id: str, limit: Optional[int]):
+        """Override per_session for one session (e.g. a batch job); None restores the default"""
+        if limit is None:
+            self._limits.pop(session_id, None)
+        else:
+            self._limits[session_id] = limit
+        self._dispatch()
+
+    def _can_run(self, session_id: str) -> bool:
+        limit = self._limits.get(session_id, self.per_session)
+        return self._total_running < self.max_concurrent and self._running.get(session_id, 0) < limit
+
+    def _acquire(self, session_id: str):
+        self._running[session_id] = self._running.get(session_id, 0) + 1
+        self._total_running += 1
+        self._grants += 1
+        self._served[session_id] = self._grants
+
+    def _release(self, session_id: str):
+        self._running[session_id] -= 1
+        if not self._running[session_id]:
+            del self._running[session_id]
+            if session_id not in self._queues:
+                self._served.pop(session_id, None)
+        self._total_running -= 1
+        self._dispatch()
+
+    def _rotation(self) -> List[str]:
+        """Sessions with waiting jobs, least recently served first"""
+        return sorted(self._queues, key=lambda sid: self._served.get(sid, 0))
+
+    def _dispatch(self):
+        """Grant free slots to waiting jobs, one session at a time in rotation"""
+        granted = False
+        while self._total_running < self.max_concurrent:
+            session_id = next((sid for sid in self._rotation() if self._can_run(sid)), None)
+            if session_id is None:
+                break
+            queue = self._queues[session_id]
+            waiter = queue.popleft()
+            if not queue:
+                del self._queues[session_id]
+            self._queued -= 1
+            self._acquire(session_id)
+            waiter.granted.set_result(None)
+            granted = True
+        QUEUE_DEPTH.set(self._queued)
+        if granted:
+            for queue in self._queues.values():
+                for waiter in queue:
+                    waiter.moved.set()
+
+    def _order(self) -> List[_Waiter]:
+        """Waiting jobs in the order they would be served"""
+        queues = [list(self._queues[sid]) for sid in self._rotation()]
+        order = []
+        for round_ in range(max((len(q) for q in queues), default=0)):
+            order.extend(q[round_] for q in queues if round_ < len(q))
+        return order
+
+    def _remove(self, waiter: _Waiter):
+        queue = self._queues.get(waiter.session_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self._queued -= 1
+            if not queue:
+                del self._queues[waiter.session_id]
+                if waiter.session_id not in self._running:
+                    self._served.pop(waiter.session_id, None)
+            QUEUE_DEPTH.set(self._queued)
+            for queue in self._queues.values():
+                for other in queue:
+                    other.moved.set()
+
+    async def _wait(self, waiter: _Waiter, on_position: Optional[Callable[[int], Awaitable[None]]]):
+        while not waiter.granted.done():
+            waiter.moved.clear()
+            position = self._order().index(waiter) + 1
+            if on_position is not None and position != waiter.position:
+                waiter.position = position
+                await on_position(position)
+            if waiter.granted.done():
+                break
+            moved = asyncio.ensure_future(waiter.moved.wait())
+            try:
+                await asyncio.wait({waiter.granted, moved}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                moved.cancel()
+
+    async def run(self, session_id: str, job: Callable[[], Awaitable[T]], on_position: Optional[Callable[[int], Awaitable[None]]] = None) -> T:
+        """
+        Run job() once a slot is free. While queued, on_position(n) is awaited
+        whenever the job's 1-based place in line changes. Raises QueueFull if
+        the job cannot even be queued
+        """
+        if self._can_run(session_id) and not self._queues:
+            self._acquire(session_id)
+        else:
+            if self._queued >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull()
+            waiter = _Waiter(session_id)
+            self._queues.setdefault(session_id, deque()).append(waiter)
+            self._queued += 1
+            # Slots may be free for this session even though others are waiting
+            self._dispatch()
+            start = time.perf_counter()
+            try:
+                await self._wait(waiter, on_position)
+            except BaseException:
+                if waiter.granted.done() and not waiter.granted.cancelled():
+                    # Granted just as we were cancelled: hand the slot on
+                    self._release(session_id)
+                else:
+                    self._remove(waiter)
+                raise
+            finally:
+                STAGE_SECONDS.labels("queue_wait").observe(time.perf_counter() - start)
+
+        try:
+            return await job()
+        finally:
+            self._release(session_id)
+
+    def stats(self) -> dict:
+        return {
+            "running": self._total_running,
+            "queued": self._queued,
+            "sessions_waiting": len(self._queues),
+            "rejected": self.rejected,
+            "max_concurrent": self.max_concurrent,
+            "per_session": self.per_session,
+            "max_queue": self.max_queue,
+        }
@@ -0,0 +1,53 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from vectorstore import LocalStore  # noqa: E402
+
+
+def _rows(n, dim=8, seed=0):
+    vectors = np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+    return [f"id-{i}" for i in range(n)], vectors, [{"row": i} for i in range(n)]
+
+
+def test_rebuild_while_reader_holds_mmap(tmp_path):
+    LocalStore(tmp_path).write_namespace("images", *_rows(500))
+    reader = LocalStore(tmp_path)
+    ids, vectors, _ = _rows(500)
+    assert reader.query(vectors[3], top_k=1, namespace="images")[0]["id"] == "id-3"
+
+    # Rebuild from another store (another process in production) with fewer rows
+    writer = LocalStore(tmp_path).writer("images")
+    new_ids, new_vectors, new_metadata = _rows(50, seed=1)
+    writer.append(new_ids, new_vectors, new_metadata)
+    # Mid-rebuild the live namespace is untouched
+    assert len(LocalStore(tmp_path).query(vectors[3], top_k=500, namespace="images")) == 500
+    writer.close(build_ivf=True)
+
+    # The reader's mapping still points at the old, intact files
+    match = reader.query(vectors[3], top_k=1, namespace="images")[0]
+    assert match["id"] == "id-3" and match["metadata"] == {"row": 3}
+    fresh = LocalStore(tmp_path)
+    assert len(fresh.query(new_vectors[0], top_k=100, namespace="images")) == 50
+    assert not [p.name for p in tmp_path.iterdir() if p.name != "images"]
+
+
+def test_failed_rebuild_leaves_namespace(tmp_path):
+    ids, vectors, metadata = _rows(20)
+    LocalStore(tmp_path).write_namespace("images", ids, vectors, metadata)
+    with pytest.raises(RuntimeError):
+        with LocalStore(tmp_path).writer("images") as writer:
+            writer.append(*_rows(5, seed=1))
+            raise RuntimeError("encoder died")
+    assert len(LocalStore(tmp_path).query(vectors[0], top_k=100, namespace="images")) == 20
+    assert [p.name for p in tmp_path.iterdir()] == ["images"]
+
+
+def test_empty_batch(tmp_path):
+    store = LocalStore(tmp_path)
+    store.write_namespace("empty", [], np.empty((0, 8), np.float32), [])
+    assert store.query(np.ones(8, np.float32), namespace="empty") == []
@@ -0,0 +1,107 @@
+"""
+Streaming upload handling: request bodies over the limit are rejected while
+they arrive, and the file is hashed chunk by chunk without ever being held
+in memory as a whole.
+"""
+import hashlib
+import os
+from typing import Tuple
+
+from fastapi import UploadFile
+
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1024 * 1024)))
+# Room for the multipart boundaries and headers around the file itself
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadLimitMiddleware:
+    """
+    ASGI middleware capping request bodies under path_prefix. A declared
+    Content-Length over the cap is refused before reading anything; otherwise
+    bytes are counted as they are received and the request is aborted with
+    413 once the cap is passed, before multipart parsing spools the rest.
+    """
+
+    def __init__(self, app, path_prefix: str = "/upload-image", max_bytes: int = UPLOAD_MAX_BYTES + MULTIPART_OVERHEAD_BYTES):
+        self.app = app
+        self.path_prefix = path_prefix
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.path_prefix):
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        declared = headers.get(b"content-length")
+        if declared is not None and declared.isdigit() and int(declared) > self.max_bytes:
+            await _reject(send)
+            return
+
+        received = 0
+        exceeded = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            if exceeded:
+                raise UploadTooLarge()
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    exceeded = True
+                    raise UploadTooLarge()
+            return message
+
+        async def limited_send(message):
+            # The body parser turns the abort into its own error response:
+            # answer 413 instead and drop what the app sends
+            nonlocal rejected
+            if exceeded:
+                if not rejected:
+                    rejected = True
+                    await _reject(send)
+                return
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, limited_send)
+        except UploadTooLarge:
+            if not rejected:
+                await _reject(send)
+
+
+async def _reject(send):
+    body = b'{"detail":"File too large"}'
+    await send({
+        "type": "http.response.start",
+        "status": 413,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), (b"connection", b"close")],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def hash_upload(file: UploadFile, max_bytes: int = UPLOAD_MAX_BYTES) -> Tuple[str, int]:
+    """
+    SHA-256 and size of an uploaded file, read in UPLOAD_CHUNK_BYTES chunks.
+    Raises UploadTooLarge as soon as max_bytes is exceeded. Leaves the file
+    rewound for decoding.
+    """
+    hasher = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            raise UploadTooLarge()
+        hasher.update(chunk)
+    await file.seek(0)
+    return hasher.hexdigest(), size
@@ -0,0 +1,368 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NAMESPACE = "__default__"
+# Number of IVF lists probed per query when a namespace has a coarse quantizer
+IVF_NPROBE = int(os.getenv("LOCAL_INDEX_NPROBE", "8"))
+
+
+class VectorStore:
+    """
+    Common query contract for the retrieval backends. Matches are returned
+    as dicts with 'id', 'score' and 'metadata', best score first.
+    """
+
+    def query(self, vector, top_k=5, namespace=None, threshold=0) -> List[dict]:
+        raise NotImplementedError
+
+    def warm_up(self, namespaces: List[str]):
+        """Open connections / load data so the first query is not slow"""
+
+    def upsert(self, ids: List[str], vectors, metadata: List[dict], namespace=None):
+        """Insert or overwrite vectors by id"""
+        raise NotImplementedError
+
+
+class PineconeStore(VectorStore):
+    """Hosted Pinecone index"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def warm_up(self, namespaces: List[str]):
+        self.index.describe_index_stats()
+
+    def query(self, vector, top_k=5, namespace=None, threshold=0) -> List[dict]:
+        response = self.index.query(vector=vector, top_k=top_k, include_metadata=True, namespace=namespace)
+        matches = response['matches']
+        if threshold > 0:
+            matches = [m for m in matches if m['score'] >= threshold]
+        return matches
+
+    def upsert(self, ids: List[str], vectors, metadata: List[dict], namespace=None):
+        records = [
+            {"id": vector_id, "values": [float(x) for x in values], "metadata": meta}
+            for vector_id, values, meta in zip(ids, vectors, metadata)
+        ]
+        self.index.upsert(vectors=records, namespace=namespace)
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _top_k(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Indices of the top_k scores, best first"""
+    if top_k >= len(scores):
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, top_k)[:top_k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+class _Namespace:
+    """
+    One namespace on disk:
+        vectors.npy      float32 (N, D), L2-normalized, memory-mapped
+        ids.json         list of N ids
+        metadata.jsonl   one metadata object per row
+        ivf_centroids.npy, ivf_order.npy, ivf_offsets.npy (optional)
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.vectors = np.load(path / "vectors.npy", mmap_mode="r")
+        self.ids = json.loads((path / "ids.json").read_text())
+        with open(path / "metadata.jsonl") as f:
+            self.metadata = [json.loads(line) for line in f]
+
+        self.centroids = None
+        if (path / "ivf_centroids.npy").exists():
+            self.centroids = np.load(path / "ivf_centroids.npy")
+            self.order = np.load(path / "ivf_order.npy", mmap_mode="r")
+            self.offsets = np.load(path / "ivf_offsets.npy")
+
+    def search(self, query: np.ndarray, top_k: int, nprobe: int):
+        if self.centroids is None:
+            scores = self.vectors @ query
+            rows = _top_k(scores, top_k)
+            return rows, scores[rows]
+
+        # Coarse step: only scan the inverted lists of the closest centroids
+        probes = _top_k(self.centroids @ query, nprobe)
+        rows = np.concatenate([self.order[self.offsets[p]:self.offsets[p + 1]] for p in probes])
+        if len(rows) == 0:
+            return rows, np.empty(0, dtype=np.float32)
+        rows.sort()  # sequential reads from the memory map
+        scores = self.vectors[rows] @ query
+        best = _top_k(scores, top_k)
+        return rows[best], scores[best]
+
+
+class LocalStore(VectorStore):
+    """
+    Local index of memory-mapped per-namespace embedding matrices. Vectors
+    are stored L2-normalized so scores are cosine similarities, matching the
+    hosted index metric.
+    """
+
+    def __init__(self, root: str, nprobe: int = IVF_NPROBE):
+        self.root = Path(root)
+        self.nprobe = nprobe
+        self._namespaces: Dict[str, _Namespace] = {}
+
+    def _namespace(self, namespace: Optional[str]) -> Optional[_Namespace]:
+        name = namespace or DEFAULT_NAMESPACE
+        if name not in self._namespaces:
+            path = self.root / name
+            if not (path / "vectors.npy").exists():
+                return None
+            self._namespaces[name] = _Namespace(path)
+        return self._namespaces[name]
+
+    def warm_up(self, namespaces: List[str]):
+        for namespace in namespaces:
+            ns = self._namespace(namespace)
+            if ns is not None:
+                # Fault the matrix pages in ahead of the first query
+                ns.vectors.sum()
+
+    def query(self, vector, top_k=5, namespace=None, threshold=0) -> List[dict]:
+        ns = self._namespace(namespace)
+        if ns is None or len(ns.ids) == 0:
+            return []
+
+        query = _normalize(np.asarray(vector, dtype=np.float32).reshape(-1))
+        rows, scores = ns.search(query, top_k, self.nprobe)
+
+        matches = []
+        for row, score in zip(rows.tolist(), scores.tolist()):
+            if threshold > 0 and score < threshold:
+                continue
+            matches.append({"id": ns.ids[row], "score": score, "metadata": ns.metadata[row]})
+        return matches
+
+    def writer(self, namespace: Optional[str]) -> "NamespaceWriter":
+        """Open a streaming writer that replaces the namespace on close()"""
+        name = namespace or DEFAULT_NAMESPACE
+        # Our own readers reopen the namespace once it has been replaced
+        self._namespaces.pop(name, None)
+        return NamespaceWriter(self.root / name)
+
+    def write_namespace(self, namespace: Optional[str], ids: List[str], vectors: np.ndarray, metadata: List[dict]):
+        """Write (or replace) a namespace from in-memory arrays"""
+        with self.writer(namespace) as writer:
+            writer.append(ids, vectors, metadata)
+
+    def build_ivf(self, namespace: Optional[str], n_lists: Optional[int] = None, iterations: int = 10, sample_size: int = 100_000, chunk_size: int = 65_536):
+        """
+        Train a spherical k-means coarse quantizer on a sample of the
+        namespace and write its inverted lists next to the vectors. The
+        namespace is staged (hard links to its files) and swapped into place,
+        so readers never see a half-written quantizer
+        """
+        name = namespace or DEFAULT_NAMESPACE
+        path = self.root / name
+        staging = _staging_dir(path)
+        try:
+            for file in NAMESPACE_FILES:
+                os.link(path / file, staging / file)
+            _build_ivf(staging, n_lists, iterations, sample_size, chunk_size)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        _swap_into_place(staging, path)
+        self._namespaces.pop(name, None)
+
+
+NAMESPACE_FILES = ("vectors.npy", "ids.json", "metadata.jsonl")
+
+
+def _staging_dir(path: Path) -> Path:
+    """An empty sibling directory a new version of the namespace is written to"""
+    staging = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir(parents=True)
+    return staging
+
+
+def _swap_into_place(staging: Path, path: Path):
+    """
+    Replace the namespace directory with a staged one. Files are never
+    rewritten in place, so readers that memory-mapped the old version keep
+    valid (unlinked) files; new readers see the old or the new version, or
+    for an instant no namespace at all
+    """
+    old = path.with_name(f"{path.name}.old-{os.getpid()}")
+    shutil.rmtree(old, ignore_errors=True)
+    if path.exists():
+        os.replace(path, old)
+    os.replace(staging, path)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def _build_ivf(path: Path, n_lists: Optional[int], iterations: int = 10, sample_size: int = 100_000, chunk_size: int = 65_536):
+    """Write ivf_*.npy for the vectors in path"""
+    vectors = np.load(path / "vectors.npy", mmap_mode="r")
+    n = len(vectors)
+    if n == 0:
+        return
+    n_lists = n_lists or max(1, int(np.sqrt(n)))
+
+    rng = np.random.default_rng(0)
+    sample = np.asarray(vectors[np.sort(rng.choice(n, size=min(n, sample_size), replace=False))])
+    centroids = sample[rng.choice(len(sample), size=min(n_lists, len(sample)), replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(len(centroids)):
+            members = sample[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+        centroids = _normalize(centroids)
+
+    # Assign every row in chunks so the full matrix never leaves the mmap
+    assign = np.empty(n, dtype=np.int32)
+    for start in range(0, n, chunk_size):
+        block = np.asarray(vectors[start:start + chunk_size])
+        assign[start:start + chunk_size] = np.argmax(block @ centroids.T, axis=1)
+
+    order = np.argsort(assign, kind="stable").astype(np.int64)
+    offsets = np.searchsorted(assign[order], np.arange(len(centroids) + 1)).astype(np.int64)
+    np.save(path / "ivf_centroids.npy", centroids.astype(np.float32))
+    np.save(path / "ivf_order.npy", order)
+    np.save(path / "ivf_offsets.npy", offsets)
+    logger.info(f"Built IVF for {path.name}: {len(centroids)} lists over {n} vectors")
+
+
+class NamespaceWriter:
+    """
+    Appends normalized vectors to a raw scratch file so snapshots larger
+    than memory can be written. Everything goes to a staging directory next
+    to the namespace; close() finishes it and swaps it into place, abort()
+    discards it and leaves the live namespace untouched. Used as a context
+    manager, it closes on success and aborts on an exception.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.staging = _staging_dir(path)
+        self.ids: List[str] = []
+        self.dim = None
+        self._raw = open(self.staging / "vectors.f32.tmp", "wb")
+        self._metadata = open(self.staging / "metadata.jsonl", "w")
+
+    def __enter__(self) -> "NamespaceWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def append(self, ids: List[str], vectors, metadata: List[dict]):
+        if not ids:
+            # An empty batch is valid input; reshape(0, -1) is not
+            return
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1))
+        self.dim = vectors.shape[1]
+        self._raw.write(vectors.tobytes())
+        for meta in metadata:
+            self._metadata.write(json.dumps(meta or {}) + "\n")
+        self.ids.extend(ids)
+
+    def close(self, build_ivf: bool = False, n_lists: Optional[int] = None):
+        """Finish the staged namespace (optionally with an IVF) and swap it into place"""
+        try:
+            self._raw.close()
+            self._metadata.close()
+            raw_path = self.staging / "vectors.f32.tmp"
+            raw = np.memmap(raw_path, dtype=np.float32, mode="r", shape=(len(self.ids), self.dim or 0)) if self.ids else np.empty((0, 0), np.float32)
+            out = np.lib.format.open_memmap(self.staging / "vectors.npy", mode="w+", dtype=np.float32, shape=raw.shape)
+            out[:] = raw
+            out.flush()
+            del raw, out
+            raw_path.unlink()
+            (self.staging / "ids.json").write_text(json.dumps(self.ids))
+            if build_ivf:
+                _build_ivf(self.staging, n_lists)
+        except BaseException:
+            self.abort()
+            raise
+        _swap_into_place(self.staging, self.path)
+
+    def abort(self):
+        """Discard everything written; the live namespace is left as it was"""
+        self._raw.close()
+        self._metadata.close()
+        shutil.rmtree(self.staging, ignore_errors=True)
+
+
+def export_pinecone_namespace(index, store: LocalStore, namespace: str, batch_size: int = 200):
+    """Snapshot every vector of a Pinecone namespace into the local store"""
+    with store.writer(namespace) as writer:
+        for page in index.list(namespace=namespace):
+            for start in range(0, len(page), batch_size):
+                batch = page[start:start + batch_size]
+                fetched = index.fetch(ids=batch, namespace=namespace).vectors
+                records = [fetched[vector_id] for vector_id in batch if vector_id in fetched]
+                if records:
+                    writer.append(
+                        [record.id for record in records],
+                        [record.values for record in records],
+                        [dict(record.metadata or {}) for record in records],
+                    )
+            print(f"[{namespace}] exported {len(writer.ids)} vectors")
+    return len(writer.ids)
+
+
+def import_pinecone_namespace(index, store: LocalStore, namespace: str, batch_size: int = 100):
+    """Upsert a local namespace snapshot back into a Pinecone index"""
+    ns = store._namespace(namespace)
+    if ns is None:
+        raise ValueError(f"No local snapshot for namespace {namespace}")
+    for start in range(0, len(ns.ids), batch_size):
+        records = [
+            {"id": ns.ids[row], "values": ns.vectors[row].tolist(), "metadata": ns.metadata[row]}
+            for row in range(start, min(start + batch_size, len(ns.ids)))
+        ]
+        index.upsert(vectors=records, namespace=namespace)
+    print(f"[{namespace}] imported {len(ns.ids)} vectors")
+    return len(ns.ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snapshot tooling for the local vector index")
+    parser.add_argument("command", choices=["export", "import", "build-ivf"])
+    parser.add_argument("--root", default=os.getenv("LOCAL_INDEX_DIR", "index"))
+    parser.add_argument("--namespaces", nargs="+", default=["images", "features"])
+    parser.add_argument("--index-name", default="htv2025")
+    parser.add_argument("--n-lists", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    store = LocalStore(args.root)
+
+    if args.command == "build-ivf":
+        for namespace in args.namespaces:
+            store.build_ivf(namespace, n_lists=args.n_lists)
+    else:
+        from dotenv import load_dotenv
+        from pinecone import Pinecone
+        load_dotenv()
+        index = Pinecone(api_key=os.getenv("PINECONE_API_KEY")).Index(args.index_name)
+        for namespace in args.namespaces:
+            if args.command == "export":
+                export_pinecone_namespace(index, store, namespace)
+            else:
+                import_pinecone_namespace(index, store, namespace)
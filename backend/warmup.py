@@ -0,0 +1,99 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List
+
+from PIL import Image
+
+import pineconedb
+import reasoning
+
+logger = logging.getLogger(__name__)
+
+# Failed steps are retried, waiting twice as long each time up to the maximum
+WARMUP_RETRY_SECONDS = float(os.getenv("WARMUP_RETRY_SECONDS", "2"))
+WARMUP_RETRY_MAX_SECONDS = float(os.getenv("WARMUP_RETRY_MAX_SECONDS", "60"))
+
+
+class Readiness:
+    """Per-component readiness reported by /ready"""
+
+    def __init__(self, components):
+        self._lock = threading.Lock()
+        self._state: Dict[str, dict] = {name: {"ready": False, "error": None, "seconds": None, "attempts": 0} for name in components}
+
+    def run(self, name: str, step: Callable[[], None]):
+        """Run a warm-up step until it succeeds, backing off between failures"""
+        delay = WARMUP_RETRY_SECONDS
+        while True:
+            start = time.perf_counter()
+            with self._lock:
+                self._state[name]["attempts"] += 1
+                attempts = self._state[name]["attempts"]
+            try:
+                step()
+            except Exception as e:
+                logger.error(f"Warm-up of {name} failed (attempt {attempts}), retrying in {delay:g}s: {e}")
+                with self._lock:
+                    self._state[name]["error"] = str(e)
+                time.sleep(delay)
+                delay = min(delay * 2, WARMUP_RETRY_MAX_SECONDS)
+                continue
+            elapsed = time.perf_counter() - start
+            logger.info(f"{name} ready in {elapsed:.2f}s")
+            with self._lock:
+                self._state[name].update(ready=True, error=None, seconds=round(elapsed, 3))
+            return
+
+    def skip(self):
+        """Warm-up is disabled: components load on first use, so report ready"""
+        with self._lock:
+            for state in self._state.values():
+                state.update(ready=True, error=None)
+
+    @property
+    def ready(self) -> bool:
+        with self._lock:
+            return all(state["ready"] for state in self._state.values())
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self._lock:
+            return {name: dict(state) for name, state in self._state.items()}
+
+
+def _warm_clip():
+    pineconedb.get_clip()
+    # First inference pays for torch's lazy init and allocator warm-up
+    pineconedb.embed_image(Image.new("RGB", (224, 224)))
+
+
+def _warm_vector_store():
+    pineconedb.get_vector_store().warm_up(["images", "features"])
+
+
+def _warm_features():
+    if pineconedb.FEATURE_MATCHING == "memory" and not pineconedb.feature_index.available:
+        logger.info(f"No feature index in {pineconedb.feature_index.path}, features are queried from the vector store")
+
+
+def _warm_llm():
+    reasoning.get_model()
+
+
+STEPS = {
+    "clip": _warm_clip,
+    "vector_store": _warm_vector_store,
+    "features": _warm_features,
+    "llm": _warm_llm,
+}
+
+readiness = Readiness(STEPS)
+
+
+def start_warm_up() -> List[threading.Thread]:
+    """Warm every component on background threads so the server binds immediately"""
+    threads = [threading.Thread(target=readiness.run, args=(name, step), name=f"warmup-{name}", daemon=True) for name, step in STEPS.items()]
+    for thread in threads:
+        thread.start()
+    return threads
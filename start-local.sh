@@ -24,7 +24,7 @@ trap cleanup SIGINT SIGTERM
 # Start backend
 echo "📦 Starting FastAPI backend on http://localhost:8000..."
 cd backend
-uvicorn main:app --reload --host 0.0.0.0 --port 8000 &
+uvicorn main:app --reload --host 0.0.0.0 --port 8000 --ws-per-message-deflate true &
 BACKEND_PID=$!
 cd ..
 